@@ -0,0 +1,298 @@
+"""Benchmarks for parsing TOUGH2 listing and history files, using synthetic files.
+
+Synthetic AUTOUGH2, TOUGH2, TOUGH2_MP and TOUGH+ listings (and FOFT, COFT and GOFT history
+files) are generated for a rectangular geometry with the specified numbers of blocks, tables and
+times.  The time taken to open each listing, navigate through it, extract histories and VTK data
+(if VTK is available), and read the history files is reported, together with throughput in MB/s and
+rows/s.  Results can be saved as a baseline and later runs compared against it to detect
+performance regressions, e.g.:
+
+  python listing_benchmark.py --blocks 20000 --times 10 --save-baseline baseline.json
+  python listing_benchmark.py --blocks 20000 --times 10 --baseline baseline.json
+"""
+
+"""
+Copyright 2012 University of Auckland.
+
+This file is part of PyTOUGH.
+
+PyTOUGH is free software: you can redistribute it and/or modify it under the terms of the GNU Lesser General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+PyTOUGH is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with PyTOUGH.  If not, see <http://www.gnu.org/licenses/>."""
+
+import os, sys
+from time import time as clock
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+from mulgrids import mulgrid
+from t2listing import t2listing, t2historyfile
+
+simulators = ['AUTOUGH2', 'TOUGH2', 'TOUGH2_MP', 'TOUGH+']
+all_tables = ['element', 'connection', 'generation']
+
+column_names = {
+    'AUTOUGH2': {'element': ['Pressure', 'Temperature', 'Vapour saturation'],
+                 'connection': ['Mass flow', 'Heat flow', 'Liquid flow'],
+                 'generation': ['Generation', 'Enthalpy']},
+    'TOUGH2': {'element': ['P', 'T', 'SG', 'SW', 'X(WAT1)', 'DG', 'DW'],
+               'connection': ['FLOH', 'FLOF', 'FLO(GAS)', 'FLO(AQ.)', 'VEL(GAS)', 'VEL(LIQ.)'],
+               'generation': ['GENERATION RATE', 'ENTHALPY']},
+    'TOUGH+': {'element': ['Pressure', 'Temperature', 'SatGas', 'SatAqu'],
+               'connection': ['HeatFlow', 'GasFlow', 'AquFlow'],
+               'generation': ['Rate', 'Enthalpy']}}
+column_names['TOUGH2_MP'] = column_names['TOUGH2']
+key_headers = {'AUTOUGH2': {'element': 'ELEMENT INDEX', 'connection': 'ELEM1 ELEM2 INDEX',
+                            'generation': 'ELEMENT SOURCE INDEX'},
+               'TOUGH2': {'element': 'ELEM.  INDEX', 'connection': 'ELEM1 ELEM2  INDEX',
+                          'generation': 'ELEMENT SOURCE INDEX'},
+               'TOUGH+': {'element': 'ELEM  INDEX', 'connection': 'ELEM1 ELEM2  INDEX',
+                          'generation': 'ELEMENT SOURCE INDEX'}}
+key_headers['TOUGH2_MP'] = key_headers['TOUGH2']
+
+def benchmark_geometry(num_blocks, num_layers = 10):
+    """Returns rectangular geometry with approximately the specified number of blocks (and no atmosphere blocks)."""
+    ncols = max(1, num_blocks / num_layers)
+    nx = max(1, int(np.sqrt(ncols)))
+    ny = max(1, ncols / nx)
+    return mulgrid().rectangular([100.] * nx, [100.] * ny, [10.] * num_layers, atmos_type = 2)
+
+def table_rows(geo, tablename):
+    """Returns row keys for the specified table."""
+    if tablename == 'element': return geo.block_name_list
+    elif tablename == 'connection': return geo.block_connection_name_list
+    else: return [(blk, 'g%4d' % (i % 10000)) for i, blk in enumerate(geo.block_name_list[::10])]
+
+def table_values(tablename, ncols, nrows, itime):
+    """Returns array of synthetic table values."""
+    base = np.arange(nrows, dtype = float)[:, np.newaxis]
+    vals = 1.e5 + base * (np.arange(ncols) + 1.) + 10. * itime
+    if tablename <> 'element': vals[:, 0] *= -1.
+    return vals
+
+def row_key_string(key):
+    return key if isinstance(key, str) else ' '.join(key)
+
+def format_rows(keys, vals, index_width, fmt, order = None):
+    """Returns string for table rows, formatted in one operation."""
+    n = len(keys)
+    if order is None: order = np.arange(n)
+    items = np.empty((n, 2 + vals.shape[1]), object)
+    items[:, 0] = np.array([row_key_string(keys[i]) for i in order], object)
+    items[:, 1] = order + 1
+    items[:, 2:] = vals[order]
+    row_fmt = ' %s' + (' %' + str(index_width) + 'd') + fmt * vals.shape[1] + '\n'
+    return (row_fmt * n) % tuple(items.ravel())
+
+def write_listing(filename, simulator, geo, num_times = 5, tables = all_tables, title = 'Benchmark listing'):
+    """Writes synthetic listing file for the specified simulator, with results for the blocks and connections
+    in the geometry."""
+    rows = dict([(tablename, table_rows(geo, tablename)) for tablename in tables])
+    f = open(filename, 'w')
+    if simulator == 'TOUGH2_MP': f.write('\f\n' + title + '\n')
+    else: f.write(' PROBLEM TITLE: ' + title + '\n')
+    f.write('\n')
+    sep = 120
+    for itime in xrange(num_times):
+        t, step = (itime + 1) * 1.e6, (itime + 1) * 10
+        if simulator <> 'AUTOUGH2':
+            marker = '=' if simulator == 'TOUGH+' else '@'
+            f.write('\n OUTPUT DATA AFTER (%5d, 2)-2-TIME STEPS\n' % step)
+            f.write(' ' + marker * sep + '\n\n')
+            f.write(' TOTAL TIME     KCYC   ITER  ITERC    KON\n')
+            f.write(' %12.5E %6d %6d %6d %6d\n\n' % (t, step, 2, step * 2, 2))
+            f.write(marker * sep + '\n\n')
+        for itable, tablename in enumerate(tables):
+            cols = column_names[simulator][tablename]
+            keys = rows[tablename]
+            vals = table_values(tablename, len(cols), len(keys), itime)
+            header = ' ' + key_headers[simulator][tablename] + '  ' + '  '.join(cols) + '\n'
+            if simulator == 'AUTOUGH2':
+                kw = ' ' + tablename[0].upper() * sep + '\n'
+                f.write(kw + ' ' + title + '\n')
+                f.write(' OUTPUT DATA AFTER %6d TIME STEPS %16.8E SECONDS\n' % (step, t))
+                f.write(kw + '\n   KCYC   ITER\n   %d   2\n' % step)
+                f.write(header + '\n')
+                f.write(format_rows(keys, vals, 5, '%14.6E'))
+                f.write(kw + '\n')
+            else:
+                if itable > 0:
+                    if simulator == 'TOUGH+': f.write('_' * sep + '\n\n')
+                    else: f.write('\n          KCYC =%5d  -  ITER =    2  -  TIME = %12.5E\n\n' % (step, t))
+                f.write(header + '\n')
+                order = None
+                if simulator == 'TOUGH2_MP': # rows out of index order
+                    order = np.arange(len(keys)).reshape((-1,1))
+                    order = np.hstack((order[1::2].ravel(), order[0::2].ravel())) if len(keys) > 1 else order.ravel()
+                f.write(format_rows(keys, vals, 6, ' %12.5E', order))
+                f.write('\n' + '@' * sep + '\n')
+        if simulator == 'AUTOUGH2': f.write('\n')
+    f.close()
+
+def write_history_file(filename, simulator, geo, history_type = 'FOFT', num_keys = 10, num_times = 100):
+    """Writes synthetic FOFT, COFT or GOFT file for the specified simulator (TOUGH2, TOUGH2_MP or TOUGH+)."""
+    tablename = {'FOFT': 'element', 'COFT': 'connection', 'GOFT': 'generation'}[history_type]
+    cols = column_names[simulator][tablename][:2]
+    keys = table_rows(geo, tablename)[:num_keys]
+    times = np.arange(num_times) * 1.e5
+    f = open(filename, 'w')
+    if simulator == 'TOUGH2':
+        for itime, t in enumerate(times):
+            vals = table_values(tablename, len(cols), len(keys), itime)
+            f.write('%6d, %14.6E,' % (itime + 1, t))
+            f.write(''.join([' %6d,' % (i + 1) + ''.join([' %14.6E,' % v for v in vals[i]]) for i in xrange(len(keys))]))
+            f.write('\n')
+    elif simulator == 'TOUGH2_MP':
+        width = 16
+        key_names = ['ELEM'] if history_type == 'FOFT' else ['ELEM1', 'ELEM2']
+        colnames = [c.replace(' ', '_') for c in cols]
+        if history_type == 'FOFT': heads = [history_type] + key_names + ['TIME(S)'] + colnames
+        else: heads = [history_type, 'TIME(S)'] + key_names + colnames
+        f.write(''.join([h.ljust(width) for h in heads]) + '\n')
+        for itime, t in enumerate(times):
+            vals = table_values(tablename, len(cols), len(keys), itime)
+            for i, key in enumerate(keys):
+                keystrs = [key] if isinstance(key, str) else list(key)
+                keyfields = [k.ljust(width) for k in keystrs]
+                timefield = ('%14.6E' % t).ljust(width)
+                if history_type == 'FOFT': fields = [' ' * width] + keyfields + [timefield]
+                else: fields = [' ' * width, timefield] + keyfields
+                f.write(''.join(fields) + ''.join([('%14.6E' % v).ljust(width) for v in vals[i]]) + '\n')
+    else: # TOUGH+
+        if history_type == 'FOFT':
+            f.write('Time [sec] - ElemIndex - ' + ' - '.join(cols) + '\n')
+            for itime, t in enumerate(times):
+                vals = table_values(tablename, len(cols), len(keys), itime)
+                f.write('%6d, %14.6E,' % (itime + 1, t))
+                f.write(','.join([' %6d,' % (i + 1) + ','.join([' %14.6E' % v for v in vals[i]]) for i in xrange(len(keys))]))
+                f.write('\n')
+        else:
+            f.write('Time [sec] - ' + ' - '.join(cols) + '\n')
+            for itime, t in enumerate(times):
+                vals = table_values(tablename, len(cols), 1, itime)
+                f.write(' %14.6E' % t + ''.join([' %14.6E' % v for v in vals[0]]) + '\n')
+    f.close()
+
+def listing_filename(directory, simulator):
+    """Returns filename for synthetic listing (TOUGH2_MP listing filenames must end in OUTPUT_DATA)."""
+    if simulator == 'TOUGH2_MP': return os.path.join(directory, 'MP_OUTPUT_DATA')
+    else: return os.path.join(directory, simulator.replace('+', 'plus') + '.listing')
+
+def history_filename(directory, simulator, history_type):
+    return os.path.join(directory, simulator.replace('+', 'plus') + '_' + history_type)
+
+def timed(fn):
+    """Returns result of calling fn, and the time taken."""
+    start = clock()
+    result = fn()
+    return result, clock() - start
+
+def benchmark_listing(filename, geo, num_history = 10):
+    """Runs benchmarks on the specified listing file and returns dictionary of results."""
+    results = {}
+    size = os.path.getsize(filename) / 1.e6
+    lst, t = timed(lambda: t2listing(filename))
+    table_rows = sum([lst._table[name].num_rows for name in lst._table])
+    total_rows = table_rows * lst.num_fulltimes
+    results['construct'] = {'time': t, 'MB/s': size / t, 'rows/s': total_rows / t}
+    def navigate():
+        lst.first()
+        while lst.next(): pass
+        while lst.prev(): pass
+    ignore, t = timed(navigate)
+    nav_rows = table_rows * (2 * lst.num_fulltimes - 1)
+    results['navigate'] = {'time': t, 'MB/s': 2 * size / t, 'rows/s': nav_rows / t}
+    rows = lst.element.row_name
+    step = max(1, len(rows) / num_history)
+    selection = [('e', blk, lst.element.column_name[0]) for blk in rows[::step][:num_history]]
+    if 'connection' in lst._table:
+        crows = lst.connection.row_name
+        cstep = max(1, len(crows) / num_history)
+        selection += [('c', con, lst.connection.column_name[0]) for con in crows[::cstep][:num_history]]
+    ignore, t = timed(lambda: lst.history(selection))
+    results['history'] = {'time': t, 'MB/s': size / t, 'rows/s': len(selection) * lst.num_fulltimes / t}
+    try:
+        import vtk
+        lst.last()
+        ignore, t = timed(lambda: lst.get_vtk_data(geo))
+        results['get_vtk_data'] = {'time': t, 'rows/s': lst.element.num_rows / t}
+    except ImportError: pass
+    lst.close()
+    return results
+
+def benchmark_history_file(filename):
+    size = os.path.getsize(filename) / 1.e6
+    hist, t = timed(lambda: t2historyfile(filename))
+    return {'time': t, 'MB/s': size / t, 'rows/s': hist.num_rows / t}
+
+def run_benchmarks(directory, num_blocks = 10000, num_times = 5, tables = all_tables, simulators = simulators,
+                   num_history_keys = 100, num_history_times = 1000, repeat = 1):
+    """Generates synthetic files in the specified directory and runs benchmarks on them, returning a
+    dictionary of results.  For each benchmark, the fastest of the specified number of repeats is reported."""
+    geo = benchmark_geometry(num_blocks)
+    results = {}
+    def best(fn):
+        runs = [fn() for i in xrange(repeat)]
+        result = runs[0]
+        for run in runs[1:]:
+            for name in result:
+                if name in run and run[name]['time'] < result[name]['time']: result[name] = run[name]
+        return result
+    for simulator in simulators:
+        filename = listing_filename(directory, simulator)
+        write_listing(filename, simulator, geo, num_times, tables)
+        for name, result in best(lambda: benchmark_listing(filename, geo)).iteritems():
+            results[simulator + ' ' + name] = result
+        if simulator <> 'AUTOUGH2':
+            for history_type in ['FOFT', 'COFT', 'GOFT']:
+                filename = history_filename(directory, simulator, history_type)
+                write_history_file(filename, simulator, geo, history_type, num_history_keys, num_history_times)
+                results[simulator + ' ' + history_type] = best(lambda: {'read': benchmark_history_file(filename)})['read']
+    return results
+
+def report(results, baseline = None, tolerance = 0.2):
+    """Prints table of benchmark results, compared against baseline results if given.  Returns a list of
+    benchmarks which are slower than the baseline by more than the specified fractional tolerance."""
+    regressions = []
+    print '%-28s %10s %10s %14s %10s' % ('Benchmark', 'time (s)', 'MB/s', 'rows/s', 'vs base')
+    for name in sorted(results.keys()):
+        r = results[name]
+        mbs = '%10.2f' % r['MB/s'] if 'MB/s' in r else ' ' * 10
+        comparison = ''
+        if baseline and name in baseline:
+            ratio = r['time'] / baseline[name]['time']
+            comparison = '%9.2fx' % ratio
+            if ratio > 1. + tolerance:
+                comparison += ' SLOWER'
+                regressions.append(name)
+        print '%-28s %10.4f %s %14.0f %s' % (name, r['time'], mbs, r['rows/s'], comparison)
+    return regressions
+
+if __name__ == '__main__':
+    import json, tempfile, shutil
+    from optparse import OptionParser
+    parser = OptionParser(usage = 'usage: %prog [options]')
+    parser.add_option('--blocks', type = 'int', default = 10000, help = 'number of blocks')
+    parser.add_option('--times', type = 'int', default = 5, help = 'number of sets of results in each listing')
+    parser.add_option('--tables', default = ','.join(all_tables), help = 'comma-separated list of tables')
+    parser.add_option('--simulators', default = ','.join(simulators), help = 'comma-separated list of simulators')
+    parser.add_option('--history-keys', type = 'int', default = 100, help = 'number of keys in history files')
+    parser.add_option('--history-times', type = 'int', default = 1000, help = 'number of times in history files')
+    parser.add_option('--repeat', type = 'int', default = 1, help = 'number of repeats of each benchmark')
+    parser.add_option('--baseline', help = 'baseline results file to compare against')
+    parser.add_option('--save-baseline', help = 'file to save results to, as a new baseline')
+    parser.add_option('--tolerance', type = 'float', default = 0.2, help = 'fractional slowdown counted as regression')
+    parser.add_option('--directory', help = 'directory for synthetic files (default is a temporary directory)')
+    options, args = parser.parse_args()
+    directory = options.directory or tempfile.mkdtemp()
+    try:
+        results = run_benchmarks(directory, options.blocks, options.times, options.tables.split(','),
+                                 options.simulators.split(','), options.history_keys, options.history_times,
+                                 options.repeat)
+    finally:
+        if not options.directory: shutil.rmtree(directory)
+    baseline = json.load(open(options.baseline)) if options.baseline else None
+    regressions = report(results, baseline, options.tolerance)
+    if options.save_baseline: json.dump(results, open(options.save_baseline, 'w'), indent = 1, sort_keys = True)
+    if regressions: sys.exit(1)
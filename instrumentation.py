@@ -0,0 +1,149 @@
+"""Optional timing and counting of file reading and writing phases, for diagnosing performance."""
+
+"""
+Copyright 2013 University of Auckland.
+
+This file is part of PyTOUGH.
+
+PyTOUGH is free software: you can redistribute it and/or modify it under the terms of the GNU Lesser General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+PyTOUGH is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with PyTOUGH.  If not, see <http://www.gnu.org/licenses/>."""
+
+from time import time
+from functools import wraps
+
+# Methods of file objects which are counted during a phase.  Values returned by the value
+# methods (lists of parsed values) are counted as values converted.
+value_methods = ['parse_string', 'read_table_line', 'read_table_line_AUTOUGH2', 'read_table_line_TOUGH2']
+
+class phase_stats(object):
+    """Statistics for named phases of reading or writing files: number of calls, wall time, lines and
+    bytes read (or written) and values converted.  Recording is disabled by default.  Callback functions
+    can be added, which are called with the phase name and a dictionary of statistics for that call at
+    the end of each phase."""
+
+    def __init__(self):
+        self.enabled = False
+        self.callbacks = []
+        self.reset()
+
+    def __repr__(self): return self.report()
+
+    def enable(self, enabled = True): self.enabled = enabled
+    def disable(self): self.enabled = False
+
+    def reset(self):
+        """Clears all recorded statistics."""
+        self.phase = {}
+
+    def add_callback(self, fn): self.callbacks.append(fn)
+    def remove_callback(self, fn): self.callbacks.remove(fn)
+
+    def record(self, name, call):
+        """Adds statistics for one call of the named phase."""
+        if name not in self.phase:
+            self.phase[name] = {'calls': 0, 'time': 0., 'lines': 0, 'bytes': 0, 'values': 0}
+        total = self.phase[name]
+        total['calls'] += 1
+        for key, value in call.iteritems(): total[key] += value
+        for fn in self.callbacks: fn(name, call)
+
+    def report(self):
+        """Returns table of recorded statistics as a string."""
+        lines = ['%-32s %6s %10s %10s %12s %12s' % ('Phase', 'calls', 'time (s)', 'lines', 'bytes', 'values')]
+        for name in sorted(self.phase.keys()):
+            p = self.phase[name]
+            lines.append('%-32s %6d %10.4f %10d %12d %12d' % (name, p['calls'], p['time'], p['lines'], p['bytes'],
+                                                              p['values']))
+        return '\n'.join(lines)
+
+stats = phase_stats()
+
+class null_phase(object):
+    """Phase which does nothing, used when statistics are disabled."""
+    def __enter__(self): return self
+    def __exit__(self, *args): return False
+
+_null_phase = null_phase()
+
+class timed_phase(object):
+    """Phase for which statistics are recorded.  If a file object is given, its readline() and write()
+    methods (and any value methods) are temporarily replaced by counting versions for the duration of
+    the phase."""
+
+    def __init__(self, name, fileobj = None):
+        self.name = name
+        self.fileobj = fileobj
+        self.installed = []
+
+    def install_counters(self):
+        f = self.fileobj
+        f._phase_counter = counter = [0, 0, 0]
+        def count_readline(readline):
+            def fn(*args):
+                line = readline(*args)
+                counter[0] += 1
+                counter[1] += len(line)
+                return line
+            return fn
+        def count_write(write):
+            def fn(s):
+                counter[0] += s.count('\n')
+                counter[1] += len(s)
+                return write(s)
+            return fn
+        def count_values(method):
+            def fn(*args, **kwargs):
+                vals = method(*args, **kwargs)
+                counter[2] += len(vals)
+                return vals
+            return fn
+        counted = [('readline', count_readline), ('write', count_write)] + \
+            [(name, count_values) for name in value_methods]
+        for name, wrap in counted:
+            if hasattr(f, name):
+                self.installed.append((name, f.__dict__.get(name)))
+                setattr(f, name, wrap(getattr(f, name)))
+
+    def remove_counters(self):
+        f = self.fileobj
+        for name, original in self.installed:
+            if original is None: delattr(f, name)
+            else: setattr(f, name, original)
+        del f._phase_counter
+
+    def counts(self):
+        if self.fileobj is not None and hasattr(self.fileobj, '_phase_counter'): return list(self.fileobj._phase_counter)
+        else: return [0, 0, 0]
+
+    def __enter__(self):
+        if self.fileobj is not None and not hasattr(self.fileobj, '_phase_counter'): self.install_counters()
+        self.start_counts = self.counts()
+        self.start_time = time()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time() - self.start_time
+        counts = self.counts()
+        if self.installed: self.remove_counters()
+        lines, nbytes, values = [c - c0 for c, c0 in zip(counts, self.start_counts)]
+        stats.record(self.name, {'time': elapsed, 'lines': lines, 'bytes': nbytes, 'values': values})
+        return False
+
+def phase(name, fileobj = None):
+    """Returns context manager for recording statistics of the named phase, optionally counting
+    reading from or writing to the given file object.  If statistics are disabled, this does nothing."""
+    if stats.enabled: return timed_phase(name, fileobj)
+    else: return _null_phase
+
+def instrumented(name):
+    """Decorator for recording statistics of a file object method as the named phase."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            if not stats.enabled: return fn(self, *args, **kwargs)
+            with timed_phase(name, self): return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -14,15 +14,19 @@ You should have received a copy of the GNU Lesser General Public License along w
 from string import ljust, rjust, ascii_lowercase, ascii_uppercase
 from geometry import *
 from fixed_format_file import *
+from instrumentation import phase
+import json
+from collections import OrderedDict, deque
 
 def padstring(string,length=80): return ljust(string,length)
 
 def int_to_chars(i, st = '', chars = ascii_lowercase):
     """Converts a number into a string of characters, using the specified characters."""
-    if i==0: return st
-    else:
-        n = len(chars)
-        return int_to_chars((i-1)/n, ''.join([chars[(i-1)%n],st]), chars)
+    n = len(chars)
+    while i > 0:
+        st = chars[(i-1)%n] + st
+        i = (i-1)/n
+    return st
 
 def new_dict_key(d, istart = 0, justfn = rjust, length = 5, chars = ascii_lowercase):
     """Returns an unused key for dictionary d, using the specified characters, plus the corresponding next starting index."""
@@ -34,8 +38,69 @@ def new_dict_key(d, istart = 0, justfn = rjust, length = 5, chars = ascii_lowerc
         used = name in d
     return name,i
 
+class name_allocator(object):
+    """Allocates unused keys for dictionary d (e.g. node or column names), formed from numbers using the specified
+    characters, justification function and length, as for new_dict_key().  The next free number is tracked, so
+    names are allocated in amortized constant time, rather than by searching from the start each time.  All
+    numbers below the next free number are in use, unless their names are freed (e.g. by deleting nodes or
+    columns), in which case the freed names are reused first, so the names allocated are the same as those
+    given by new_dict_key()."""
+    def __init__(self, d, justfn = rjust, length = 5, chars = ascii_lowercase):
+        self.d = d
+        self.justfn, self.length, self.chars = justfn, length, chars
+        self.char_index = dict([(c,i) for i,c in enumerate(chars)])
+        self.next = 1
+
+    def __repr__(self): return 'name allocator: next ' + repr(self.name(self.next))
+
+    def name(self, i):
+        """Returns name corresponding to number i."""
+        return self.justfn(int_to_chars(i, chars = self.chars), self.length)
+
+    def number(self, name):
+        """Returns number corresponding to a name, or None if the name is not formed by the allocator."""
+        s = name.strip()
+        if s == '' or self.justfn(s, self.length) <> name: return None
+        n, num_chars = 0, len(self.chars)
+        for c in s:
+            if c not in self.char_index: return None
+            n = n * num_chars + self.char_index[c] + 1
+        return n
+
+    def allocate(self, istart = 0):
+        """Returns an unused name, with number greater than istart, plus its number."""
+        i = max(istart, self.next - 1)
+        used = True
+        while used:
+            i += 1
+            name = self.name(i)
+            used = name in self.d
+        if istart < self.next: self.next = i + 1
+        return name, i
+
+    def allocate_batch(self, num, istart = 0):
+        """Returns a list of the specified number of unused names, with numbers greater than istart."""
+        names = []
+        for k in xrange(num):
+            name, istart = self.allocate(istart)
+            names.append(name)
+        return names
+
+    def free(self, name):
+        """Records that a name is no longer used, so it can be allocated again."""
+        i = self.number(name)
+        if i is not None and i < self.next: self.next = i
+
 def uniqstring(s): return ''.join(sorted(set(s), key=s.index))
 
+def file_hash(filename):
+    """Returns SHA-1 hash of the contents of a file, as a hexadecimal string."""
+    from hashlib import sha1
+    h = sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''): h.update(chunk)
+    return h.hexdigest()
+
 def fix_blockname(name):
     """Fixes blanks in 4th column of block names, caused by TOUGH2 treating names as (a3,i2)"""
     if name[2].isdigit() and name[4].isdigit() and name[3]==' ': return '0'.join((name[0:3],name[4:5]))
@@ -53,6 +118,17 @@ def valid_blockname(name):
     letter_digit_space_punct=ascii_letters+digit_space+punctuation
     return all([s in letter_digit_space_punct for s in name[0:3]]) and (name[3] in digit_space) and (name[4] in digits)
 
+# VTK cell types for prisms with given numbers of points:
+vtk_cell_type = {6: 13, 8: 12, 10: 15, 12: 16}
+vtk_convex_point_set = 41
+vtk_unsigned_char = 3
+
+def geometry_changed(obj):
+    """Records that the geometry of a node, column or layer has changed, by incrementing the geometry
+    version of each grid containing it, so that array representations of those grids are rebuilt when
+    next needed."""
+    for version in obj._grid_versions: version[0] += 1
+
 class NamingConventionError(Exception):
     """Used to raise exceptions when grid naming convention is not respected- e.g. when column
     or layer names are too long."""
@@ -116,6 +192,72 @@ class quadtree(object):
         plt.plot(x,y,'.--')
         for child in self.child: child.plot(plt)
 
+class rtree(object):
+    """Packed R-tree of 2D bounding boxes, for spatial searching in 2D grids.  Leaf order is determined by
+    sort-tile-recursive (STR) packing.  The tree is stored as a list of levels (root first), each an array of
+    node bounding boxes of shape (number of nodes, 2, 2); the children of node i in one level are nodes
+    i*node_capacity to (i+1)*node_capacity-1 in the level below.  Elements with undefined (NaN) bounding
+    boxes are never found."""
+    def __init__(self,bounds,node_capacity=16):
+        bounds=np.asarray(bounds,dtype=float).reshape((-1,2,2))
+        self.node_capacity=node_capacity
+        self.index=self.pack(bounds)
+        self.level=[]
+        if len(bounds)>0:
+            self.level.append(bounds[self.index])
+            while len(self.level[-1])>1:
+                b=self.level[-1]
+                start=np.arange(0,len(b),node_capacity)
+                parent=np.empty((len(start),2,2))
+                parent[:,0,:]=np.fmin.reduceat(b[:,0,:],start,axis=0)
+                parent[:,1,:]=np.fmax.reduceat(b[:,1,:],start,axis=0)
+                self.level.append(parent)
+            self.level.reverse()
+    def __repr__(self): return str(self.num_elements)+' elements; '+str(self.num_levels)+' levels'
+    def get_num_elements(self): return len(self.index)
+    num_elements=property(get_num_elements)
+    def get_num_levels(self): return len(self.level)
+    num_levels=property(get_num_levels)
+    def pack(self,bounds):
+        """Returns STR ordering of the bounding boxes: sorted into vertical slices by x-coordinate of their
+        centres, and within each slice by y-coordinate."""
+        n=len(bounds)
+        centre=0.5*(bounds[:,0,:]+bounds[:,1,:])
+        num_leaves=(n+self.node_capacity-1)//self.node_capacity
+        slice_size=max(1,int(np.ceil(np.sqrt(num_leaves))))*self.node_capacity
+        xorder=np.argsort(centre[:,0],kind='mergesort')
+        order=np.lexsort((centre[xorder,1],np.arange(n)//slice_size))
+        return xorder[order]
+    def query_boxes(self,lower,upper):
+        """Returns arrays of query indices and element indices, for each element with bounding box intersecting
+        each of the query boxes with the specified lower (bottom left) and upper (top right) corner arrays."""
+        if not self.level: return np.zeros(0,dtype=int),np.zeros(0,dtype=int)
+        iquery=np.arange(len(lower))
+        inode=np.zeros(len(lower),dtype=int)
+        for ilevel,b in enumerate(self.level):
+            if ilevel>0: # expand to children
+                iquery=np.repeat(iquery,self.node_capacity)
+                inode=(inode[:,np.newaxis]*self.node_capacity+np.arange(self.node_capacity)).ravel()
+                exists=inode<len(b)
+                iquery,inode=iquery[exists],inode[exists]
+            nb=b[inode]
+            with np.errstate(invalid='ignore'):
+                overlap=np.all((nb[:,0,:]<=upper[iquery])&(lower[iquery]<=nb[:,1,:]),axis=1)
+            iquery,inode=iquery[overlap],inode[overlap]
+        return iquery,self.index[inode]
+    def query_points(self,points):
+        """Returns arrays of point indices and element indices, for each element with bounding box containing
+        each of the specified points."""
+        points=np.asarray(points,dtype=float).reshape((-1,2))
+        return self.query_boxes(points,points)
+    def query_point(self,pos):
+        """Returns array of indices of elements with bounding boxes containing the specified point."""
+        return self.query_points(pos)[1]
+    def query_rectangle(self,rect):
+        """Returns array of indices of elements with bounding boxes intersecting the specified rectangle."""
+        lower,upper=[np.asarray(r,dtype=float).reshape((1,2)) for r in rect]
+        return self.query_boxes(lower,upper)[1]
+
 mulgrid_format_specification = {
     'header': [['type','_convention','_atmosphere_type','atmosphere_volume','atmosphere_connection',
                 'unit_type','gdcx','gdcy','cntype','permeability_angle'],
@@ -128,17 +270,27 @@ mulgrid_format_specification = {
     'surface': [['name','elevation'], ['3s','10.2f']],
     'well': [['name','x','y','z'], ['5s']+['10.1f']*3]}
 
+mulgrid_cache_version = 1
+
 class node(object):
     """Grid node class"""
+    _grid_versions = ()
     def __init__(self,name='   ',pos=np.array([0.0,0.0])):
         self.name=name
         if isinstance(pos,(tuple,list)): pos=np.array(pos)
-        self.pos=pos
         self.column=set([])
+        self.pos=pos
     def __repr__(self): return self.name
+    def get_pos(self): return self._pos
+    def set_pos(self,pos):
+        self._pos=pos
+        for col in self.column: col.clear_cache()
+        geometry_changed(self)
+    pos=property(get_pos,set_pos)
 
 class column(object):
     """Grid column class"""
+    _grid_versions = ()
     def __init__(self,name='   ',node=[],centre=None,surface=None):
         self.name=name
         self.node=node
@@ -153,6 +305,7 @@ class column(object):
         self.get_area()
         if self.area<0.: # check node numbering orientation
             self.node.reverse()
+            self.clear_cache()
             self.area=-self.area
         self.neighbour=set([])
         self.connection=set([])
@@ -163,11 +316,35 @@ class column(object):
     def get_num_neighbours(self): return len(self.neighbour)
     num_neighbours=property(get_num_neighbours)
 
+    def get_node(self): return self._node
+    def set_node(self,nodes):
+        self._node=nodes
+        self.clear_cache()
+        geometry_changed(self)
+    node=property(get_node,set_node)
+
+    def clear_cache(self):
+        """Clears cached geometric properties of the column.  This is done automatically when the column
+        nodes or their positions are assigned, or connections to the column are added or deleted."""
+        self._cache={}
+
+    def cached(self,name,calculate):
+        """Returns cached geometric property with the given name, calculating it first if necessary."""
+        if name not in self._cache: self._cache[name]=calculate()
+        return self._cache[name]
+
+    def get_centre(self): return self._centre
+    def set_centre(self,centre):
+        self._centre=centre
+        geometry_changed(self)
+    centre=property(get_centre,set_centre)
+
     def get_surface(self): return self._surface
     def set_surface(self,val):
         self._surface=val
         if val is None: self.default_surface=True
         else: self.default_surface=False
+        geometry_changed(self)
     surface=property(get_surface,set_surface)
 
     def is_against(self,col):
@@ -176,7 +353,7 @@ class column(object):
 
     def get_polygon(self):
         """Returns polygon formed by node positions."""
-        return [node.pos for node in self.node]
+        return list(self.cached('polygon',lambda: [node.pos for node in self.node]))
     polygon=property(get_polygon)
 
     def get_area(self):
@@ -185,26 +362,28 @@ class column(object):
 
     def get_centroid(self):
         """Returns column centroid"""
-        return polygon_centroid(self.polygon)
+        return self.cached('centroid',lambda: polygon_centroid(self.polygon)).copy()
     centroid = property(get_centroid)
 
     def get_bounding_box(self):
         """Returns (horizontal) bounding box of the column."""
-        return bounds_of_points([node.pos for node in self.node])
+        return [p.copy() for p in self.cached('bounding_box',lambda: bounds_of_points(self.polygon))]
     bounding_box=property(get_bounding_box)
 
     def get_neighbourlist(self):
         """Returns a list of neighbouring columns corresponding to each column side (None if
         the column side is on a boundary)."""
-        nbrlist = []
-        for i,nodei in enumerate(self.node):
-            i1 = (i+1)%self.num_nodes
-            nodes = set([nodei,self.node[i1]])
-            con = [cn for cn in self.connection if set(cn.node)==nodes]
-            if con: col = [c for c in con[0].column if c<>self][0]
-            else: col = None
-            nbrlist.append(col)
-        return nbrlist
+        def calculate():
+            nbrlist = []
+            for i,nodei in enumerate(self.node):
+                i1 = (i+1)%self.num_nodes
+                nodes = set([nodei,self.node[i1]])
+                con = [cn for cn in self.connection if set(cn.node)==nodes]
+                if con: col = [c for c in con[0].column if c<>self][0]
+                else: col = None
+                nbrlist.append(col)
+            return nbrlist
+        return list(self.cached('neighbourlist',calculate))
     neighbourlist=property(get_neighbourlist)
 
     def near_point(self,pos):
@@ -222,14 +401,15 @@ class column(object):
 
     def get_exterior_angles(self):
         """Returns list of exterior angle for each node in the column."""
-        side=[self.node[i].pos-self.node[i-1].pos for i in xrange(self.num_nodes)]
-        h=[vector_heading(s) for s in side]
-        angles=[np.pi-(h[(i+1)%self.num_nodes]-h[i]) for i in xrange(self.num_nodes)]
-        angles=[a%(2*np.pi) for a in angles]
-        return angles
+        def calculate():
+            side=[self.node[i].pos-self.node[i-1].pos for i in xrange(self.num_nodes)]
+            h=[vector_heading(s) for s in side]
+            angles=[np.pi-(h[(i+1)%self.num_nodes]-h[i]) for i in xrange(self.num_nodes)]
+            return [a%(2*np.pi) for a in angles]
+        return list(self.cached('exterior_angles',calculate))
     exterior_angles=property(get_exterior_angles)
     def get_interior_angles(self):
-        return [2.*np.pi-a for a in self.exterior_angles]
+        return list(self.cached('interior_angles',lambda: [2.*np.pi-a for a in self.exterior_angles]))
     interior_angles=property(get_interior_angles)
 
     def get_angle_ratio(self):
@@ -241,7 +421,8 @@ class column(object):
 
     def get_side_lengths(self):
         "Returns list of side lengths for the column"
-        return np.array([norm(self.node[(i+1)%self.num_nodes].pos-self.node[i].pos) for i in xrange(self.num_nodes)])
+        return self.cached('side_lengths',lambda: np.array([norm(self.node[(i+1)%self.num_nodes].pos-self.node[i].pos)
+                                                           for i in xrange(self.num_nodes)])).copy()
     side_lengths=property(get_side_lengths)
         
     def get_side_ratio(self):
@@ -376,12 +557,28 @@ class connection(object):
 
 class layer(object):
     """Grid layer class"""
+    _grid_versions = ()
     def __init__(self,name='  ',bottom=0.0,centre=0.0,top=0.0):
         self.name=name
         self.bottom=bottom
         self.centre=centre
         self.top=top
     def __repr__(self): return self.name+'('+str(self.bottom)+':'+str(self.top)+')'
+    def get_bottom(self): return self._bottom
+    def set_bottom(self,bottom):
+        self._bottom=bottom
+        geometry_changed(self)
+    bottom=property(get_bottom,set_bottom)
+    def get_centre(self): return self._centre
+    def set_centre(self,centre):
+        self._centre=centre
+        geometry_changed(self)
+    centre=property(get_centre,set_centre)
+    def get_top(self): return self._top
+    def set_top(self,top):
+        self._top=top
+        geometry_changed(self)
+    top=property(get_top,set_top)
     def contains_elevation(self,z): return self.bottom<=z<=self.top
     def translate(self,shift):
         """Translates a layer up or down by specified distance"""
@@ -450,11 +647,981 @@ class well(object):
         if elevation: return self.elevation_pos(elevation)
         else: return None
 
+class plot_scene(object):
+    """Precomputed geometry of a layer or slice plot of a grid: the vertices of the plot polygons, and the indices
+    of the blocks (and columns) they represent.  A scene can be drawn once and then updated with new values of a
+    variable, which only changes the face colours of the polygons (e.g. for animating results at different
+    times).  Frames can also be rendered to image files, optionally in parallel worker processes."""
+    def __init__(self, verts, blocks, columns, num_blocks, num_columns, title = '', xlabel = 'x (m)',
+                 ylabel = 'y (m)', aspect = 'equal'):
+        self.verts = verts
+        self.blocks = np.array(blocks, dtype = int)
+        self.columns = np.array(columns, dtype = int)
+        self.num_blocks, self.num_columns = num_blocks, num_columns
+        self.title, self.xlabel, self.ylabel, self.aspect = title, xlabel, ylabel, aspect
+        self.collection, self.title_text = None, None
+
+    def __repr__(self): return self.title + ': ' + str(self.num_polygons) + ' polygons'
+
+    def __getstate__(self):
+        """Drawn matplotlib objects are not pickled (e.g. when sending scenes to worker processes)."""
+        state = self.__dict__.copy()
+        state['collection'], state['title_text'] = None, None
+        return state
+
+    def get_num_polygons(self): return len(self.blocks)
+    num_polygons = property(get_num_polygons)
+
+    def values(self, variable):
+        """Returns values of a variable (an array of values for each block, or for each column) for each
+        polygon in the scene."""
+        variable = np.asarray(variable)
+        if len(variable) == self.num_columns and self.num_columns != self.num_blocks: return variable[self.columns]
+        else: return variable[self.blocks]
+
+    def draw(self, variable = None, variable_name = None, unit = None, plt = None, subplot = 111, ax = None,
+             colourmap = None, linewidth = 0.2, linecolour = 'black', colourbar_limits = None, title = None):
+        """Draws the scene, shaded by the specified variable (if given), on the specified axes (or a new
+        subplot), and returns the polygon collection."""
+        if ax is None:
+            if plt is None: import matplotlib.pyplot as plt
+            ax = plt.subplot(subplot, aspect = self.aspect)
+        import matplotlib.collections as collections
+        if variable is not None: facecolors = None
+        else: facecolors = []
+        self.collection = collections.PolyCollection(self.verts, cmap = colourmap, linewidth = linewidth,
+                                                     facecolors = facecolors, edgecolors = linecolour)
+        if variable is not None: self.collection.set_array(self.values(variable))
+        if colourbar_limits is not None: self.collection.set_clim(*tuple(colourbar_limits))
+        ax.add_collection(self.collection)
+        ax.autoscale_view()
+        ax.set_xlabel(self.xlabel)
+        ax.set_ylabel(self.ylabel)
+        default_title = self.title
+        if variable is not None:
+            if variable_name: varname = variable_name
+            else: varname = 'Value'
+            scalelabel = varname
+            if unit: scalelabel += ' ('+unit+')'
+            cbar = ax.figure.colorbar(self.collection, ax = ax)
+            cbar.set_label(scalelabel)
+            default_title = varname + ' in ' + default_title
+        if title is None: title = default_title
+        self.title_text = ax.set_title(title)
+        return self.collection
+
+    def update(self, variable, title = None):
+        """Updates the face colours of a drawn scene with new values of the variable, and optionally
+        the title."""
+        if self.collection is None: raise Exception('Plot scene has not been drawn.')
+        self.collection.set_array(self.values(variable))
+        if title is not None: self.title_text.set_text(title)
+
+    def render(self, variables, filenames, titles = None, processes = 1, figsize = (12,9), dpi = None,
+               colourbar_limits = None, **kwargs):
+        """Renders a frame to an image file for each of a list of variables (or rows of a two-dimensional array,
+        e.g. a history of block values), with the corresponding file names and (optionally) titles.  Frames are
+        divided between the specified number of worker processes (if greater than 1).  Unless colour bar limits are
+        specified, the limits are taken from the range of values over all frames.  Other keyword arguments are
+        passed to the draw() method."""
+        num_frames = len(filenames)
+        if titles is None: titles = [None] * num_frames
+        if colourbar_limits is None and num_frames > 0:
+            vals = [self.values(variable) for variable in variables]
+            colourbar_limits = (min([np.min(v) for v in vals]), max([np.max(v) for v in vals]))
+        kwargs['colourbar_limits'] = colourbar_limits
+        processes = max(min(processes, num_frames), 1)
+        chunks = [range(i, num_frames, processes) for i in xrange(processes)]
+        jobs = [(self, [variables[i] for i in chunk], [filenames[i] for i in chunk], [titles[i] for i in chunk],
+                 figsize, dpi, kwargs) for chunk in chunks]
+        if processes == 1: render_plot_scene_frames(jobs[0])
+        else:
+            from multiprocessing import Pool
+            pool = Pool(processes)
+            try: pool.map(render_plot_scene_frames, jobs)
+            finally:
+                pool.close()
+                pool.join()
+
+def render_plot_scene_frames(job):
+    """Renders frames of a plot scene to image files, drawing the scene once and then updating it for each
+    frame.  The job is a tuple of (scene, variables, filenames, titles, figsize, dpi, draw options).  This is a
+    module-level function so that it can be run in worker processes."""
+    scene, variables, filenames, titles, figsize, dpi, options = job
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize = figsize)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111, aspect = scene.aspect)
+    for i, (variable, filename, title) in enumerate(zip(variables, filenames, titles)):
+        if i == 0: scene.draw(variable, ax = ax, title = title, **options)
+        else: scene.update(variable, title)
+        fig.savefig(filename, dpi = dpi)
+
+class mulgrid_arrays(object):
+    """Array representation of mulgrid geometry: node positions, column node connectivity in compressed sparse
+    row (CSR) form, column and node indices of connections, and layer elevations.  Quantities derived from these
+    (e.g. column areas, centroids and bounds) are calculated with vectorized operations when first needed."""
+    def __init__(self,geo,state=None):
+        self.state=state
+        node_index=dict([(id(n),i) for i,n in enumerate(geo.nodelist)])
+        column_index=dict([(id(col),i) for i,col in enumerate(geo.columnlist)])
+        self.node_pos=np.array([n.pos for n in geo.nodelist],dtype=float).reshape((-1,2))
+        self.column_num_nodes=np.array([col.num_nodes for col in geo.columnlist],dtype=int)
+        self.column_node_indptr=np.concatenate(([0],np.cumsum(self.column_num_nodes))).astype(int)
+        self.column_node_indices=np.array([node_index.get(id(n),-1) for col in geo.columnlist for n in col.node],
+                                          dtype=int)
+        self.column_centre=np.array([[np.nan,np.nan] if col.centre is None else col.centre
+                                     for col in geo.columnlist],dtype=float).reshape((-1,2))
+        self.column_surface=np.array([np.nan if col.surface is None else col.surface for col in geo.columnlist],
+                                     dtype=float)
+        self.connection_columns=np.array([[column_index.get(id(c),-1) for c in con.column]
+                                          for con in geo.connectionlist],dtype=int).reshape((-1,2))
+        self.connection_nodes=np.array([[node_index.get(id(n),-1) for n in con.node] if con.node else [-1,-1]
+                                        for con in geo.connectionlist],dtype=int).reshape((-1,2))
+        self.layer_bottom=np.array([lay.bottom for lay in geo.layerlist],dtype=float)
+        self.layer_centre=np.array([lay.centre for lay in geo.layerlist],dtype=float)
+        self.layer_top=np.array([lay.top for lay in geo.layerlist],dtype=float)
+        self._derived={}
+        self.block_tracks=OrderedDict()
+
+    def __repr__(self):
+        return str(len(self.node_pos))+' nodes; '+str(len(self.column_num_nodes))+' columns; '+ \
+            str(len(self.connection_columns))+' connections; '+str(len(self.layer_bottom))+' layers'
+
+    def derived(self,name,calculate):
+        """Returns derived array with the given name, calculating it first if necessary."""
+        if name not in self._derived: self._derived[name]=calculate()
+        return self._derived[name]
+
+    def block_track(self,key,calculate,max_tracks=256):
+        """Returns block track with the given key, calculating it first if necessary.  Up to max_tracks tracks
+        are cached, the least recently used being discarded first."""
+        if key in self.block_tracks: track=self.block_tracks.pop(key)
+        else: track=calculate()
+        self.block_tracks[key]=track
+        while len(self.block_tracks)>max_tracks: self.block_tracks.popitem(last=False)
+        return track
+
+    def get_num_columns(self): return len(self.column_num_nodes)
+    num_columns=property(get_num_columns)
+
+    def get_column_node_column(self):
+        """Returns column index for each entry in the column_node_indices array."""
+        return self.derived('column_node_column',
+                            lambda: np.repeat(np.arange(self.num_columns),self.column_num_nodes))
+    column_node_column=property(get_column_node_column)
+
+    def get_column_node_next(self):
+        """Returns index (in the column_node_indices array) of the next node around the column, for each entry."""
+        def calculate():
+            nxt=np.arange(1,len(self.column_node_indices)+1)
+            nonempty=self.column_num_nodes>0
+            nxt[self.column_node_indptr[1:][nonempty]-1]=self.column_node_indptr[:-1][nonempty]
+            return nxt
+        return self.derived('column_node_next',calculate)
+    column_node_next=property(get_column_node_next)
+
+    def get_column_node_pos(self):
+        """Returns node positions for each entry in the column_node_indices array."""
+        return self.derived('column_node_pos',lambda: self.node_pos[self.column_node_indices])
+    column_node_pos=property(get_column_node_pos)
+
+    def column_sum(self,values):
+        """Sums values given for each entry in the column_node_indices array over each column."""
+        return np.bincount(self.column_node_column,weights=values,minlength=self.num_columns)
+
+    def shoelace_terms(self):
+        """Returns node positions shifted relative to the first node of each column (to reduce roundoff),
+        positions of the next nodes around the columns, and the corresponding polygon area terms."""
+        def calculate():
+            p=self.column_node_pos
+            p=p-p[self.column_node_indptr[:-1]][self.column_node_column]
+            q=p[self.column_node_next]
+            return p,q,p[:,0]*q[:,1]-q[:,0]*p[:,1]
+        return self.derived('shoelace_terms',calculate)
+
+    def get_column_area(self):
+        """Returns array of column areas."""
+        def calculate():
+            p,q,t=self.shoelace_terms()
+            return np.abs(0.5*self.column_sum(t))
+        return self.derived('column_area',calculate)
+    column_area=property(get_column_area)
+
+    def get_column_centroid(self):
+        """Returns array of column centroids."""
+        def calculate():
+            p,q,t=self.shoelace_terms()
+            a=self.column_sum(t)
+            n=np.maximum(self.column_num_nodes,1)
+            c=np.zeros((self.num_columns,2))
+            for i in xrange(2):
+                mean=self.column_sum(p[:,i])/n
+                with np.errstate(divide='ignore',invalid='ignore'):
+                    c[:,i]=np.where((self.column_num_nodes<3)|(a==0.),mean,self.column_sum((p[:,i]+q[:,i])*t)/(3.*a))
+            shift=self.column_node_pos[np.minimum(self.column_node_indptr[:-1],len(self.column_node_pos)-1)]
+            return c+shift
+        return self.derived('column_centroid',calculate)
+    column_centroid=property(get_column_centroid)
+
+    def get_column_bounds(self):
+        """Returns array of horizontal column bounding boxes, of shape (number of columns, 2, 2), each
+        containing bottom left and top right corners."""
+        def calculate():
+            b=np.nan*np.ones((self.num_columns,2,2))
+            nonempty=self.column_num_nodes>0
+            if np.any(nonempty):
+                start=self.column_node_indptr[:-1][nonempty]
+                b[nonempty,0,:]=np.minimum.reduceat(self.column_node_pos,start,axis=0)
+                b[nonempty,1,:]=np.maximum.reduceat(self.column_node_pos,start,axis=0)
+            return b
+        return self.derived('column_bounds',calculate)
+    column_bounds=property(get_column_bounds)
+
+    def get_column_side_lengths(self):
+        """Returns array of column side lengths, for each entry in the column_node_indices array."""
+        def calculate():
+            p,q,t=self.shoelace_terms()
+            return np.sqrt(np.sum((q-p)**2,axis=1))
+        return self.derived('column_side_lengths',calculate)
+    column_side_lengths=property(get_column_side_lengths)
+
+    def get_column_side_ratio(self):
+        """Returns array of column side ratios (ratio of largest to smallest side length)."""
+        def calculate():
+            r=np.nan*np.ones(self.num_columns)
+            nonempty=self.column_num_nodes>0
+            if np.any(nonempty):
+                start=self.column_node_indptr[:-1][nonempty]
+                l=self.column_side_lengths
+                r[nonempty]=np.maximum.reduceat(l,start)/np.minimum.reduceat(l,start)
+            return r
+        return self.derived('column_side_ratio',calculate)
+    column_side_ratio=property(get_column_side_ratio)
+
+    def get_bounds(self):
+        """Returns horizontal bounding box of the nodes."""
+        return [np.min(self.node_pos,axis=0),np.max(self.node_pos,axis=0)]
+    bounds=property(get_bounds)
+
+    def get_column_side_neighbour(self):
+        """Returns half-edge table of column side neighbours: for each entry in the column_node_indices array
+        (representing the column side from that node to the next node around the column), the index of the
+        neighbouring column across that side, or -1 if the side is not on a connection."""
+        def calculate():
+            nn=len(self.node_pos)
+            a=self.column_node_indices.astype(np.int64)
+            b=a[self.column_node_next]
+            side_key=(self.column_node_column*nn+np.minimum(a,b))*nn+np.maximum(a,b)
+            valid=np.all(self.connection_nodes>=0,axis=1)&np.all(self.connection_columns>=0,axis=1)
+            cols,nodes=self.connection_columns[valid].astype(np.int64),self.connection_nodes[valid]
+            lo,hi=np.min(nodes,axis=1),np.max(nodes,axis=1)
+            con_key=np.concatenate(((cols[:,0]*nn+lo)*nn+hi,(cols[:,1]*nn+lo)*nn+hi))
+            con_neighbour=np.concatenate((cols[:,1],cols[:,0]))
+            nbr=-np.ones(len(side_key),dtype=int)
+            if len(con_key)>0:
+                order=np.argsort(con_key,kind='mergesort')
+                con_key,con_neighbour=con_key[order],con_neighbour[order]
+                i=np.minimum(np.searchsorted(con_key,side_key),len(con_key)-1)
+                found=con_key[i]==side_key
+                nbr[found]=con_neighbour[i[found]]
+            return nbr
+        return self.derived('column_side_neighbour',calculate)
+    column_side_neighbour=property(get_column_side_neighbour)
+
+    def column_furthest_intersection(self,colindex,line):
+        """Returns the furthest intersection point (from the start of the line) between the specified line and
+        the sides of the column with the given index, together with the index of the intersected side around the
+        column, or (None, None) if there is no intersection.  As for the line_polygon_intersections() function
+        (with bound_line = (True, False)), the line is bounded at its start but not at its end."""
+        # polygons are small, so plain float arithmetic is faster than array operations here:
+        indptr,pos=self.derived('column_node_pos_list',lambda: (self.column_node_indptr.tolist(),
+                                                                self.column_node_pos.tolist()))
+        i0,i1=indptr[colindex],indptr[colindex+1]
+        if i1==i0: return None,None
+        tol=1.e-12
+        x0,y0=pos[i0]
+        l1x,l1y=line[0][0]-x0,line[0][1]-y0
+        ex,ey=l1x-(line[1][0]-x0),l1y-(line[1][1]-y0)
+        furthest,dmax=None,-1.
+        for i in xrange(i0,i1):
+            p1x,p1y=pos[i][0]-x0,pos[i][1]-y0
+            p2=pos[i+1] if i+1<i1 else pos[i0]
+            dx,dy=p2[0]-x0-p1x,p2[1]-y0-p1y
+            det=dx*ey-ex*dy
+            if det==0.: continue
+            bx,by=l1x-p1x,l1y-p1y
+            xi0=(bx*ey-ex*by)/det
+            xi1=(dx*by-bx*dy)/det
+            if -tol<=xi0<=1.+tol and -tol<=xi1:
+                pt=(x0+p1x+xi0*dx,y0+p1y+xi0*dy)
+                d=(pt[0]-line[0][0])**2+(pt[1]-line[0][1])**2
+                if d>=dmax: furthest,dmax=(pt,i-i0),d # last side with furthest point
+        if furthest is None: return None,None
+        else: return np.array(furthest[0]),furthest[1]
+
+    def get_column_centre_kdtree(self):
+        """Returns kd-tree of column centres."""
+        def calculate():
+            from scipy.spatial import cKDTree
+            return cKDTree(self.column_centre)
+        return self.derived('column_centre_kdtree',calculate)
+    column_centre_kdtree=property(get_column_centre_kdtree)
+
+    def get_layer_column_block(self):
+        """Returns integer array of shape (number of layers - 1, number of columns), giving for each column and
+        (non-atmosphere) layer the index of the corresponding block amongst the underground blocks of the grid,
+        or -1 if the column surface is not above the layer bottom."""
+        def calculate():
+            present=self.column_surface[np.newaxis,:]>self.layer_bottom[1:,np.newaxis]
+            block=np.cumsum(present.ravel(),dtype=np.int32).reshape(present.shape)-1
+            block[~present]=-1
+            return block
+        return self.derived('layer_column_block',calculate)
+    layer_column_block=property(get_layer_column_block)
+
+    def get_mesh3d(self):
+        """Returns 3D mesh of the grid as a dictionary of arrays: 'points' (3D point coordinates),
+        'connectivity' (point indices of the cells, with bottom nodes followed by top nodes), 'offsets'
+        (start of each cell in the connectivity array, with the total length appended), 'cell_types' (VTK
+        cell types), 'cell_layer' and 'cell_column' (layer and column indices of the cells).  Points are
+        identified by 'point_layer', 'point_node' and 'point_column' arrays: subsurface points lie at the
+        layer bottoms and surface points (with layer index zero) at the column surface elevations, and
+        'point_column' is -1 unless a separate surface point is needed for each column at that node
+        (because of varying column surface elevations).  Cells are ordered by layer and then column, as
+        for the underground blocks of the grid."""
+        def calculate():
+            num_nodes,num_columns=len(self.node_pos),self.num_columns
+            surface=np.where(np.isnan(self.column_surface),self.layer_bottom[0],self.column_surface)
+            node,col=self.column_node_indices,self.column_node_column
+            entry_surface=surface[col]
+            node_max=-np.inf*np.ones(num_nodes)
+            node_min=np.inf*np.ones(num_nodes)
+            np.maximum.at(node_max,node,entry_surface)
+            np.minimum.at(node_min,node,entry_surface)
+            # subsurface points:
+            bottom=self.layer_bottom[1:]
+            node_present=node_max[np.newaxis,:]>bottom[:,np.newaxis]
+            sub_index=np.cumsum(node_present.ravel()).reshape(node_present.shape)-1
+            sub_layer,sub_node=np.nonzero(node_present)
+            # surface points, with extra points at nodes where column surface elevations differ:
+            extra=node_max[node]<>node_min[node]
+            key=node.astype(np.int64)*(num_columns+1)+np.where(extra,col+1,0)
+            key,first,surf_index=np.unique(key,return_index=True,return_inverse=True)
+            num_sub=len(sub_node)
+            surf_index+=num_sub
+            points=np.empty((num_sub+len(key),3))
+            points[:num_sub,:2]=self.node_pos[sub_node]
+            points[:num_sub,2]=bottom[sub_layer]
+            points[num_sub:,:2]=self.node_pos[node[first]]
+            points[num_sub:,2]=entry_surface[first]
+            point_layer=np.concatenate((sub_layer+1,np.zeros(len(key),dtype=int)))
+            point_node=np.concatenate((sub_node,node[first]))
+            point_column=np.concatenate((-np.ones(num_sub,dtype=int),np.where(extra[first],col[first],-1)))
+            # cells:
+            present=surface[np.newaxis,:]>bottom[:,np.newaxis]
+            top=present.copy()
+            top[1:]&=~present[:-1]
+            cell_layer,cell_column=np.nonzero(present)
+            cell_top=top[cell_layer,cell_column]
+            n=self.column_num_nodes[cell_column]
+            offsets=np.concatenate(([0],np.cumsum(2*n)))
+            cell=np.repeat(np.arange(len(n)),n)
+            j=np.arange(len(cell))-np.repeat(np.cumsum(n)-n,n)
+            entry=self.column_node_indptr[cell_column][cell]+j
+            lay,entry_node=cell_layer[cell],node[entry]
+            connectivity=np.empty(offsets[-1],dtype=int)
+            connectivity[offsets[cell]+j]=sub_index[lay,entry_node]
+            connectivity[offsets[cell]+n[cell]+j]=np.where(cell_top[cell],surf_index[entry],
+                                                           sub_index[np.maximum(lay-1,0),entry_node])
+            cell_types=np.array([vtk_cell_type.get(2*k,vtk_convex_point_set) for k in xrange(np.max(n)+1)]
+                                if len(n)>0 else [],dtype=np.uint8)[n]
+            return {'points':points,'connectivity':connectivity,'offsets':offsets,'cell_types':cell_types,
+                    'cell_layer':cell_layer+1,'cell_column':cell_column,'point_layer':point_layer,
+                    'point_node':point_node,'point_column':point_column}
+        return self.derived('mesh3d',calculate)
+    mesh3d=property(get_mesh3d)
+
+    def get_column_rtree(self):
+        """Returns packed R-tree of column bounding boxes."""
+        return self.derived('column_rtree',lambda: rtree(self.column_bounds))
+    column_rtree=property(get_column_rtree)
+
+    def columns_contain_points(self,points,colindices):
+        """Tests whether each of an array of 2D points lies inside the column with corresponding index in
+        the colindices array, using the same crossing-number test as the in_polygon() function, vectorized
+        over all point and column side pairs.  Returns a Boolean array."""
+        n=self.column_num_nodes[colindices]
+        num_pairs=len(colindices)
+        if num_pairs==0: return np.zeros(0,dtype=bool)
+        pair=np.repeat(np.arange(num_pairs),n)
+        start=self.column_node_indptr[colindices]
+        offset=np.arange(len(pair))-np.repeat(np.cumsum(n)-n,n)
+        side=np.repeat(start,n)+offset
+        pos=self.column_node_pos
+        ref=pos[start][pair]
+        v=points[pair]-ref
+        p1=pos[side]-ref
+        p2=pos[self.column_node_next[side]]-ref
+        d=p2-p1
+        tolerance=1.e-6
+        cross=((p1[:,1]<=v[:,1])&(v[:,1]<p2[:,1]))|((p2[:,1]<=v[:,1])&(v[:,1]<p1[:,1]))
+        cross&=np.abs(d[:,1])>tolerance
+        with np.errstate(divide='ignore',invalid='ignore'):
+            x=p1[:,0]+(v[:,1]-p1[:,1])*d[:,0]/d[:,1]
+        cross&=v[:,0]<x
+        numcrossings=np.bincount(pair,weights=cross,minlength=num_pairs).astype(int)
+        return numcrossings%2==1
+
+    def columns_near_points(self,points,colindices):
+        """Tests whether each of an array of 2D points lies inside the bounding box of the column with
+        corresponding index in the colindices array.  Returns a Boolean array."""
+        b=self.column_bounds[colindices]
+        return np.all((b[:,0,:]<=points)&(points<=b[:,1,:]),axis=1)
+
+    def get_column_node_table(self):
+        """Returns array of node indices for each column, with a row for each column, padded with -1 for columns
+        with fewer nodes than the maximum (and at least four columns)."""
+        def calculate():
+            width=max([4]+list(self.column_num_nodes))
+            table=-np.ones((self.num_columns,width),dtype=int)
+            offset=np.arange(len(self.column_node_indices))-self.column_node_indptr[self.column_node_column]
+            table[self.column_node_column,offset]=self.column_node_indices
+            return table
+        return self.derived('column_node_table',calculate)
+    column_node_table=property(get_column_node_table)
+
+    def column_local_basis(self,points,colindices,tolerance=1.e-8,max_iterations=15):
+        """Finds local coordinates of each of an array of 2D points in the 3 or 4-sided column with corresponding
+        index in the colindices array, using Newton iteration vectorized over all points (as in the column
+        local_pos() method), and returns the finite element basis functions at those coordinates (as given
+        by the column basis() method), in an array with four values for each point (the last being zero for
+        triangular columns).  Also returned is a Boolean array indicating which points were found inside
+        their columns."""
+        num_points=len(colindices)
+        n=self.column_num_nodes[colindices]
+        nodes=self.column_node_table[colindices,:4]
+        p=self.node_pos[np.maximum(nodes,0)]
+        p[n==3,3]=0.
+        tri=n==3
+        xi=np.zeros((num_points,2))
+        xi[tri]=1/3.
+        def basis(xi,tri):
+            a0,a1,b0,b1=1.-xi[:,0],1.+xi[:,0],1.-xi[:,1],1.+xi[:,1]
+            psi=0.25*np.array([a0*b0,a1*b0,a1*b1,a0*b1]).T
+            psi[tri]=np.array([xi[tri,0],xi[tri,1],1.-xi[tri,0]-xi[tri,1],np.zeros(np.count_nonzero(tri))]).T
+            return psi
+        def basis_derivatives(xi,tri):
+            a0,a1,b0,b1=1.-xi[:,0],1.+xi[:,0],1.-xi[:,1],1.+xi[:,1]
+            dpsi=0.25*np.array([[-b0,-a0],[b0,-a1],[b1,a1],[-b1,a0]]).transpose((2,0,1))
+            dpsi[tri]=np.array([[1.,0.],[0.,1.],[-1.,-1.],[0.,0.]])
+            return dpsi
+        active=(n==3)|(n==4)
+        found=np.zeros(num_points,dtype=bool)
+        for iteration in xrange(max_iterations): # Newton iteration
+            i=np.nonzero(active)[0]
+            if len(i)==0: break
+            dx=np.sum(basis(xi[i],tri[i])[:,:,np.newaxis]*p[i],axis=1)-points[i]
+            converged=np.sqrt(np.sum(dx**2,axis=1))<=tolerance
+            found[i[converged]]=True
+            active[i[converged]]=False
+            i,dx=i[~converged],dx[~converged]
+            J=np.einsum('pki,pkj->pij',p[i],basis_derivatives(xi[i],tri[i]))
+            det=J[:,0,0]*J[:,1,1]-J[:,0,1]*J[:,1,0]
+            singular=det==0.
+            active[i[singular]]=False
+            i,dx,J,det=i[~singular],dx[~singular],J[~singular],det[~singular]
+            xi[i,0]-=(J[:,1,1]*dx[:,0]-J[:,0,1]*dx[:,1])/det
+            xi[i,1]-=(J[:,0,0]*dx[:,1]-J[:,1,0]*dx[:,0])/det
+        inside=np.where(tri,np.all(xi>=0.,axis=1)&(np.sum(xi,axis=1)<=1.),np.all(np.abs(xi)<=1.,axis=1))
+        return basis(xi,tri),found&inside
+
+class column_fitter(object):
+    """Least-squares bilinear finite element fitting of scattered data to the column centres of a geometry, with
+    Sobolev smoothing (see the mulgrid fit_columns() method).  The decomposition of the columns into 3 and
+    4-sided columns, the node indexing and the smoothing matrix are set up once, when the fitter is created.  The
+    locations of data points in the columns, and the factorization of the fitting matrix, are cached for the most
+    recently fitted sets of data point positions (up to max_point_sets of them), so that fitting several data sets
+    is efficient, particularly if they share the same point positions."""
+    def __init__(self, geo, columns = [], alpha = 0.1, beta = 0.1, max_point_sets = 1):
+        from scipy import sparse
+        if columns == []: columns = geo.columnlist
+        else:
+            if isinstance(columns[0],str): columns = [geo.column[col] for col in columns]
+        self.columns = columns
+        self.alpha, self.beta = alpha, beta
+
+        # make copy of geometry and decompose into 3,4 sided columns:
+        dgeo = mulgrid(convention = geo.convention)
+        for n in geo.nodelist: dgeo.add_node(node(n.name, n.pos))
+        for col in geo.columnlist:
+            dgeo.add_column(column(col.name, [dgeo.node[n.name] for n in col.node]))
+        self.colmap = dgeo.decompose_columns(columns, mapping = True, chars = ascii_lowercase + ascii_uppercase)
+        self.geo = dgeo
+        arrays = dgeo.arrays
+        geo_column_index = dict([(col.name,i) for i,col in enumerate(dgeo.columnlist)])
+        fit_columns = np.array([geo_column_index[geocolname] for col in columns for geocolname in
+                                self.colmap[col.name]], dtype = int)
+        self.is_fit_column = np.zeros(dgeo.num_columns, dtype = bool)
+        self.is_fit_column[fit_columns] = True
+        node_table = arrays.column_node_table[:,:4]
+        fit_nodes = np.unique(node_table[fit_columns])
+        fit_nodes = fit_nodes[fit_nodes >= 0]
+        self.num_nodes = len(fit_nodes)
+        node_index = -np.ones(dgeo.num_nodes + 1, dtype = int) # (last entry for padding in node table)
+        node_index[fit_nodes] = np.arange(self.num_nodes)
+        self.column_nodes = node_index[node_table]
+
+        # smoothing matrix:
+        smooth = {3: 0.5 * alpha * np.array([[1.,0.,-1.],
+                                             [0.,1.,-1.],
+                                             [-1.,-1.,2.]]),
+                  4: alpha / 6. * np.array([[4.,-1.,-2.,-1.],
+                                            [-1.,4.,-1.,-2.],
+                                            [-2.,-1.,4.,-1.],
+                                            [-1.,-2.,-1.,4.]]) + \
+                      beta * np.array([[1.,-1.,1.,-1.],
+                                       [-1.,1.,-1.,1.],
+                                       [1.,-1.,1.,-1.],
+                                       [-1.,1.,-1.,1.]])}
+        column_smooth = np.zeros((len(fit_columns), 4, 4))
+        for num_nodes in [3, 4]:
+            column_smooth[arrays.column_num_nodes[fit_columns] == num_nodes,
+                          :num_nodes, :num_nodes] = smooth[num_nodes]
+        nodes = self.column_nodes[fit_columns]
+        I, J = np.repeat(nodes, 4, axis = 1), np.tile(nodes, (1,4))
+        vals = column_smooth.reshape((len(fit_columns), 16))
+        used = (I >= 0) & (J >= 0)
+        self.smoothing = sparse.coo_matrix((vals[used], (I[used], J[used])),
+                                           shape = (self.num_nodes, self.num_nodes)).tocsr()
+
+        # operators for calculating column values from fitted nodal values:
+        i = np.arange(len(fit_columns))
+        geo_area = arrays.column_area[fit_columns]
+        column_start = np.cumsum([0] + [len(self.colmap[col.name]) for col in columns])
+        column_area = np.add.reduceat(geo_area, column_start[:-1]) if len(fit_columns) > 0 else np.zeros(0)
+        geo_parent = np.repeat(np.arange(len(columns)), np.diff(column_start))
+        weight = np.repeat(geo_area / column_area[geo_parent] / arrays.column_num_nodes[fit_columns], 4)
+        used = nodes.ravel() >= 0
+        self.mean_operator = sparse.coo_matrix((weight[used], (np.repeat(geo_parent, 4)[used],
+                                                               nodes.ravel()[used])),
+                                               shape = (len(columns), self.num_nodes)).tocsr()
+        self.column_node_lists = [np.unique(nodes[start: end][nodes[start: end] >= 0])
+                                  for start, end in zip(column_start[:-1], column_start[1:])]
+        self.column_index = dict([(col.name,i) for i,col in enumerate(columns)])
+        self.max_point_sets = max_point_sets
+        self._point_sets = OrderedDict()
+
+    def __repr__(self):
+        return 'column fitter: ' + str(len(self.columns)) + ' columns; ' + str(self.num_nodes) + ' nodes; ' + \
+            str(len(self._point_sets)) + ' cached point sets'
+
+    def clear(self):
+        """Clears cached point locations and matrix factorizations."""
+        self._point_sets = OrderedDict()
+
+    def basis_matrix(self, points, silent = False, chunk_size = 100000):
+        """Returns a sparse matrix of the finite element basis functions at the specified 2D points, with a row for
+        each fitting node and a column for each point (empty for points outside the fitted columns).  Points are
+        located in the columns in chunks of the specified size."""
+        from scipy import sparse
+        import sys
+        points = np.asarray(points, dtype = float).reshape((-1,2))
+        num_points = len(points)
+        arrays = self.geo.arrays
+        chunks = []
+        for start in xrange(0, num_points, chunk_size):
+            pts = points[start: start + chunk_size]
+            if not silent:
+                ps = 'fit_columns %3.0f%% done'% (100. * start / num_points)
+                sys.stdout.write('%s\r' % ps)
+                sys.stdout.flush()
+            colindex = self.geo.column_indices_containing_points(pts)
+            ipt = np.nonzero(colindex >= 0)[0]
+            ipt = ipt[self.is_fit_column[colindex[ipt]]]
+            colindex = colindex[ipt]
+            psi, found = arrays.column_local_basis(pts[ipt], colindex)
+            ipt, colindex, psi = ipt[found], colindex[found], psi[found]
+            nodes = self.column_nodes[colindex]
+            used = nodes >= 0
+            chunks.append(sparse.coo_matrix((psi[used], (nodes[used], np.repeat(ipt, 4).reshape(nodes.shape)[used])),
+                                            shape = (self.num_nodes, len(pts))).tocsr())
+        if chunks: return sparse.hstack(chunks, format = 'csr')
+        else: return sparse.csr_matrix((self.num_nodes, 0))
+
+    def point_set(self, points, silent = False):
+        """Returns basis function matrix (see basis_matrix()) and factorized fitting matrix for the specified 2D
+        points, from the cache if the same point positions have been fitted recently.  Least recently used point
+        sets are discarded from the cache when it holds more than max_point_sets of them."""
+        from hashlib import sha1
+        from scipy.sparse.linalg import splu
+        points = np.ascontiguousarray(points, dtype = float).reshape((-1,2))
+        key = (len(points), sha1(points.tostring()).hexdigest())
+        if key in self._point_sets: item = self._point_sets.pop(key)
+        else:
+            P = self.basis_matrix(points, silent)
+            A = P * P.T + self.smoothing
+            item = (P, splu(A.tocsc()))
+        if self.max_point_sets > 0:
+            self._point_sets[key] = item
+            while len(self._point_sets) > self.max_point_sets: self._point_sets.popitem(last = False)
+        return item
+
+    def normal_equations(self, data, values = None):
+        """Returns the least-squares fitting matrix (without smoothing) and right-hand side for the data (see
+        fit_nodes() for its form).  These can be summed over separate chunks of a large data set."""
+        points, values = self.data_points_values(data, values)
+        P = self.basis_matrix(points, silent = True)
+        return P * P.T, P * values
+
+    def data_points_values(self, data, values = None):
+        """Splits data into point positions and values.  If values are not specified, they are taken from the
+        data columns after the x,y point positions (as a one-dimensional array if there is only one such
+        column)."""
+        data = np.asarray(data, dtype = float)
+        if data.ndim != 2: raise Exception('Data must be a two-dimensional array, with a row for each data point.')
+        points = data[:,0:2]
+        if values is None:
+            if data.shape[1] == 3: values = data[:,2]
+            else: values = data[:,2:]
+        else: values = np.asarray(values, dtype = float)
+        return points, values
+
+    def fit_nodes(self, data, values = None, silent = False, processes = 1, chunk_size = 100000):
+        """Returns fitted nodal values for the data, which can either be an array of x,y,z data, or an array of
+        x,y point positions with the corresponding data values given separately (values).  The values may be
+        a two-dimensional array, with each column representing a different data set at the same points (or
+        equivalently the data array may have more than three columns), in which case the nodal values are also
+        two-dimensional.  The data may also be given as an iterable (e.g. a list) of two-dimensional data
+        arrays, or as the name of a text or .npy file, in which case the data are processed in chunks (see
+        fit_stream()), and the values must be included in the data."""
+        chunks = isinstance(data, (list, tuple)) and len(data) > 0 and np.ndim(data[0]) == 2
+        if chunks or not isinstance(data, (np.ndarray, list, tuple)):
+            if values is not None: raise Exception('Values must be included in the data when fitting data chunks.')
+            return self.fit_stream(data, silent, processes, chunk_size)
+        points, values = self.data_points_values(data, values)
+        P, lu = self.point_set(points, silent)
+        b = P * values
+        return lu.solve(b)
+
+    def fit_stream(self, data, silent = False, processes = 1, chunk_size = 100000):
+        """Returns fitted nodal values for data given as an iterable of chunks, each an array of x,y point positions
+        followed by one or more columns of data values, or as the name of a text or .npy file containing such an
+        array (see data_chunks()).  The least-squares equations are accumulated chunk by chunk, so memory use is
+        bounded by the size of the grid and the chunk size, rather than the total number of data points.  If
+        processes is greater than 1, chunks are processed in parallel by that many worker processes.  Point
+        locations and matrix factorizations are not cached."""
+        from scipy.sparse.linalg import splu
+        import sys
+        if isinstance(data, basestring): data = data_chunks(data, chunk_size)
+        A, b, num_points = self.smoothing.copy(), 0., 0
+        if processes > 1:
+            from multiprocessing import Pool
+            pool = Pool(processes, initializer = init_fit_chunk_worker, initargs = (self,))
+            results = pool.imap(fit_chunk_normal_equations, data)
+        else:
+            pool = None
+            results = (fit_chunk_normal_equations(chunk, self) for chunk in data)
+        try:
+            for chunk_A, chunk_b, n in results:
+                A = A + chunk_A
+                b = b + chunk_b
+                num_points += n
+                if not silent:
+                    sys.stdout.write('fit_columns %d points done\r' % num_points)
+                    sys.stdout.flush()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        if num_points == 0: b = np.zeros(self.num_nodes)
+        return splu(A.tocsc()).solve(b)
+
+    def fit(self, data, values = None, min_columns = [], silent = False, output_dict = False, processes = 1,
+            chunk_size = 100000):
+        """Fits data to the column centres (see fit_nodes() for the form of the data and values).  For columns
+        with names in min_columns, column centre values are calculated as the minimum of the fitted nodal values;
+        for all other columns, the area-weighted average of the nodal values is used.  The result is by default
+        an array of fitted values corresponding to each of the columns (two-dimensional, if the values are). If
+        output_dict is True, the result is a dictionary of fitted values indexed by column names."""
+        if min_columns != []:
+            if not isinstance(min_columns[0],str): min_columns = [col.name for col in min_columns]
+        z = self.fit_nodes(data, values, silent, processes, chunk_size)
+        column_values = self.mean_operator * z
+        for colname in min_columns:
+            if colname in self.column_index:
+                i = self.column_index[colname]
+                column_values[i] = np.min(z[self.column_node_lists[i]], axis = 0)
+        if output_dict: return dict(zip([col.name for col in self.columns], column_values))
+        else: return column_values
+
+def data_chunks(filename, chunk_size = 100000):
+    """Generates chunks of a two-dimensional data array stored in a file, with the specified number of rows in
+    each chunk.  Files with names ending in .npy are read as NumPy binary files (memory-mapped), and other
+    files as text files (one row per line)."""
+    if filename.lower().endswith('.npy'):
+        data = np.load(filename, mmap_mode = 'r')
+        for start in xrange(0, len(data), chunk_size):
+            yield np.array(data[start: start + chunk_size], dtype = float)
+    else:
+        from itertools import islice
+        f = open(filename)
+        try:
+            while True:
+                lines = list(islice(f, chunk_size))
+                if not lines: break
+                chunk = np.loadtxt(lines, ndmin = 2)
+                if len(chunk) > 0: yield chunk
+        finally: f.close()
+
+fit_worker_fitter = None
+def init_fit_chunk_worker(fitter):
+    """Initializes a worker process for accumulating fitting equations over data chunks."""
+    global fit_worker_fitter
+    fit_worker_fitter = fitter
+
+def fit_chunk_normal_equations(chunk, fitter = None):
+    """Returns the fitting matrix, right-hand side and number of points for a chunk of data.  If no fitter is
+    specified, the fitter of the worker process is used."""
+    if fitter is None: fitter = fit_worker_fitter
+    A, b = fitter.normal_equations(chunk)
+    return A, b, len(chunk)
+
+class grid_optimizer(object):
+    """Least-squares optimization of node positions in a geometry (see the mulgrid optimize() method).  The
+    residuals (connection angle cosines, column side ratios and column angle ratios affected by moving the
+    specified nodes) and their sparse Jacobian matrix are calculated on arrays of node positions, so the object
+    does not refer to the geometry and can be sent to other processes."""
+    def __init__(self, geo, nodenames, connection_angle_weight = 1.0, column_aspect_weight = 0.0,
+                 column_skewness_weight = 0.0):
+        self.nodenames = list(nodenames)
+        nodeset = set(self.nodenames)
+        columns = [col for col in geo.columnlist if nodeset & set([n.name for n in col.node])]
+        self.colnames = [col.name for col in columns]
+        colset = set(self.colnames)
+        if connection_angle_weight > 0.0:
+            cons = [con for con in geo.connectionlist if set(col.name for col in con.column) & colset]
+        else: cons = []
+        self.connames = [tuple([col.name for col in con.column]) for con in cons]
+        self.connection_angle_weight = connection_angle_weight
+        self.column_aspect_weight = column_aspect_weight
+        self.column_skewness_weight = column_skewness_weight
+        # local node and column indexing:
+        nodes = geo.nodes_in_columns(columns) + [n for con in cons for n in con.node]
+        node_index = {}
+        for n in [geo.node[name] for name in self.nodenames] + nodes:
+            if n.name not in node_index: node_index[n.name] = len(node_index)
+        self.node_pos = np.zeros((len(node_index), 2))
+        for name, i in node_index.iteritems(): self.node_pos[i] = geo.node[name].pos
+        self.free_nodes = np.array([node_index[name] for name in self.nodenames], dtype = int)
+        self.free_index = -np.ones(len(node_index), dtype = int)
+        self.free_index[self.free_nodes] = np.arange(len(self.free_nodes))
+        column_index = dict([(name, i) for i, name in enumerate(self.colnames)])
+        num_nodes = np.array([col.num_nodes for col in columns], dtype = int)
+        self.column_node_indptr = np.concatenate(([0], np.cumsum(num_nodes))).astype(int)
+        self.column_nodes = np.array([node_index[n.name] for col in columns for n in col.node], dtype = int)
+        self.column_node_column = np.repeat(np.arange(len(columns)), num_nodes)
+        i = np.arange(len(self.column_nodes))
+        start = self.column_node_indptr[self.column_node_column]
+        self.column_node_next = start + (i - start + 1) % num_nodes[self.column_node_column]
+        self.column_node_prev = start + (i - start - 1) % num_nodes[self.column_node_column]
+        # connection columns (index of moving column, or -1 with fixed centre):
+        self.connection_nodes = np.array([[node_index[n.name] for n in con.node] for con in cons],
+                                         dtype = int).reshape((-1,2))
+        self.connection_columns = np.array([[column_index.get(col.name, -1) for col in con.column] for con in cons],
+                                           dtype = int).reshape((-1,2))
+        self.connection_centres = np.array([[col.centre for col in con.column] for con in cons],
+                                           dtype = float).reshape((-1,2,2))
+
+    def __repr__(self):
+        return 'grid optimizer: ' + str(len(self.free_nodes)) + ' nodes; ' + str(len(self.colnames)) + \
+            ' columns; ' + str(len(self.connames)) + ' connections'
+
+    def get_num_residuals(self):
+        n = 0
+        if self.connection_angle_weight: n += len(self.connames)
+        if self.column_aspect_weight: n += len(self.colnames)
+        if self.column_skewness_weight: n += len(self.colnames)
+        return n
+    num_residuals = property(get_num_residuals)
+
+    def positions(self, x):
+        """Returns positions of all nodes, given the array x of free node coordinates."""
+        pos = self.node_pos.copy()
+        pos[self.free_nodes] = np.asarray(x).reshape((-1,2))
+        return pos
+
+    def column_geometry(self, pos):
+        """Returns shifted node positions for each column node entry, and column centroids, areas and
+        centroid moment sums."""
+        col = self.column_node_column
+        shift = pos[self.column_nodes[self.column_node_indptr[:-1]]]
+        q = pos[self.column_nodes] - shift[col] # shift to reduce roundoff for large coordinates
+        qn = q[self.column_node_next]
+        t = q[:,0] * qn[:,1] - qn[:,0] * q[:,1]
+        num_columns = len(self.colnames)
+        area = 0.5 * np.bincount(col, weights = t, minlength = num_columns)
+        Q = np.array([np.bincount(col, weights = (q[:,i] + qn[:,i]) * t, minlength = num_columns)
+                      for i in xrange(2)]).T
+        centroid = Q / (6. * area[:,np.newaxis]) + shift
+        return q, t, area, Q, centroid
+
+    def centroid_derivatives(self, q, t, area, Q):
+        """Returns derivatives (2x2 matrices) of column centroids with respect to the position of the node at
+        each column node entry."""
+        col = self.column_node_column
+        qn, qp = q[self.column_node_next], q[self.column_node_prev]
+        tp = t[self.column_node_prev]
+        dt = np.array([qn[:,1], -qn[:,0]]).T # derivative of t at entry
+        dtp = np.array([-qp[:,1], qp[:,0]]).T # derivative of t at previous entry
+        dA = 0.5 * (dt + dtp)
+        dQ = (t + tp)[:,np.newaxis,np.newaxis] * np.eye(2) + \
+            (q + qn)[:,:,np.newaxis] * dt[:,np.newaxis,:] + (qp + q)[:,:,np.newaxis] * dtp[:,np.newaxis,:]
+        A = area[col][:,np.newaxis,np.newaxis]
+        return dQ / (6. * A) - Q[col][:,:,np.newaxis] * dA[:,np.newaxis,:] / (6. * A**2)
+
+    def ratio_terms(self, values):
+        """Returns the ratio of largest to smallest of the specified values for each column entry, and the
+        entry indices of the largest and smallest values."""
+        indptr = self.column_node_indptr
+        vmax, vmin = np.maximum.reduceat(values, indptr[:-1]), np.minimum.reduceat(values, indptr[:-1])
+        col = self.column_node_column
+        i = np.arange(len(values))
+        big = len(values)
+        imax = np.minimum.reduceat(np.where(values == vmax[col], i, big), indptr[:-1])
+        imin = np.minimum.reduceat(np.where(values == vmin[col], i, big), indptr[:-1])
+        return vmax / vmin, imax, imin
+
+    def side_lengths(self, q):
+        """Returns column side lengths (from each column node entry to the next), and unit side vectors."""
+        s = q[self.column_node_next] - q
+        l = np.sqrt(np.sum(s**2, axis = 1))
+        return l, s / l[:,np.newaxis]
+
+    def interior_angles(self, q):
+        """Returns column interior angles at each column node entry, and the derivatives of the side
+        headings (for the sides ending at each entry)."""
+        s = q - q[self.column_node_prev]
+        h = np.arctan2(s[:,0], s[:,1]) % (2. * np.pi)
+        ext = (np.pi - (h[self.column_node_next] - h)) % (2. * np.pi)
+        dh = np.array([s[:,1], -s[:,0]]).T / np.sum(s**2, axis = 1)[:,np.newaxis]
+        return 2. * np.pi - ext, dh
+
+    def residual(self, x):
+        """Returns array of residuals for the free node coordinates x."""
+        pos = self.positions(x)
+        q, t, area, Q, centroid = self.column_geometry(pos)
+        result = []
+        if self.connection_angle_weight:
+            n = pos[self.connection_nodes[:,1]] - pos[self.connection_nodes[:,0]]
+            c = np.where((self.connection_columns >= 0)[:,:,np.newaxis],
+                         centroid[np.maximum(self.connection_columns, 0)], self.connection_centres)
+            d = c[:,1] - c[:,0]
+            cosine = np.sum(n * d, axis = 1) / np.sqrt(np.sum(n**2, axis = 1) * np.sum(d**2, axis = 1))
+            result.append(self.connection_angle_weight * cosine)
+        if self.column_aspect_weight:
+            l, u = self.side_lengths(q)
+            result.append(self.column_aspect_weight * (self.ratio_terms(l)[0] - 1.))
+        if self.column_skewness_weight:
+            angles, dh = self.interior_angles(q)
+            result.append(self.column_skewness_weight * (self.ratio_terms(angles)[0] - 1.))
+        if result: return np.concatenate(result)
+        else: return np.zeros(0)
+
+    def jacobian(self, x):
+        """Returns sparse Jacobian matrix of the residuals with respect to the free node coordinates x."""
+        from scipy import sparse
+        pos = self.positions(x)
+        q, t, area, Q, centroid = self.column_geometry(pos)
+        rows, nodes, vals = [], [], [] # derivative (2-vector) of residual row with respect to node position
+        row0 = 0
+        if self.connection_angle_weight:
+            w = self.connection_angle_weight
+            num_cons = len(self.connames)
+            n = pos[self.connection_nodes[:,1]] - pos[self.connection_nodes[:,0]]
+            moving = self.connection_columns >= 0
+            c = np.where(moving[:,:,np.newaxis], centroid[np.maximum(self.connection_columns, 0)],
+                         self.connection_centres)
+            d = c[:,1] - c[:,0]
+            ln, ld = np.sqrt(np.sum(n**2, axis = 1)), np.sqrt(np.sum(d**2, axis = 1))
+            n, d = n / ln[:,np.newaxis], d / ld[:,np.newaxis]
+            cosine = np.sum(n * d, axis = 1)[:,np.newaxis]
+            dn = w * (d - cosine * n) / ln[:,np.newaxis]
+            dd = w * (n - cosine * d) / ld[:,np.newaxis]
+            icon = np.arange(num_cons)
+            rows += [icon, icon]
+            nodes += [self.connection_nodes[:,1], self.connection_nodes[:,0]]
+            vals += [dn, -dn]
+            dc = self.centroid_derivatives(q, t, area, Q)
+            for side, sign in [(1, 1.), (0, -1.)]:
+                i = np.nonzero(moving[:,side])[0]
+                col = self.connection_columns[i,side]
+                nn = np.diff(self.column_node_indptr)[col]
+                entry = np.repeat(self.column_node_indptr[col], nn) + \
+                    np.arange(np.sum(nn)) - np.repeat(np.cumsum(nn) - nn, nn)
+                icon = np.repeat(i, nn)
+                rows.append(icon)
+                nodes.append(self.column_nodes[entry])
+                vals.append(sign * np.einsum('pa,pab->pb', dd[icon], dc[entry]))
+            row0 += num_cons
+        def add_ratio_terms(values, dvalues, weight, row0):
+            """Adds Jacobian terms for ratio residuals, given the derivatives of each value as a list of
+            (entry offset, derivative) tuples."""
+            ratio, imax, imin = self.ratio_terms(values)
+            icol = np.arange(len(ratio))
+            for ientry, scale in [(imax, weight / values[imin]), (imin, -weight * ratio / values[imin])]:
+                for offset, dv in dvalues:
+                    rows.append(row0 + icol)
+                    nodes.append(self.column_nodes[offset(ientry)])
+                    vals.append(scale[:,np.newaxis] * dv[ientry])
+        if self.column_aspect_weight:
+            l, u = self.side_lengths(q)
+            add_ratio_terms(l, [(lambda e: self.column_node_next[e], u), (lambda e: e, -u)],
+                            self.column_aspect_weight, row0)
+            row0 += len(self.colnames)
+        if self.column_skewness_weight:
+            angles, dh = self.interior_angles(q)
+            dhn = dh[self.column_node_next]
+            add_ratio_terms(angles, [(lambda e: self.column_node_next[e], dhn), (lambda e: e, -dhn - dh),
+                                     (lambda e: self.column_node_prev[e], dh)],
+                            self.column_skewness_weight, row0)
+            row0 += len(self.colnames)
+        num_vars = 2 * len(self.free_nodes)
+        if rows:
+            rows, nodes, vals = np.concatenate(rows), np.concatenate(nodes), np.concatenate(vals)
+            var = self.free_index[nodes]
+            free = var >= 0
+            rows, var, vals = np.repeat(rows[free], 2), (2 * var[free,np.newaxis] + [0,1]).ravel(), vals[free].ravel()
+        else: rows, var, vals = np.zeros(0, dtype = int), np.zeros(0, dtype = int), np.zeros(0)
+        return sparse.coo_matrix((vals, (rows, var)), shape = (row0, num_vars)).tocsr()
+
+    def solve(self):
+        """Returns optimized free node coordinates, using the SciPy least_squares() routine with the sparse
+        Jacobian if it is available, or otherwise the leastsq() routine."""
+        x0 = self.node_pos[self.free_nodes].ravel()
+        if len(x0) == 0 or self.num_residuals == 0: return x0
+        try:
+            from scipy.optimize import least_squares
+        except ImportError: # older versions of SciPy
+            from scipy.optimize import leastsq
+            x1, success = leastsq(self.residual, x0, Dfun = lambda x: self.jacobian(x).toarray())
+            if success > 4: raise Exception('scipy leastsq() optimization routine did not converge.')
+            return x1
+        result = least_squares(self.residual, x0, jac = self.jacobian, method = 'trf', tr_solver = 'lsmr')
+        if result.status <= 0: raise Exception('scipy least_squares() optimization routine did not converge.')
+        return result.x
+
+def solve_grid_optimizer(optimizer):
+    """Returns optimized node coordinates for a grid optimizer.  This is a module-level function so that it can
+    be run in worker processes."""
+    return optimizer.solve()
+
 class mulgrid(object):
     """MULgraph grid class"""
     def __init__(self, filename = '', type = 'GENER', convention = 0, atmos_type = 0, atmos_volume = 1.e25,
                  atmos_connection = 1.e-6, unit_type = '', permeability_angle = 0.0,
-                 read_function = default_read_function):
+                 read_function = default_read_function, cache = False):
         self.filename=filename
         self.type=type  # geometry type- only GENER supported
         self._convention=convention  # naming convention
@@ -470,7 +1637,7 @@ class mulgrid(object):
         self.permeability_angle=permeability_angle
         self.read_function = read_function
         self.empty()
-        if self.filename: self.read(filename)
+        if self.filename: self.read(filename, cache)
 
     def set_secondary_variables(self):
         """Sets variables dependent on naming convention and atmosphere type"""
@@ -548,7 +1715,7 @@ class mulgrid(object):
 
     def get_column_side_ratio(self):
         """Returns an array of side ratios for each column."""
-        return np.array([col.side_ratio for col in self.columnlist])
+        return self.arrays.column_side_ratio.copy()
     column_side_ratio=property(get_column_side_ratio)
 
     def get_connection_angle_cosine(self):
@@ -586,6 +1753,41 @@ class mulgrid(object):
         self.well={}
         self.block_name_list,self.block_name_index=[],{}
         self.block_connection_name_list,self.block_connection_name_index=[],{}
+        self._arrays=None
+        self._layer_blocks=None
+        self._column_pair_connection,self._node_pair_connection={},{}
+        self._name_allocators={}
+        self._geometry_version=[0]
+
+    def geometry_changed(self):
+        """Records that the grid geometry (node positions, or column, connection or layer structure) has
+        changed, so that array representations of the geometry are rebuilt when next needed."""
+        self._geometry_version[0]+=1
+
+    def watch_geometry(self,objects):
+        """Records that the specified nodes, columns or layers belong to the grid, so that changes to their
+        geometry are recorded in the grid's geometry version."""
+        version=self._geometry_version
+        for obj in objects:
+            versions=getattr(obj,'_grid_versions',())
+            if not any([v is version for v in versions]): obj._grid_versions=versions+(version,)
+        version[0]+=1
+
+    def unwatch_geometry(self,objects):
+        """Records that the specified nodes, columns or layers no longer belong to the grid."""
+        version=self._geometry_version
+        for obj in objects:
+            obj._grid_versions=tuple([v for v in getattr(obj,'_grid_versions',()) if v is not version])
+        version[0]+=1
+
+    def get_arrays(self):
+        """Returns array representation of the grid geometry, rebuilding it if the geometry has changed
+        since it was last built."""
+        state=(self._geometry_version[0],len(self.nodelist),len(self.columnlist),len(self.connectionlist),
+               len(self.layerlist))
+        if self._arrays is None or self._arrays.state<>state: self._arrays=mulgrid_arrays(self,state)
+        return self._arrays
+    arrays=property(get_arrays)
 
     def __repr__(self):
         conventionstr=['3 characters for column, 2 digits for layer','3 characters for layer, 2 digits for column','2 characters for layer, 3 digits for column'][self.convention]
@@ -625,7 +1827,89 @@ class mulgrid(object):
 
     def connects(self,col1,col2):
         """Returns True if the geometry contains a connection connecting the two specified columns."""
-        return any([(col1 in con.column) and (col2 in con.column) for con in self.connectionlist])
+        return frozenset((col1,col2)) in self._column_pair_connection
+
+    def index_connection(self,con):
+        """Adds connection to the column-pair and node-pair adjacency indexes.  If another connection with
+        the same columns (or nodes) is already indexed, it is kept."""
+        self._column_pair_connection.setdefault(frozenset(con.column),con)
+        if con.node: self._node_pair_connection.setdefault(frozenset(con.node),con)
+
+    def unindex_connection(self,con):
+        """Removes connection from the adjacency indexes, replacing it with any other connection having
+        the same columns (or nodes)."""
+        def replace(index,key,candidates,conkey):
+            if index.get(key) is con:
+                del index[key]
+                for c in candidates:
+                    if c is not con and conkey(c)==key:
+                        index[key]=c
+                        break
+        replace(self._column_pair_connection,frozenset(con.column),con.column[0].connection,
+                lambda c: frozenset(c.column))
+        if con.node:
+            replace(self._node_pair_connection,frozenset(con.node),
+                    set().union(*[col.connection for col in con.node[0].column]),
+                    lambda c: frozenset(c.node) if c.node else None)
+
+    def layer_block_names(self, layername, colnames):
+        """Returns array of block names in the specified layer, for the specified array of column names."""
+        if self.convention == 0: names = np.char.add(colnames.astype('S3'), layername[0:2])
+        elif self.convention == 1: names = np.char.add(layername[0:3], colnames.astype('S2'))
+        else: names = np.char.add(layername[0:2], colnames.astype('S3'))
+        names = names.astype('S5')
+        c = names.view('S1').reshape(names.shape + (5,))
+        def isdigit(x): return (x >= '0') & (x <= '9')
+        fix = isdigit(c[:,2]) & isdigit(c[:,4]) & (c[:,3] == ' ') # as in fix_blockname()
+        c[fix,3] = '0'
+        return names
+
+    def update_layer_blocks(self):
+        """Updates cached lists of block names and block connection names for each non-atmosphere layer.
+        If the grid columns, layers, connections and naming are unchanged since the last update, the lists
+        are regenerated only for layers in which the columns present (or the columns connected to the
+        atmosphere) have changed, e.g. after column surface elevations have been modified.  Returns the
+        cache dictionary."""
+        colnames = [col.name for col in self.columnlist]
+        laynames = [lay.name for lay in self.layerlist]
+        arrays = self.arrays
+        structure = (self.convention, self.atmosphere_type, self.atmosphere_column_name if self.atmosphere_type == 0
+                     else None, colnames, laynames, arrays.layer_bottom.tolist(), arrays.layer_top.tolist(),
+                     arrays.connection_columns.tolist())
+        num_layers = max(self.num_layers - 1, 0)
+        cache = self._layer_blocks
+        if cache is None or cache['structure'] <> structure:
+            cache = {'structure': structure, 'colnames': np.array(colnames, dtype = str), 'present': None,
+                     'atmosphere': None, 'block_names': [None] * num_layers, 'connection_names': [None] * num_layers}
+            self._layer_blocks = cache
+        with np.errstate(invalid = 'ignore'):
+            present = arrays.column_surface[np.newaxis,:] > arrays.layer_bottom[1:, np.newaxis]
+            atmosphere = arrays.column_surface[np.newaxis,:] <= arrays.layer_top[1:, np.newaxis]
+        atmosphere[0:1,:] = True
+        if cache['present'] is None: changed = range(num_layers)
+        else: changed = np.nonzero(np.any(present <> cache['present'], axis = 1) |
+                                   np.any(present & (atmosphere <> cache['atmosphere']), axis = 1))[0]
+        cache['present'], cache['atmosphere'] = present, atmosphere
+        if len(changed) > 0:
+            c0, c1 = arrays.connection_columns[:,0], arrays.connection_columns[:,1]
+            if self.atmosphere_type == 0: atmname = self.block_name(self.layerlist[0].name, self.atmosphere_column_name)
+            elif self.atmosphere_type == 1: atmnames = self.layer_block_names(self.layerlist[0].name, cache['colnames'])
+            for ilay in changed:
+                names = self.layer_block_names(self.layerlist[ilay + 1].name, cache['colnames'])
+                cols = np.nonzero(present[ilay])[0]
+                cache['block_names'][ilay] = names[cols].tolist()
+                # vertical connections:
+                atm = atmosphere[ilay][cols]
+                above = self.layer_block_names(self.layerlist[ilay].name, cache['colnames'][cols])
+                if self.atmosphere_type == 0: above[atm] = atmname
+                elif self.atmosphere_type == 1: above[atm] = atmnames[cols[atm]]
+                else: cols, above = cols[~atm], above[~atm]
+                vertical = zip(names[cols].tolist(), above.tolist())
+                # horizontal connections:
+                con = present[ilay][c0] & present[ilay][c1]
+                horizontal = zip(names[c0[con]].tolist(), names[c1[con]].tolist())
+                cache['connection_names'][ilay] = vertical + horizontal
+        return cache
 
     def setup_block_name_index(self):
         """Sets up list and dictionary of block names and indices for the tough2 grid represented by the geometry."""
@@ -634,35 +1918,17 @@ class mulgrid(object):
             if self.atmosphere_type==0: # one atmosphere block
                 self.block_name_list.append(self.block_name(self.layerlist[0].name,self.atmosphere_column_name))
             elif self.atmosphere_type==1: # one atmosphere block per column
-                for col in self.columnlist: self.block_name_list.append(self.block_name(self.layerlist[0].name,col.name))
-            for lay in self.layerlist[1:]:
-                for col in [col for col in self.columnlist if col.surface>lay.bottom]:
-                    self.block_name_list.append(self.block_name(lay.name,col.name))
-        self.block_name_index=dict([(blk,i) for i,blk in enumerate(self.block_name_list)])
+                colnames = np.array([col.name for col in self.columnlist], dtype = str)
+                self.block_name_list += self.layer_block_names(self.layerlist[0].name, colnames).tolist()
+            for names in self.update_layer_blocks()['block_names']: self.block_name_list += names
+        self.block_name_index=dict(zip(self.block_name_list,xrange(len(self.block_name_list))))
 
     def setup_block_connection_name_index(self):
         """Sets up list and dictionary of connection names and indices for blocks in the TOUGH2 grid represented by the geometry."""
         self.block_connection_name_list = []
-        for ilay,lay in enumerate(self.layerlist[1:]):
-            layercols = [col for col in self.columnlist if col.surface > lay.bottom]
-            for col in layercols: # vertical connections
-                thisblkname = self.block_name(lay.name, col.name)
-                if (ilay == 0) or (col.surface <= lay.top): # connection to atmosphere
-                    abovelayer = self.layerlist[0]
-                    if self.atmosphere_type == 0:
-                        aboveblkname = self.block_name_list[0]
-                    elif self.atmosphere_type == 1:
-                        aboveblkname = self.block_name(abovelayer.name,col.name)
-                    else: continue
-                else:
-                    abovelayer = self.layerlist[ilay]
-                    aboveblkname = self.block_name(abovelayer.name,col.name)
-                self.block_connection_name_list.append((thisblkname, aboveblkname))
-            layercolset = set(layercols) # horizontal connections:
-            for con in [con for con in self.connectionlist if set(con.column).issubset(layercolset)]:
-                conblocknames = tuple([self.block_name(lay.name,concol.name) for concol in con.column])
-                self.block_connection_name_list.append(conblocknames)
-        self.block_connection_name_index = dict([(con,i) for i,con in enumerate(self.block_connection_name_list)])
+        for names in self.update_layer_blocks()['connection_names']: self.block_connection_name_list += names
+        self.block_connection_name_index = dict(zip(self.block_connection_name_list,
+                                                    xrange(len(self.block_connection_name_list))))
 
     def column_name(self,blockname):
         """Returns column name of block name."""
@@ -716,18 +1982,48 @@ class mulgrid(object):
         return all([(blkname[0:3]==blkname[0:3].rjust(3)) for blkname in self.block_name_list])
     right_justified_names=property(get_right_justified_names)
 
+    def name_allocator(self, kind, justfn = rjust, chars = ascii_lowercase):
+        """Returns name allocator for new node or column names (kind = 'node' or 'column'), using the
+        specified justification and characters."""
+        d = getattr(self, kind)
+        key = (kind, justfn, self.colname_length, chars)
+        allocator = self._name_allocators.get(key)
+        if allocator is None or allocator.d is not d:
+            allocator = name_allocator(d, justfn, self.colname_length, chars)
+            self._name_allocators[key] = allocator
+        return allocator
+
+    def free_name(self, kind, name):
+        """Records that a node or column name (kind = 'node' or 'column') is no longer used."""
+        for key, allocator in self._name_allocators.iteritems():
+            if key[0] == kind: allocator.free(name)
+
     def new_node_name(self, istart = 0, justfn = rjust, chars = ascii_lowercase):
-        name,i = new_dict_key(self.node, istart, justfn, self.colname_length, chars)
+        name,i = self.name_allocator('node', justfn, chars).allocate(istart)
         if len(name) > self.colname_length:
             raise NamingConventionError("Node name is too long for the grid naming convention.")
         else: return name,i
 
     def new_column_name(self, istart = 0, justfn = rjust, chars = ascii_lowercase):
-        name,i = new_dict_key(self.column, istart, justfn, self.colname_length, chars)
+        name,i = self.name_allocator('column', justfn, chars).allocate(istart)
         if len(name) > self.colname_length:
             raise NamingConventionError("Column name is too long for the grid naming convention.")
         else: return name,i
 
+    def new_node_names(self, num, justfn = rjust, chars = ascii_lowercase):
+        """Returns a list of the specified number of unused node names."""
+        names = self.name_allocator('node', justfn, chars).allocate_batch(num)
+        if any([len(name) > self.colname_length for name in names]):
+            raise NamingConventionError("Node name is too long for the grid naming convention.")
+        else: return names
+
+    def new_column_names(self, num, justfn = rjust, chars = ascii_lowercase):
+        """Returns a list of the specified number of unused column names."""
+        names = self.name_allocator('column', justfn, chars).allocate_batch(num)
+        if any([len(name) > self.colname_length for name in names]):
+            raise NamingConventionError("Column name is too long for the grid naming convention.")
+        else: return names
+
     def column_bounds(self,columns):
         """Returns horizontal bounding box for a list of columns."""
         nodes=self.nodes_in_columns(columns)
@@ -735,34 +2031,39 @@ class mulgrid(object):
 
     def get_bounds(self):
         """Returns horizontal bounding box for grid."""
-        return bounds_of_points([node.pos for node in self.nodelist])
+        return self.arrays.bounds
     bounds=property(get_bounds)
 
     def add_node(self,nod=node()):
         """Adds node to the grid"""
         self.nodelist.append(nod)
         self.node[nod.name]=self.nodelist[-1]
+        self.watch_geometry([nod])
 
     def delete_node(self,nodename):
         node=self.node[nodename]
         del self.node[nodename]
         self.nodelist.remove(node)
+        self.free_name('node',nodename)
+        self.unwatch_geometry([node])
 
     def add_column(self,col=column()):
         """Adds column to the grid"""
         self.columnlist.append(col)
         self.column[col.name]=self.columnlist[-1]
         for node in col.node: node.column.add(col)
+        self.watch_geometry([col])
 
     def delete_column(self,colname):
         col=self.column[colname]
-        cons=[con for con in self.connectionlist if col in con.column]
-        for con in cons:
+        for con in list(col.connection):
             self.delete_connection(tuple([c.name for c in con.column]))
         for nbr in col.neighbour: nbr.neighbour.remove(col)
         for node in col.node: node.column.remove(col)
         del self.column[colname]
         self.columnlist.remove(col)
+        self.free_name('column',colname)
+        self.unwatch_geometry([col])
 
     def split_column(self,colname,nodename, chars = ascii_lowercase):
         """Splits the specified quadrilateral column into two triangles, splitting at the specified node.  Returns
@@ -784,6 +2085,10 @@ class mulgrid(object):
                     n3cols=[c for c in list(col.neighbour) if n3 in c.node]
                     swapcons,swapnbrs=[],[]
                     for con in list(col.connection):
+                        if con.column[0] in n3cols or con.column[1] in n3cols:
+                            self.unindex_connection(con)
+                            oldnames=(con.column[0].name,con.column[1].name)
+                            if self.connection.get(oldnames) is con: del self.connection[oldnames]
                         if con.column[0] in n3cols:
                             con.column[1]=col2; swapcons.append(con); swapnbrs.append(con.column[0])
                         elif con.column[1] in n3cols:
@@ -791,12 +2096,17 @@ class mulgrid(object):
                     for con in swapcons:
                         col.connection.remove(con)
                         col2.connection.add(con)
+                        self.connection[(con.column[0].name,con.column[1].name)]=con
+                        self.index_connection(con)
                     for c in swapnbrs:
                         col.neighbour.remove(c)
                         c.neighbour.remove(col)
                         col2.neighbour.add(c)
                         c.neighbour.add(col2)
+                        c.clear_cache()
                     del col.node[i[3]]
+                    col.clear_cache()
+                    self.geometry_changed()
                     col.centre=col.centroid
                     self.add_column(col2)
                     self.add_connection(connection([col,col2]))
@@ -815,6 +2125,7 @@ class mulgrid(object):
                 i = self.columnlist.index(self.column[olditem])
                 self.columnlist[i].name = newitem
                 self.column[newitem] = self.column.pop(olditem)
+                self.free_name('column', olditem)
             self.setup_block_name_index()
             self.setup_block_connection_name_index()
             return True
@@ -822,6 +2133,7 @@ class mulgrid(object):
 
     def clear_layers(self):
         """Deletes all layers from the grid."""
+        self.unwatch_geometry(self.layerlist)
         self.layer = {}
         self.layerlist = []
 
@@ -829,11 +2141,13 @@ class mulgrid(object):
         """Adds layer to the grid"""
         self.layerlist.append(lay)
         self.layer[lay.name]=self.layerlist[-1]
+        self.watch_geometry([lay])
 
     def delete_layer(self,layername):
         layer=self.layer[layername]
         del self.layer[layername]
         self.layerlist.remove(layer)
+        self.unwatch_geometry([layer])
 
     def rename_layer(self, oldlayername, newlayername):
         """Renames a layer or list of layers."""
@@ -854,7 +2168,11 @@ class mulgrid(object):
         self.connectionlist.append(con)
         self.connection[(con.column[0].name,con.column[1].name)] = self.connectionlist[-1]
         self.connectionlist[-1].node = self.connection_nodes(con.column)
-        for col in self.connectionlist[-1].column: col.connection.add(self.connectionlist[-1])
+        for col in self.connectionlist[-1].column:
+            col.connection.add(self.connectionlist[-1])
+            col.clear_cache()
+        self.index_connection(con)
+        self.geometry_changed()
 
     def connection_nodes(self, cols):
         """Identifies nodes on the connection between a pair of two columns.  The node ordering
@@ -874,9 +2192,13 @@ class mulgrid(object):
     def delete_connection(self,colnames):
         """Deletes a connection from the grid."""
         con=self.connection[colnames]
-        for col in con.column: col.connection.remove(con)
+        self.unindex_connection(con)
+        for col in con.column:
+            col.connection.remove(con)
+            col.clear_cache()
         del self.connection[colnames]
         self.connectionlist.remove(con)
+        self.geometry_changed()
             
     def add_well(self,wl=well()):
         """Adds well to the grid"""
@@ -954,7 +2276,12 @@ class mulgrid(object):
 
     def columns_in_polygon(self,polygon):
         """Returns a list of all columns with centres inside the specified polygon."""
-        return [col for col in self.columnlist if col.in_polygon(polygon)]
+        if self.num_columns==0: return []
+        centre=self.arrays.column_centre
+        bounds=bounds_of_points(polygon)
+        near=np.nonzero(np.all((bounds[0]<=centre)&(centre<=bounds[1]),axis=1))[0]
+        if len(polygon)==2: return [self.columnlist[i] for i in near]
+        else: return [self.columnlist[i] for i in near if in_polygon(centre[i],polygon)]
 
     def nodes_in_polygon(self,polygon):
         """Returns a list of all nodes inside the specified polygon."""
@@ -969,11 +2296,17 @@ class mulgrid(object):
             columns=self.columnlist
         else: bounds=self.column_bounds(columns)
         return quadtree(bounds,columns)
+
+    def get_column_rtree(self):
+        """Returns a packed R-tree of column bounding boxes for searching the grid for columns containing particular
+        points.  This is rebuilt automatically when the grid geometry changes."""
+        return self.arrays.column_rtree
+    column_rtree=property(get_column_rtree)
             
     def get_node_kdtree(self):
         """Returns a kd-tree structure for searching the grid for particular nodes."""
         from scipy.spatial import cKDTree
-        return cKDTree([node.pos for node in self.nodelist])
+        return cKDTree(self.arrays.node_pos)
     node_kdtree=property(get_node_kdtree)
         
     def node_nearest_to(self,point,kdtree=None):
@@ -984,9 +2317,8 @@ class mulgrid(object):
             r,i=kdtree.query(point)
             return self.nodelist[i]
         else:
-            d=np.array([np.linalg.norm(node.pos-point) for node in self.nodelist])
-            isort=np.argsort(d)
-            return self.nodelist[isort[0]]
+            d=np.sum((self.arrays.node_pos-point)**2,axis=1)
+            return self.nodelist[np.argmin(d)]
 
     def read_header(self, geo):
         """Reads grid header info from file geo"""
@@ -996,50 +2328,102 @@ class mulgrid(object):
         self.unit_type = self._unit_type
         if self.cntype is not None: print 'CNTYPE option not supported.'
 
+    def read_section(self, geo):
+        """Reads lines of a section from file geo, up to the next blank line."""
+        lines = []
+        line = geo.readline()
+        while line.strip():
+            lines.append(padstring(line.rstrip('\n')))
+            line = geo.readline()
+        return lines
+
+    def parse_section(self, geo, lines, linetype):
+        """Parses lines of a section into a list of values for each field of the specified line type.  With the
+        default reading functions, numeric fields are converted to arrays in bulk; otherwise (or if any values in
+        a field are blank or invalid) values are converted individually."""
+        fields = []
+        for (i1,i2),typ in geo.line_spec[linetype]:
+            strs = [line[i1:i2] for line in lines]
+            values = None
+            if (self.read_function is default_read_function) and (typ in ['d','e','f','g']):
+                try:
+                    values = np.array(strs, dtype = float)
+                    if typ == 'd': values = values.astype(int)
+                except ValueError: pass
+            if values is None: values = [self.read_function[typ](s) for s in strs]
+            fields.append(values)
+        return fields
+
+    def build_nodes(self, names, pos):
+        """Adds nodes with the specified names and positions to the grid."""
+        newnodes = [node(name, p) for name,p in zip(names, pos)]
+        for n in newnodes: self.node[n.name] = n
+        self.nodelist += newnodes
+        self.watch_geometry(newnodes)
+
+    def build_columns(self, names, nodes, centres):
+        """Adds columns with the specified names, lists of nodes and centres to the grid.  Columns with centre
+        None have their centres set to their centroids, calculated in bulk."""
+        default_centre = np.zeros(2)
+        newcols = []
+        for name,colnodes,centre in zip(names, nodes, centres):
+            if centre is None:
+                col = column(name, colnodes, default_centre)
+                col.centre_specified = 0
+            else: col = column(name, colnodes, centre)
+            newcols.append(col)
+            self.columnlist.append(col)
+            self.column[name] = col
+            for n in colnodes: n.column.add(col)
+        self.watch_geometry(newcols)
+        if any([centre is None for centre in centres]):
+            centroid = self.arrays.column_centroid[-len(newcols):]
+            for col,c in zip(newcols, centroid):
+                if not col.centre_specified: col.centre = c if col.num_nodes > 0 else None
+
+    def set_column_surfaces(self, cols, surfaces):
+        """Sets surface elevations of the specified columns, and their numbers of layers."""
+        bottom = np.array([lay.bottom for lay in self.layerlist[1:]])
+        num_above = np.searchsorted(-bottom, -np.array(surfaces, dtype = float), side = 'right')
+        for col,surface,n in zip(cols, surfaces, num_above):
+            col.surface = surface
+            col.num_layers = len(bottom) - n
+
     def read_nodes(self,geo):
         """Reads grid nodes from file geo"""
-        line = padstring(geo.readline())
-        while line.strip():
-            [name, x, y] = geo.parse_string(line, 'node')
-            name = name.strip().rjust(self.colname_length)
-            pos = np.array([x, y])*self.unit_scale
-            newnode = node(name,pos)
-            self.add_node(newnode)
-            line=geo.readline()
+        lines = self.read_section(geo)
+        name, x, y = self.parse_section(geo, lines, 'node')
+        names = [n.strip().rjust(self.colname_length) for n in name]
+        pos = np.column_stack((np.array(x, dtype = float), np.array(y, dtype = float))) * self.unit_scale
+        self.build_nodes(names, pos)
 
     def read_columns(self,geo):
         """Reads grid columns from file geo"""
-        line=padstring(geo.readline())
-        while line.strip():
-            [colname, centre_specified, nnodes, centrex, centrey] = geo.parse_string(line, 'column')
-            colname = colname.strip().rjust(self.colname_length)
-            if centre_specified: centre = np.array([centrex, centrey])*self.unit_scale
-            else: centre = None
-            nodes = []
-            for each in xrange(nnodes):
-                [nodename] = geo.read_values('column_node')
-                nodename = nodename.strip().rjust(self.colname_length)
-                colnode = self.node[nodename]
-                nodes.append(colnode)
-            self.add_column(column(colname,nodes,centre))
-            line=geo.readline()
+        lines = self.read_section(geo)
+        names, nodes, centres = [], [], []
+        i = 0
+        while i < len(lines):
+            [colname, centre_specified, nnodes, centrex, centrey] = geo.parse_string(lines[i], 'column')
+            names.append(colname.strip().rjust(self.colname_length))
+            if centre_specified: centres.append(np.array([centrex, centrey])*self.unit_scale)
+            else: centres.append(None)
+            nodes.append([self.node[line[0:3].strip().rjust(self.colname_length)] for line in lines[i+1: i+1+nnodes]])
+            i += 1 + nnodes
+        self.build_columns(names, nodes, centres)
 
     def read_connections(self,geo):
         """Reads grid connections from file geo"""
-        line = padstring(geo.readline())
-        while line.strip():
-            names = geo.parse_string(line, 'connection')
+        lines = self.read_section(geo)
+        for names in zip(*self.parse_section(geo, lines, 'connection')):
             names = [name.strip().rjust(self.colname_length) for name in names]
             cols = [self.column[name] for name in names]
             self.add_connection(connection(cols))
-            line = geo.readline()
         self.identify_neighbours()
 
     def read_layers(self,geo):
         """Reads grid layers from file geo"""
-        line = padstring(geo.readline())
-        while line.strip():
-            name, bottom, centre = geo.parse_string(line, 'layer')
+        lines = self.read_section(geo)
+        for name, bottom, centre in zip(*self.parse_section(geo, lines, 'layer')):
             name = name.strip().rjust(self.layername_length)
             bottom *= self.unit_scale
             newlayer = layer(name,bottom)
@@ -1050,54 +2434,130 @@ class mulgrid(object):
                 if nlayers > 1: centre = 0.5*(newlayer.bottom + self.layerlist[nlayers-2].bottom)
                 else: centre = newlayer.bottom
             newlayer.centre = centre
-            line = geo.readline()
         self.identify_layer_tops()
         self.set_default_surface()
 
     def read_surface(self,geo):
         """Reads grid surface from file geo"""
-        line=padstring(geo.readline())
-        while line.strip():
-            [name, surface] = geo.parse_string(line, 'surface')
-            name = name.strip().rjust(self.colname_length)
-            surface *= self.unit_scale
-            col = self.column[name]
-            col.surface = surface
-            self.set_column_num_layers(col)
-            line = geo.readline()
+        lines = self.read_section(geo)
+        name, surface = self.parse_section(geo, lines, 'surface')
+        cols = [self.column[n.strip().rjust(self.colname_length)] for n in name]
+        self.set_column_surfaces(cols, np.array(surface, dtype = float) * self.unit_scale)
 
     def read_wells(self,geo):
         """Reads grid wells from file geo"""
-        line = padstring(geo.readline())
-        while line.strip():
-            [name, x, y, z] = geo.parse_string(line, 'well')
+        lines = self.read_section(geo)
+        for name, x, y, z in zip(*self.parse_section(geo, lines, 'well')):
             p = np.array([x,y,z])*self.unit_scale
             if name in self.well: self.well[name].pos.append(p)
             else: self.add_well(well(name,[p]))
-            line = geo.readline()
 
-    def read(self,filename):
-        """Reads MULgraph grid from file"""
+    def read(self, filename, cache = False):
+        """Reads MULgraph grid from file.  If cache is True, the grid is restored from a binary cache file (with
+        '.npz' appended to the filename) if it exists and was created from a geometry file with the same contents;
+        otherwise the cache file is written after the grid has been read."""
         self.empty()
+        if cache:
+            cache_filename, filehash = filename + '.npz', file_hash(filename)
+            if self.read_cache(cache_filename, filehash): return self
         geo = fixed_format_file(filename, 'rU', mulgrid_format_specification, self.read_function)
-        self.read_header(geo)
-        if self.type=='GENER':
-            read_fn={'VERTI':self.read_nodes, 'GRID': self.read_columns, 'CONNE': self.read_connections,
-                     'LAYER': self.read_layers, 'SURFA': self.read_surface, 'SURF': self.read_surface,
-                     'WELLS': self.read_wells}
-            more=True
-            while more:
-                line=geo.readline().strip()
-                if line:
-                    keyword=line[0:5].rstrip()
-                    read_fn[keyword](geo)
-                else: more=False
-            self.setup_block_name_index()
-            self.setup_block_connection_name_index()
-        else: print 'Grid type',self.type,'not supported.'
+        with phase('mulgrid.read', geo):
+            self.read_header(geo)
+            if self.type=='GENER':
+                read_fn={'VERTI':self.read_nodes, 'GRID': self.read_columns, 'CONNE': self.read_connections,
+                         'LAYER': self.read_layers, 'SURFA': self.read_surface, 'SURF': self.read_surface,
+                         'WELLS': self.read_wells}
+                more=True
+                while more:
+                    line=geo.readline().strip()
+                    if line:
+                        keyword=line[0:5].rstrip()
+                        read_fn[keyword](geo)
+                    else: more=False
+                self.setup_block_name_index()
+                self.setup_block_connection_name_index()
+            else: print 'Grid type',self.type,'not supported.'
         geo.close()
+        if cache and self.type=='GENER': self.write_cache(cache_filename, filehash)
         return self
 
+    def write_cache(self, filename, filehash):
+        """Writes binary cache file containing the grid in array form, for fast reading."""
+        arrays = self.arrays
+        header = dict([(key, getattr(self, key)) for key in mulgrid_format_specification['header'][0]])
+        wellpos = [p for w in self.welllist for p in w.pos]
+        try:
+            np.savez(filename, version = mulgrid_cache_version, hash = filehash, header = json.dumps(header),
+                     node_name = np.array([n.name for n in self.nodelist], dtype = str),
+                     node_pos = arrays.node_pos,
+                     column_name = np.array([col.name for col in self.columnlist], dtype = str),
+                     column_centre = arrays.column_centre,
+                     column_centre_specified = np.array([col.centre_specified for col in self.columnlist], dtype = int),
+                     column_node_indptr = arrays.column_node_indptr,
+                     column_node_indices = arrays.column_node_indices,
+                     column_surface = arrays.column_surface,
+                     column_default_surface = np.array([col.default_surface for col in self.columnlist], dtype = bool),
+                     connection_columns = arrays.connection_columns,
+                     connection_nodes = arrays.connection_nodes,
+                     layer_name = np.array([lay.name for lay in self.layerlist], dtype = str),
+                     layer_bottom = arrays.layer_bottom, layer_centre = arrays.layer_centre,
+                     well_name = np.array([w.name for w in self.welllist], dtype = str),
+                     well_num_pos = np.array([w.num_pos for w in self.welllist], dtype = int),
+                     well_pos = np.array(wellpos, dtype = float).reshape((-1,3)),
+                     block_name_list = np.array(self.block_name_list, dtype = str),
+                     block_connection_name_list = np.array(self.block_connection_name_list, dtype = str).reshape((-1,2)))
+        except IOError: pass # cache is optional
+
+    def read_cache(self, filename, filehash):
+        """Reads grid from binary cache file, if it exists and was created from a geometry file with the
+        specified hash.  Returns True if the grid was read."""
+        from os.path import isfile
+        if not isfile(filename): return False
+        try: data = np.load(filename)
+        except (IOError, ValueError): return False
+        with data:
+            if int(data['version']) <> mulgrid_cache_version or str(data['hash']) <> filehash: return False
+            self.read_cache_data(data)
+        return True
+
+    def read_cache_data(self, data):
+        """Builds grid from arrays read from binary cache file."""
+        for key, value in json.loads(str(data['header'])).iteritems():
+            setattr(self, key, str(value) if isinstance(value, unicode) else value)
+        self.set_secondary_variables()
+        self.build_nodes(data['node_name'].tolist(), data['node_pos'])
+        indptr, indices = data['column_node_indptr'].tolist(), data['column_node_indices'].tolist()
+        colnodes = [self.nodelist[i] for i in indices]
+        nodes = [colnodes[i0:i1] for i0,i1 in zip(indptr[:-1], indptr[1:])]
+        # cached centres are used for all columns, to avoid recalculating centroids:
+        self.build_columns(data['column_name'].tolist(), nodes, list(data['column_centre']))
+        for col,spec in zip(self.columnlist, data['column_centre_specified'].tolist()): col.centre_specified = spec
+        for (i,j),nodeindices in zip(data['connection_columns'].tolist(), data['connection_nodes'].tolist()):
+            con = connection([self.columnlist[i], self.columnlist[j]])
+            con.node = None if nodeindices[0] < 0 else [self.nodelist[k] for k in nodeindices]
+            self.connectionlist.append(con)
+            self.connection[(con.column[0].name, con.column[1].name)] = con
+            for col in con.column: col.connection.add(con)
+            self.index_connection(con)
+        self.geometry_changed()
+        self.identify_neighbours()
+        for name, bottom, centre in zip(data['layer_name'].tolist(), data['layer_bottom'], data['layer_centre']):
+            self.add_layer(layer(name, bottom, centre))
+        if self.num_layers > 0:
+            self.identify_layer_tops()
+            self.set_default_surface()
+            cols = [col for col,default in zip(self.columnlist, data['column_default_surface']) if not default]
+            surfaces = data['column_surface'][~data['column_default_surface']]
+            self.set_column_surfaces(cols, surfaces)
+        i = 0
+        for name,n in zip(data['well_name'].tolist(), data['well_num_pos']):
+            self.add_well(well(name, list(data['well_pos'][i: i+n])))
+            i += n
+        self.block_name_list = data['block_name_list'].tolist()
+        self.block_name_index = dict([(blk,i) for i,blk in enumerate(self.block_name_list)])
+        self.block_connection_name_list = [tuple(names) for names in data['block_connection_name_list'].tolist()]
+        self.block_connection_name_index = dict([(con,i) for i,con in enumerate(self.block_connection_name_list)])
+
     def block_surface(self,lay,col):
         """Returns elevation of top of block for given layer and column"""
         if lay.name==self.layerlist[0].name:
@@ -1486,15 +2946,15 @@ class mulgrid(object):
         can also be optionally provided, in which case that column and (if necessary) its neighbours will be 
         searched first.  A bounding polygon (or rectangle)for searching within can also optionally be supplied-
         this can, for example, be specified as the boundary polygon of the grid.  A quadtree for searching
-        the columns can also optionally be specified."""
+        the columns can also optionally be specified; otherwise the column R-tree is used."""
         target=None
         if bounds is not None:
             if len(bounds)==2: inbounds=in_rectangle(pos,bounds)
             else: inbounds=in_polygon(pos,bounds)
         else: inbounds=True
         if inbounds:
-            if columns is None: searchcols=self.columnlist
-            else: searchcols=columns
+            if columns is None: searchset=None # search all columns
+            else: searchset=set(columns)
             donecols=set([])
             if guess is not None: 
                 if guess.contains_point(pos): return guess
@@ -1502,7 +2962,8 @@ class mulgrid(object):
                     donecols.add(guess)
                     from copy import copy
                     nbrcols=list(copy(guess.neighbour))
-                    nearnbrcols=[col for col in nbrcols if col.near_point(pos) and col in searchcols]
+                    nearnbrcols=[col for col in nbrcols if col.near_point(pos) and
+                                (searchset is None or col in searchset)]
                     sortindex=np.argsort([norm(col.centre-pos) for col in nearnbrcols])
                     for i in sortindex:
                         if nearnbrcols[i].contains_point(pos): return nearnbrcols[i]
@@ -1510,7 +2971,9 @@ class mulgrid(object):
             # guess was no good- do full search on remaining columns:
             if qtree: return qtree.search(pos)
             else:
-                nearcols=list(set([col for col in searchcols if col.near_point(pos)])-donecols)
+                nearcols=[self.columnlist[i] for i in self.column_rtree.query_point(pos)]
+                if searchset is not None: nearcols=[col for col in nearcols if col in searchset]
+                nearcols=list(set(nearcols)-donecols)
                 sortindex=np.argsort([norm(col.centre-pos) for col in nearcols])
                 for i in sortindex:
                     if nearcols[i].contains_point(pos):
@@ -1518,6 +2981,50 @@ class mulgrid(object):
                         break
         return target
 
+    def column_indices_containing_points(self,points,candidates=8,chunk_size=100000):
+        """Returns an integer array of indices (in the columnlist) of the columns containing each of an array
+        of horizontal points, of shape (number of points, 2), or -1 for points not inside any column.  For each
+        point, the columns with the nearest centres (up to the specified number of candidates) are tested
+        first, using a kd-tree, followed if necessary by all columns with bounding boxes containing the point,
+        found using the column R-tree.  Points are processed in chunks of the specified size, to limit memory
+        usage."""
+        points=np.asarray(points,dtype=float).reshape((-1,2))
+        num_points=len(points)
+        result=-np.ones(num_points,dtype=int)
+        if self.num_columns==0 or num_points==0: return result
+        arrays=self.arrays
+        bounds=arrays.bounds
+        candidates=min(candidates,self.num_columns)
+        for start in xrange(0,num_points,chunk_size):
+            pts=points[start:start+chunk_size]
+            ingrid=np.nonzero(np.all((bounds[0]<=pts)&(pts<=bounds[1]),axis=1))[0]
+            found=np.zeros(len(pts),dtype=bool)
+            if len(ingrid)==0: continue
+            r,nearest=arrays.column_centre_kdtree.query(pts[ingrid],k=candidates)
+            nearest=nearest.reshape((len(ingrid),candidates))
+            for k in xrange(candidates): # test candidate columns in order of distance
+                todo=ingrid[~found[ingrid]]
+                if len(todo)==0: break
+                cols=nearest[~found[ingrid],k]
+                near=arrays.columns_near_points(pts[todo],cols)
+                todo,cols=todo[near],cols[near]
+                inside=arrays.columns_contain_points(pts[todo],cols)
+                result[start+todo[inside]]=cols[inside]
+                found[todo[inside]]=True
+            # search remaining points in all columns with bounding boxes containing them:
+            todo=ingrid[~found[ingrid]]
+            if len(todo)>0:
+                ipt,cols=arrays.column_rtree.query_points(pts[todo])
+                inside=arrays.columns_contain_points(pts[todo[ipt]],cols)
+                ipt,cols=ipt[inside],cols[inside]
+                if len(ipt)>0: # choose column with nearest centre for each point
+                    d=np.sum((arrays.column_centre[cols]-pts[todo[ipt]])**2,axis=1)
+                    order=np.lexsort((d,ipt))
+                    ipt,cols=ipt[order],cols[order]
+                    first=np.concatenate(([True],ipt[1:]<>ipt[:-1]))
+                    result[start+todo[ipt[first]]]=cols[first]
+        return result
+
     def layer_containing_elevation(self,z):
         """Returns layer containing the specified vertical elevation (or None if not found)."""
         target=None
@@ -1527,53 +3034,77 @@ class mulgrid(object):
                 break
         return target
 
-    def column_mapping(self,geo):
+    def column_mapping_indices(self,geo):
+        """Returns integer array of indices of the nearest columns in self to each column in a geometry object geo.
+        If the SciPy library is available, the (cached) KDTree of column centres is used to speed searching."""
+        centres=geo.arrays.column_centre
+        if len(centres)==0: return np.zeros(0,dtype=int)
+        try:
+            r,index=self.arrays.column_centre_kdtree.query(centres)
+        except ImportError: # if don't have SciPy installed:
+            selfcentres=self.arrays.column_centre
+            index=np.array([np.argmin(np.sum((selfcentres-c)**2,axis=1)) for c in centres],dtype=int)
+        return index
+
+    def column_mapping(self,geo,column_indices=None):
         """Returns a dictionary mapping each column name in a geometry object geo to the name of the nearest column in self.
-         If the SciPy library is available, a KDTree structure is used to speed searching."""
+        The corresponding array of column indices (from column_mapping_indices()) may optionally be specified, if it has
+        already been calculated."""
         if self.atmosphere_type==geo.atmosphere_type==0:
             mapping={geo.atmosphere_column_name:self.atmosphere_column_name}
         else: mapping={}
-        try:
-            from scipy.spatial import cKDTree
-            kdtree=cKDTree([col.centre for col in self.columnlist])
-            def closest_col(col):
-                r,i=kdtree.query(col.centre)
-                return self.columnlist[i]
-        except ImportError: # if don't have SciPy installed:
-            def closest_col(col):
-                coldist=np.array([norm(selfcol.centre-col.centre) for selfcol in self.columnlist])
-                return self.columnlist[np.argmin(coldist)]
-        for col in geo.columnlist: mapping[col.name]=closest_col(col).name
+        if column_indices is None: column_indices=self.column_mapping_indices(geo)
+        selfnames=[col.name for col in self.columnlist]
+        for col,i in zip(geo.columnlist,column_indices): mapping[col.name]=selfnames[i]
         return mapping
 
+    def layer_mapping_indices(self,geo):
+        """Returns integer array of indices of the nearest layers in self to each layer in a geometry object geo.
+        The surface layer is mapped to the surface layer."""
+        index=np.zeros(geo.num_layers,dtype=int)
+        if geo.num_layers>1:
+            laydist=np.abs(geo.arrays.layer_centre[1:,np.newaxis]-self.arrays.layer_centre[np.newaxis,1:])
+            index[1:]=1+np.argmin(laydist,axis=1) # (1 added for surface layer, omitted from search)
+        return index
+
     def layer_mapping(self,geo):
         """Returns a dictionary mapping each layer name in a geometry object geo to the name of the nearest layer in self."""
-        mapping={geo.layerlist[0].name: self.layerlist[0].name}  # surface mapped to surface
-        for layer in geo.layerlist[1:]:
-            laydist=np.array([abs(selflay.centre-layer.centre) for selflay in self.layerlist[1:]])
-            closest=self.layerlist[1+np.argmin(laydist)]  # (1 added for surface layer, omitted from search)
-            mapping[layer.name]=closest.name
-        return mapping
-    
+        selfnames=[lay.name for lay in self.layerlist]
+        return dict([(lay.name,selfnames[i]) for lay,i in zip(geo.layerlist,self.layer_mapping_indices(geo))])
+
+    def block_mapping_indices(self,geo,column_mapping=False):
+        """Returns integer array of indices (in the block_name_list) of the nearest blocks in self to each block in a
+        geometry object geo, as for block_mapping(), or -1 for blocks which have no corresponding block in self.  The
+        associated array of column mapping indices can also optionally be returned."""
+        colindex=self.column_mapping_indices(geo)
+        layindex=self.layer_mapping_indices(geo)
+        # atmosphere blocks:
+        if self.atmosphere_type==0: atm=np.zeros(geo.num_atmosphere_blocks,dtype=int)
+        elif self.atmosphere_type==geo.atmosphere_type==1: atm=colindex
+        else: atm=-np.ones(geo.num_atmosphere_blocks,dtype=int)
+        # underground blocks:
+        geolayer,geocol=np.nonzero(geo.arrays.layer_column_block>=0)
+        sourcelayer,sourcecol=layindex[geolayer+1]-1,colindex[geocol]
+        block=self.arrays.layer_column_block
+        present=block>=0
+        # if source block is above surface in column, use first layer below surface instead:
+        above=~present[sourcelayer,sourcecol]
+        sourcelayer[above]=np.argmax(present,axis=0)[sourcecol[above]]
+        index=block[sourcelayer,sourcecol]
+        index=np.concatenate((atm,np.where(index>=0,index+self.num_atmosphere_blocks,-1)))
+        if column_mapping: return (index,colindex)
+        else: return index
+
     def block_mapping(self,geo,column_mapping=False):
         """Returns a dictionary mapping each block name in a geometry object geo to the name of the nearest block in self.
         Columns are given priority over layers, i.e. first the nearest column is found, then the nearest layer for blocks
         in that column.  The associated column mapping can also optionally be returned."""
-        mapping={}
-        col_mapping=self.column_mapping(geo)
-        layer_mapping=self.layer_mapping(geo)
-        for dest in geo.block_name_list:
-            destcol,destlayer=geo.column_name(dest),geo.layer_name(dest)
-            sourcecol,sourcelayer=col_mapping[destcol],layer_mapping[destlayer]
-            if destlayer==geo.layerlist[0].name:
-                sourcelayer=self.layerlist[0].name # atmosphere layer
-                if self.atmosphere_type==0: sourcecol=self.atmosphere_column_name
-            else:
-                # if source block is above surface in column, use first layer below surface instead:
-                if self.column[sourcecol].surface<=self.layer[sourcelayer].bottom:
-                    sourcelayer=self.column_surface_layer(self.column[sourcecol]).name
-            mapping[dest]=self.block_name(sourcelayer,sourcecol)
-        if column_mapping: return (mapping,col_mapping)
+        index,colindex=self.block_mapping_indices(geo,True)
+        mapped=np.nonzero(index>=0)[0]
+        selfnames=np.array(self.block_name_list,dtype=object)
+        geonames=np.array(geo.block_name_list,dtype=object)
+        mapping=dict(zip(geonames[mapped],selfnames[index[mapped]]))
+        if column_mapping: return (mapping,self.column_mapping(geo,colindex))
         else: return mapping
 
     def block_name_containing_point(self, pos, qtree = None, blockmap = {}):
@@ -1583,9 +3114,34 @@ class mulgrid(object):
         if col:
             if self.layerlist[0].bottom < pos[2] <= col.surface: layer = self.layerlist[1] 
             else: layer = self.layer_containing_elevation(pos[2])
-            if (col.surface > layer.bottom): blkname = self.block_name(layer.name, col.name, blockmap)
+            if layer and (col.surface > layer.bottom): blkname = self.block_name(layer.name, col.name, blockmap)
         return blkname
 
+    def block_indices_containing_points(self,points,chunk_size=100000):
+        """Returns an integer array of indices (in the block_name_list) of the blocks containing each of an array
+        of 3D points, of shape (number of points, 3), or -1 for points outside the grid.  As for
+        block_name_containing_point(), points between the top of the uppermost layer and the surface of a column
+        are located in the uppermost layer."""
+        points=np.asarray(points,dtype=float).reshape((-1,3))
+        result=-np.ones(len(points),dtype=int)
+        if self.num_layers<2: return result
+        icol=self.column_indices_containing_points(points[:,0:2],chunk_size=chunk_size)
+        arrays=self.arrays
+        inside=np.nonzero(icol>=0)[0]
+        icol,z=icol[inside],points[inside,2]
+        bottom=arrays.layer_bottom[1:]
+        ground=arrays.layer_bottom[0]
+        with np.errstate(invalid='ignore'):
+            surface=arrays.column_surface[icol]
+            below_surface=(ground<z)&(z<=surface)
+        ilayer=np.searchsorted(-bottom,-z)
+        ilayer[below_surface]=0
+        valid=(ilayer<len(bottom))&((z<=ground)|below_surface)
+        inside,icol,ilayer=inside[valid],icol[valid],ilayer[valid]
+        block=arrays.layer_column_block[ilayer,icol]
+        result[inside]=np.where(block>=0,block+self.num_atmosphere_blocks,-1)
+        return result
+
     def block_contains_point(self,blockname,pos):
         """Returns True if the block with specified name contains the specified 3D point."""
         result=False
@@ -1600,48 +3156,69 @@ class mulgrid(object):
                         result=col.contains_point(pos[0:2])
         return result
 
+    def bisection_start_points(self,lines,max_levels=7):
+        """For each of a list of lines, returns a tuple of (point,column) for the first midpoint, found by
+        recursive bisection of the line (depth-first, up to the specified maximum level), that lies inside the
+        grid, or (None,None) if there is none.  The midpoints of all lines are located together."""
+        if not lines: return []
+        num_levels=max_levels+2
+        ends=np.array(lines,dtype=float)
+        mids=[]
+        for level in xrange(num_levels):
+            m=0.5*(ends[:,:-1]+ends[:,1:])
+            mids.append(m)
+            e=np.empty((len(lines),2*ends.shape[1]-1,2))
+            e[:,0::2],e[:,1::2]=ends,m
+            ends=e
+        mids=np.concatenate(mids,axis=1) # midpoints at each level, in order along line
+        cols=self.column_indices_containing_points(mids.reshape((-1,2))).reshape(mids.shape[0:2])
+        order=[]
+        def preorder(level,k):
+            order.append(2**level-1+k)
+            if level<num_levels-1:
+                preorder(level+1,2*k)
+                preorder(level+1,2*k+1)
+        preorder(0,0)
+        order=np.array(order)
+        result=[]
+        for linemids,linecols in zip(mids,cols):
+            found=np.nonzero(linecols[order]>=0)[0]
+            if len(found)>0:
+                k=order[found[0]]
+                result.append((linemids[k],self.columnlist[linecols[k]]))
+            else: result.append((None,None))
+        return result
+
     def column_track(self,line):
         """Returns a list of tuples of (column,entrypoint,exitpoint) representing the horizontal track traversed by the
         specified line through the grid.  Line is a tuple of two 2D arrays.  The resulting list is ordered by distance
         from the start of the line."""
-
-        def furthest_intersection(poly,line):
-            """Returns furthest intersection point between line and poly."""
-            pts,inds = line_polygon_intersections(poly, line, bound_line=(True,False), indices=True)
-            if pts:
-                d = np.array([np.linalg.norm(intpt-line[0]) for intpt in pts])
-                i = np.argmax(d)
-                return pts[i],inds[i]
-            else: return None,None
-
-        def find_track_start(line):
+        return self.column_tracks([line])[0]
+
+    def column_tracks(self,lines):
+        """Returns a list of column tracks (as returned by column_track()) for each of a list of lines.  The
+        columns containing the line end points are found together, and the tracks are traversed using the
+        half-edge table of column side neighbours, so this is much faster than calling column_track() for
+        each line, e.g. when computing tracks for many slice lines."""
+        arrays=self.arrays
+        lines=[[np.array(pt,dtype=float) for pt in line] for line in lines]
+        endcols=self.column_indices_containing_points([pt for line in lines for pt in line]).reshape((-1,2))
+        colindex=dict([(id(col),i) for i,col in enumerate(self.columnlist)])
+        side_neighbour=arrays.column_side_neighbour
+        midlines=[line for line,linecols in zip(lines,endcols) if all(linecols<0)]
+        midstart=deque(self.bisection_start_points(midlines))
+
+        def find_track_start(line,linecols):
             """Finds starting point for track- an arbitrary point on the line that is inside
             the grid.  If the start point of the line is inside the grid, that is used;
-            otherwise, a recursive bisection technique is used to find a point."""
+            otherwise, a point found by recursive bisection is used."""
             col,start_type = None,None
-            for endpt,name in zip(line,['start','end']):
-                pos,col,start_type= endpt,self.column_containing_point(endpt),name
+            for endpt,icol,name in zip(line,linecols,['start','end']):
+                pos,col,start_type= endpt,self.columnlist[icol] if icol>=0 else None,name
                 if col: break
             if not col: # line ends are both outside the grid:
                 start_type = 'mid'
-                max_levels = 7
-
-                def find_start(line,level=0):
-                    midpt = 0.5*(line[0] + line[1])
-                    col = self.column_containing_point(midpt)
-                    if col: return midpt,col
-                    else:
-                        if level <= max_levels:
-                            line0,line1 = [line[0],midpt],[midpt,line[1]]
-                            pos,col = find_start(line0,level+1)
-                            if col: return pos,col
-                            else:
-                                pos,col = find_start(line1,level+1)
-                                if col: return pos,col
-                                else: return None,None
-                        else: return None,None
-
-                pos,col = find_start(line)
+                pos,col = midstart.popleft()
             return pos,col,start_type
 
         def next_corner_column(col,pos,more,cols):
@@ -1666,11 +3243,13 @@ class mulgrid(object):
         def find_track_segment(linesegment,pos,col):
             """Finds track segment starting from the specified position and column."""
             track = []
-            cols, more, inpos, colnbr = set(), True, pos, col.neighbourlist
+            cols, more, inpos = set(), True, pos
             lined = np.linalg.norm(linesegment[1] - linesegment[0])
             while more:
                 cols.add(col)
-                outpos, ind = furthest_intersection(col.polygon,linesegment)
+                nextcol = None
+                icol = colindex[id(col)]
+                outpos, ind = arrays.column_furthest_intersection(icol,linesegment)
                 if outpos is not None:
                     d = np.linalg.norm(outpos - linesegment[0])
                     if d >= lined: # gone past end of line
@@ -1679,7 +3258,8 @@ class mulgrid(object):
                     if np.linalg.norm(outpos - inpos) > 0.: track.append(tuple([col,inpos,outpos]))
                     if more: # find next column
                         inpos = outpos
-                        nextcol = colnbr[ind]
+                        inbr = side_neighbour[arrays.column_node_indptr[icol]+ind]
+                        nextcol = self.columnlist[inbr] if inbr>=0 else None
                         if nextcol:
                             if nextcol in cols:
                                 nextcol, more = next_corner_column(col, outpos, more, cols)
@@ -1690,28 +3270,30 @@ class mulgrid(object):
                 else:
                     nextcol, more = next_neighbour_column(nbr_base_col, more, cols)
                 col = nextcol
-                if col: colnbr = col.neighbourlist
-                else: more = False
+                if not col: more = False
 
             return track
 
         def reverse_track(track): return [tuple([tk[0],tk[2],tk[1]]) for tk in track][::-1]
 
-        pos,col,start_type = find_track_start(line)
-        if pos is not None and col:
-            if start_type=='start':
-                track = find_track_segment(line,pos,col)
-            elif start_type=='end':
-                track = find_track_segment(line[::-1],pos,col)
-                track = reverse_track(track)
-            else:
-                track1 = find_track_segment([pos,line[0]],pos,col)
-                track2 = find_track_segment([pos,line[1]],pos,col)
-                # remove arbitrary starting point from middle of track, and join:
-                midtk = tuple([track1[0][0], track1[0][2], track2[0][2]])
-                track = reverse_track(track1)[:-1] + [midtk] +track2[1:]
-            return track
-        else: return []
+        tracks=[]
+        for line,linecols in zip(lines,endcols):
+            pos,col,start_type = find_track_start(line,linecols)
+            if pos is not None and col:
+                if start_type=='start':
+                    track = find_track_segment(line,pos,col)
+                elif start_type=='end':
+                    track = find_track_segment(line[::-1],pos,col)
+                    track = reverse_track(track)
+                else:
+                    track1 = find_track_segment([pos,line[0]],pos,col)
+                    track2 = find_track_segment([pos,line[1]],pos,col)
+                    # remove arbitrary starting point from middle of track, and join:
+                    midtk = tuple([track1[0][0], track1[0][2], track2[0][2]])
+                    track = reverse_track(track1)[:-1] + [midtk] +track2[1:]
+                tracks.append(track)
+            else: tracks.append([])
+        return tracks
 
     def layer_plot_wells(self, plt, ax, layer, wells, well_names, hide_wells_outside, wellcolour, welllinewidth, wellname_bottom):
         """Draws wells on a layer plot, given the plot and axes.  For documentation of the parameters, see layer_plot()."""
@@ -1814,6 +3396,46 @@ class mulgrid(object):
                            scale_units = 'width', width = arrow_width)
             qk = plt.quiverkey(Q, flow_scale_pos[0], flow_scale_pos[1], flow_scale, key_str)
 
+    def layer_plot_layer(self, layer):
+        """Returns the layer to be plotted in a layer plot and the default plot title, given a layer, layer name,
+        elevation or None (for the ground surface)."""
+        if isinstance(layer,(float,int)):
+            layer_elev = layer
+            layer = self.layer_containing_elevation(float(layer))
+            if layer: default_title = 'layer '+layer.name+' (elevation '+("%4.0f"%float(layer_elev)).strip()+' m)'
+            else: raise Exception("Layer elevation out of range in layer_plot()")
+        elif layer is None: default_title = 'surface layer'
+        elif layer in self.layerlist: default_title = 'layer '+layer.name
+        elif layer in self.layer:
+            layer = self.layer[layer]
+            default_title = 'layer '+layer.name
+        else: raise Exception("Unknown layer in layer_plot()")
+        return layer, default_title
+
+    def layer_plot_scene(self, layer = 0, xlabel = 'x (m)', ylabel = 'y (m)', aspect = 'equal'):
+        """Returns a plot_scene object containing the precomputed polygons of a layer plot (see layer_plot()),
+        which can be drawn and then efficiently updated with new values, e.g. for animations."""
+        layer, default_title = self.layer_plot_layer(layer)
+        arrays = self.arrays
+        natm = self.num_atmosphere_blocks
+        colindex = np.arange(self.num_columns)
+        if layer is None: # surface block of each column
+            present = arrays.layer_column_block >= 0
+            block = arrays.layer_column_block[np.argmax(present, axis = 0), colindex]
+            block = np.where(np.any(present, axis = 0), block + natm, -1)
+        else:
+            ilayer = self.layerlist.index(layer)
+            if ilayer > 0:
+                block = arrays.layer_column_block[ilayer - 1]
+                block = np.where(block >= 0, block + natm, -1)
+            elif self.atmosphere_type == 0: block = np.zeros(self.num_columns, dtype = int)
+            elif self.atmosphere_type == 1: block = colindex
+            else: block = -np.ones(self.num_columns, dtype = int)
+        cols = colindex[block >= 0]
+        verts = np.split(arrays.column_node_pos, arrays.column_node_indptr[1:-1])
+        return plot_scene([verts[i] for i in cols], block[cols], cols, self.num_blocks, self.num_columns,
+                          default_title, xlabel, ylabel, aspect)
+
     def layer_plot(self, layer=0, variable=None, variable_name=None, unit=None, column_names=None, node_names=None, column_centres=None,
                    nodes=None, colourmap=None, linewidth=0.2, linecolour='black', aspect='equal', plt=None, subplot=111, title=None,
                    xlabel='x (m)', ylabel='y (m)', contours=False, contour_label_format='%3.0f', contour_grid_divisions=(100,100),
@@ -1835,17 +3457,7 @@ class mulgrid(object):
         else: loneplot = False
         matplotlib.rcParams.update({'mathtext.default': 'regular','figure.figsize':(12,9)})
         ax = plt.subplot(subplot,aspect = aspect)
-        if isinstance(layer,(float,int)):
-            layer_elev = layer
-            layer = self.layer_containing_elevation(float(layer))
-            if layer: default_title = 'layer '+layer.name+' (elevation '+("%4.0f"%float(layer_elev)).strip()+' m)'
-            else: raise Exception("Layer elevation out of range in layer_plot()")
-        elif layer is None: default_title = 'surface layer'
-        elif layer in self.layerlist: default_title = 'layer '+layer.name
-        elif layer in self.layer:
-            layer = self.layer[layer]
-            default_title = 'layer '+layer.name
-        else: raise Exception("Unknown layer in layer_plot()")
+        layer, default_title = self.layer_plot_layer(layer)
         if variable is not None:
             if len(variable)==self.num_columns: variable = self.column_values_to_block(variable)
         if variable_name: varname = variable_name
@@ -2047,22 +3659,9 @@ class mulgrid(object):
                         ax.text(nameposp[0], nameposp[1], well.name, clip_on = True,
                                 horizontalalignment = 'center', verticalalignment = namealign)
 
-    def slice_plot(self, line=None, variable=None, variable_name=None, unit=None, block_names=None, colourmap=None, linewidth=0.2,
-                   linecolour='black', aspect='auto', plt=None, subplot=111, title=None, xlabel=None, ylabel='elevation (m)',
-                   contours=False, contour_label_format='%3.0f', contour_grid_divisions=(100,100), colourbar_limits=None,
-                   plot_limits=None, column_axis = False, layer_axis = False, wells = None, well_names = True,
-                   hide_wells_outside = False, wellcolour = 'blue', welllinewidth = 1.0, wellname_bottom = False,
-                   rocktypes = None, allrocks = False, rockgroup = None, flow = None, grid = None, flux_matrix = None,
-                   flow_variable_name = None, flow_unit = None, flow_scale = None, flow_scale_pos = (0.5, 0.02),
-                   flow_arrow_width = None, connection_flows = False, blockmap = {}):
-        """Produces a vertical slice plot of a Mulgraph grid, shaded by the specified variable (an array of values for each block).
-       A unit string can be specified for annotation.  Block names can be optionally superimposed, and the colour 
-       map, linewidth, aspect ratio, colour-bar limits and plot limits specified.
-       If no variable is specified, only the grid is drawn, without shading.  If no line is specified, a slice
-       through the grid bounds is made (bottom left to top right).
-       If a string 'x' or 'y' is passed in instead of a line, a plot is made through the centre of the grid along
-       the x- or y-axes, and the coordinate along the slice represents the actual x- or y- coordinate.  If a northing
-       (float, in degrees) is passed instead of a line, a plot is made through the centre along the specified northing direction."""
+    def slice_plot_line(self, line):
+        """Returns the horizontal line for a slice plot and the default plot title, given a line, axis string
+        ('x' or 'y'), northing (in degrees) or None (for a line across the grid bounds)."""
         if line is None:
             l=self.bounds
             default_title='vertical slice across grid bounds'
@@ -2085,6 +3684,54 @@ class mulgrid(object):
         else:
             l=line
             default_title='vertical slice from ('+("%7.0f"%l[0][0]).strip()+','+("%7.0f"%l[0][1]).strip()+') to ('+("%7.0f"%l[1][0]).strip()+','+("%7.0f"%l[1][1]).strip()+')'
+        return l, default_title
+
+    def slice_plot_scene(self, line = None, xlabel = None, ylabel = 'elevation (m)', aspect = 'auto'):
+        """Returns a plot_scene object containing the precomputed polygons of a vertical slice plot (see
+        slice_plot()), which can be drawn and then efficiently updated with new values, e.g. for animations."""
+        l, default_title = self.slice_plot_line(line)
+        if norm(l[1]-l[0]) > 0.0: track = self.column_track(l)
+        else: track = []
+        if xlabel is None:
+            if line=='x': xlabel='x (m)'
+            elif line=='y': xlabel='y (m)'
+            else: xlabel='distance (m)'
+        colindex = dict([(id(col),i) for i,col in enumerate(self.columnlist)])
+        verts, blocks, columns = [], [], []
+        for trackitem in track:
+            col,points=trackitem[0],trackitem[1:]
+            inpoint=points[0]
+            if len(points)>1: outpoint=points[1]
+            else: outpoint=inpoint
+            if line=='x': din,dout=inpoint[0],outpoint[0]
+            elif line=='y': din,dout=inpoint[1],outpoint[1]
+            else: din,dout=norm(inpoint-l[0]),norm(outpoint-l[0])
+            for lay in self.layerlist[1:]:
+                if col.surface>lay.bottom:
+                    top = self.block_surface(lay,col)
+                    verts.append(((din,lay.bottom),(din,top),(dout,top),(dout,lay.bottom)))
+                    blocks.append(self.block_name_index[self.block_name(lay.name,col.name)])
+                    columns.append(colindex[id(col)])
+        return plot_scene(verts, blocks, columns, self.num_blocks, self.num_columns, default_title, xlabel, ylabel,
+                          aspect)
+
+    def slice_plot(self, line=None, variable=None, variable_name=None, unit=None, block_names=None, colourmap=None, linewidth=0.2,
+                   linecolour='black', aspect='auto', plt=None, subplot=111, title=None, xlabel=None, ylabel='elevation (m)',
+                   contours=False, contour_label_format='%3.0f', contour_grid_divisions=(100,100), colourbar_limits=None,
+                   plot_limits=None, column_axis = False, layer_axis = False, wells = None, well_names = True,
+                   hide_wells_outside = False, wellcolour = 'blue', welllinewidth = 1.0, wellname_bottom = False,
+                   rocktypes = None, allrocks = False, rockgroup = None, flow = None, grid = None, flux_matrix = None,
+                   flow_variable_name = None, flow_unit = None, flow_scale = None, flow_scale_pos = (0.5, 0.02),
+                   flow_arrow_width = None, connection_flows = False, blockmap = {}):
+        """Produces a vertical slice plot of a Mulgraph grid, shaded by the specified variable (an array of values for each block).
+       A unit string can be specified for annotation.  Block names can be optionally superimposed, and the colour 
+       map, linewidth, aspect ratio, colour-bar limits and plot limits specified.
+       If no variable is specified, only the grid is drawn, without shading.  If no line is specified, a slice
+       through the grid bounds is made (bottom left to top right).
+       If a string 'x' or 'y' is passed in instead of a line, a plot is made through the centre of the grid along
+       the x- or y-axes, and the coordinate along the slice represents the actual x- or y- coordinate.  If a northing
+       (float, in degrees) is passed instead of a line, a plot is made through the centre along the specified northing direction."""
+        l, default_title = self.slice_plot_line(line)
         if norm(l[1]-l[0])>0.0:
             import matplotlib
             if plt is None:
@@ -2241,36 +3888,148 @@ class mulgrid(object):
 
     def line_values(self,start,end,variable,divisions=100,coordinate=False,qtree=None):
         """Gets values of variable along specified line through geometry.  Returns two arrays for
-        distance along line (or specified coordinate) and value at each position."""
+        distance along line (or specified coordinate) and value at each position.  The qtree parameter
+        is not used, and is retained for compatibility."""
+        x,blocks=self.line_sample_blocks(start,end,divisions,coordinate)
+        return x,np.asarray(variable)[blocks]
+
+    def line_sample_blocks(self,start,end,divisions=100,coordinate=False):
+        """Returns arrays of distance along line (or specified coordinate) and block index (in the
+        block_name_list) for points at the specified number of divisions along a line through the grid,
+        omitting points outside the grid."""
         if isinstance(start,(list,tuple)): start=np.array(start)
         if isinstance(end,(list,tuple)): end=np.array(end)
-        x,y=[],[]
+        x,blocks=np.zeros(0),np.zeros(0,dtype=int)
         line_length=norm(end-start)
         if line_length>0.0:
-            for i in xrange(divisions+1):
-                xi=float(i)/divisions
-                pos=(1.-xi)*start+xi*end
-                dist=xi*line_length
-                blkname=self.block_name_containing_point(pos,qtree=qtree)
-                if blkname:
-                    if coordinate != None: x.append(pos[coordinate])
-                    else: x.append(dist)
-                    y.append(variable[self.block_name_index[blkname]])
-        return np.array(x),np.array(y)
+            xi=np.arange(divisions+1,dtype=float)/divisions
+            pos=np.outer(1.-xi,start)+np.outer(xi,end)
+            blkindex=self.block_indices_containing_points(pos)
+            inside=blkindex>=0
+            if coordinate is False or coordinate is None: x=xi[inside]*line_length
+            else: x=pos[inside,coordinate]
+            blocks=blkindex[inside]
+        return x,blocks
 
     def polyline_values(self,polyline,variable,divisions=100,coordinate=False,qtree=None):
         """Gets values of a variable along a specified polyline, returning two arrays for distance along the polyline and value."""
-        x,y=[],[]
+        x,blocks=self.polyline_sample_blocks(polyline,divisions,coordinate)
+        return x,np.asarray(variable)[blocks]
+
+    def polyline_sample_blocks(self,polyline,divisions=100,coordinate=False):
+        """Returns arrays of distance along polyline (or specified coordinate) and block index (in the
+        block_name_list) for points at the specified number of divisions along each polyline segment,
+        omitting points outside the grid."""
+        x,blocks=[],[]
         for i in xrange(len(polyline)-1):
             start,end=polyline[i],polyline[i+1]
-            xi,yi=self.line_values(start,end,variable,divisions,coordinate,qtree=qtree)
+            xi,bi=self.line_sample_blocks(start,end,divisions,coordinate)
             if i>0:
-                xi=xi[1:]; yi=yi[1:]
+                xi=xi[1:]; bi=bi[1:]
             if not coordinate:
                 if len(x)>0: xi+=x[-1]  # add end distance from last segment
             x+=list(xi)
-            y+=list(yi)
-        return np.array(x),np.array(y)
+            blocks+=list(bi)
+        return np.array(x),np.array(blocks,dtype=int)
+
+    def polyline_block_track(self,polyline):
+        """Returns the exact sequence of blocks traversed by a 3D polyline (list of 3D points) through the grid,
+        as a tuple of three arrays: block indices (in the block_name_list), and the distances along the polyline
+        at which each block is entered and exited.  These are calculated from the column track of each polyline
+        segment and the layer elevations in each column.  Results for the most recently used polylines are
+        cached (until the grid geometry changes, or clear_block_tracks() is called), so repeated calls with the
+        same polyline, e.g. for different time steps, are fast."""
+        polyline=[np.array(pt,dtype=float) for pt in polyline]
+        key=(self.atmosphere_type,tuple(tuple(pt) for pt in polyline))
+        return self.arrays.block_track(key,lambda: self.calculate_polyline_block_track(polyline))
+
+    def clear_block_tracks(self):
+        """Clears cached polyline and well block tracks, and well sample blocks."""
+        self.arrays.block_tracks.clear()
+
+    def calculate_polyline_block_track(self,polyline):
+        """Calculates block track for polyline_block_track()."""
+        blocks,entry,exit=[],[],[]
+        if self.num_layers<2: return np.zeros(0,dtype=int),np.zeros(0),np.zeros(0)
+        arrays=self.arrays
+        column_index=dict([(id(col),i) for i,col in enumerate(self.columnlist)])
+        segments=zip(polyline[:-1],polyline[1:])
+        horizontal=[norm(p1[0:2]-p0[0:2])>0. for p0,p1 in segments]
+        tracks=self.column_tracks([[p0[0:2],p1[0:2]] for (p0,p1),h in zip(segments,horizontal) if h])
+        vertical_cols=self.column_indices_containing_points([p0[0:2] for (p0,p1),h in zip(segments,horizontal)
+                                                            if not h])
+        block=arrays.layer_column_block
+        bottom,top=arrays.layer_bottom[1:],arrays.layer_top[1:]
+        atmosphere_blocks=self.num_atmosphere_blocks
+        distance=0.
+        for (p0,p1),h in zip(segments,horizontal):
+            length=norm(p1-p0)
+            # column pieces of segment, with start and end parameters along segment:
+            if h:
+                hlength=norm(p1[0:2]-p0[0:2])
+                track=tracks.pop(0)
+                icol=np.array([column_index[id(item[0])] for item in track],dtype=int)
+                ta=np.array([norm(item[1]-p0[0:2]) for item in track])/hlength
+                tb=np.array([norm(item[2]-p0[0:2]) for item in track])/hlength
+            else:
+                icol,vertical_cols=vertical_cols[0:1],vertical_cols[1:]
+                icol=icol[icol>=0]
+                ta,tb=np.zeros(len(icol)),np.ones(len(icol))
+            if length>0. and len(icol)>0:
+                present=block[:,icol].T>=0 # (pieces, layers)
+                # top of column's uppermost block extends to column surface, if above ground:
+                surface_layer=np.argmax(present,axis=1)
+                coltop=np.tile(top,(len(icol),1))
+                coltop[np.arange(len(icol)),surface_layer]=np.maximum(top[surface_layer],arrays.column_surface[icol])
+                dz=p1[2]-p0[2]
+                za,zb=p0[2]+ta*dz,p0[2]+tb*dz
+                zmin,zmax=np.minimum(za,zb)[:,np.newaxis],np.maximum(za,zb)[:,np.newaxis]
+                zlo,zhi=np.maximum(bottom,zmin),np.minimum(coltop,zmax)
+                if dz<>0.:
+                    overlap=present&(zhi>zlo)
+                    t0,t1=(zlo-p0[2])/dz,(zhi-p0[2])/dz
+                    tin,tout=np.minimum(t0,t1),np.maximum(t0,t1)
+                else: # horizontal segment- first layer containing elevation (from top):
+                    inlayer=present&(bottom<=zmin)&(zmin<=coltop)
+                    overlap=inlayer&(np.cumsum(inlayer,axis=1)==1)
+                    tin,tout=np.tile(ta[:,np.newaxis],(1,len(bottom))),np.tile(tb[:,np.newaxis],(1,len(bottom)))
+                ipiece,ilayer=np.nonzero(overlap)
+                tin=np.maximum(tin[ipiece,ilayer],ta[ipiece])
+                tout=np.minimum(tout[ipiece,ilayer],tb[ipiece])
+                order=np.lexsort((tin,ipiece))
+                blocks+=list(block[ilayer,icol[ipiece]][order]+atmosphere_blocks)
+                entry+=list(distance+tin[order]*length)
+                exit+=list(distance+tout[order]*length)
+            distance+=length
+        blocks,entry,exit=np.array(blocks,dtype=int),np.array(entry),np.array(exit)
+        if len(blocks)>1: # join pieces of the same block at polyline nodes:
+            join=np.concatenate(([False],(blocks[1:]==blocks[:-1])&(entry[1:]==exit[:-1])))
+            keep=np.nonzero(~join)[0]
+            last=np.concatenate((keep[1:]-1,[len(blocks)-1]))
+            blocks,entry,exit=blocks[keep],entry[keep],exit[last]
+        return blocks,entry,exit
+
+    def line_block_track(self,start,end):
+        """Returns the exact sequence of blocks traversed by a 3D line through the grid (see polyline_block_track())."""
+        return self.polyline_block_track([start,end])
+
+    def polyline_profile(self,polyline,variable):
+        """Returns piecewise-constant profile of a variable (or variables) along a 3D polyline through the grid,
+        as two arrays: distances along the polyline, and values.  The distances array contains the entry and
+        exit distances of each block traversed, and the values array contains the corresponding block values
+        (repeated at entry and exit).  The variable can be an array with a value for each block, or a
+        two-dimensional array (or list of arrays) for several variables, in which case the values array has
+        a row for each variable."""
+        blocks,entry,exit=self.polyline_block_track(polyline)
+        variable=np.asarray(variable)
+        x=np.column_stack((entry,exit)).ravel()
+        y=np.repeat(variable[...,blocks],2,axis=-1)
+        return x,y
+
+    def line_profile(self,start,end,variable):
+        """Returns piecewise-constant profile of a variable (or variables) along a 3D line through the grid
+        (see polyline_profile())."""
+        return self.polyline_profile([start,end],variable)
 
     def well_values(self,well_name,variable,divisions=1,elevation=False,deviations=False,qtree=None,extend=False):
         """Gets values of a variable down a specified well, returning distance down the well 
@@ -2281,19 +4040,59 @@ class mulgrid(object):
         else: coordinate=False
         if well_name in self.well: 
             well=self.well[well_name]
-            if deviations:
-                from copy import copy
-                polyline=copy(well.pos)
-                grid_bottom=self.layerlist[-1].bottom
-                if extend and well.bottom[2]>grid_bottom: polyline.append(well.elevation_pos(grid_bottom,extend=True))
-            else:
-                polyline=[]
-                for layer in self.layerlist:
-                    p=well.elevation_pos(layer.centre,extend=extend)
-                    if p is not None: polyline.append(p)
-            return self.polyline_values(polyline,variable,divisions,coordinate,qtree=qtree)
+            polyline=self.well_polyline(well,deviations,extend)
+            # block indices of sample points are cached with the block tracks (see polyline_block_track()):
+            key=('well_values',self.atmosphere_type,tuple(tuple(p) for p in polyline),divisions,coordinate)
+            x,blocks=self.arrays.block_track(key,lambda: self.polyline_sample_blocks(polyline,divisions,coordinate))
+            return x.copy(),np.asarray(variable)[blocks]
         else: return None
 
+    def well_polyline(self,well,deviations=True,extend=False):
+        """Returns a polyline (list of 3D points) representing the track of a well, taken either from the nodes
+        of the well deviations, or from the intersections of the well with the grid layer centres (if deviations
+        is False).  If extend is True, the well track is extended to the bottom of the model."""
+        if deviations:
+            polyline=list(well.pos)
+            grid_bottom=self.layerlist[-1].bottom
+            if extend and well.bottom[2]>grid_bottom: polyline.append(well.elevation_pos(grid_bottom,extend=True))
+        else:
+            polyline=[]
+            for layer in self.layerlist:
+                p=well.elevation_pos(layer.centre,extend=extend)
+                if p is not None: polyline.append(p)
+        return polyline
+
+    def well_block_track(self,well_name,extend=False):
+        """Returns the exact track of blocks intersected by a well, calculated from the nodes of the well
+        deviations, as a tuple of five arrays: block indices (in the block_name_list), downhole depths of the
+        top and bottom of the well in each block, and the corresponding elevations.  If extend is True, the
+        well track is extended to the bottom of the model.  Tracks are cached until the well or grid geometry
+        changes (see polyline_block_track())."""
+        polyline=self.well_polyline(self.well[well_name],True,extend)
+        blocks,top,bottom=self.polyline_block_track(polyline)
+        depth=np.cumsum([0.]+[norm(p1-p0) for p0,p1 in zip(polyline[:-1],polyline[1:])])
+        z=[p[2] for p in polyline]
+        return blocks,top,bottom,np.interp(top,depth,z),np.interp(bottom,depth,z)
+
+    def well_profiles(self,variable,well_names=None,elevation=False,extend=False):
+        """Returns a dictionary of exact piecewise-constant profiles of a variable down the specified wells (all
+        wells by default), keyed by well name.  Each profile is a tuple of two arrays, for downhole depth (or
+        elevation) and value, at the top and bottom of each block intersected by the well (see
+        well_block_track()).  The variable can be an array of block values, or a two-dimensional array (e.g. a
+        history of block values, with a row for each time), in which case the value arrays have a row for
+        each row of the variable.  Values for all wells are extracted in a single array operation."""
+        if well_names is None: well_names=[wl.name for wl in self.welllist]
+        tracks=[self.well_block_track(name,extend) for name in well_names]
+        blocks=np.concatenate([track[0] for track in tracks]+[np.zeros(0,dtype=int)])
+        values=np.repeat(np.asarray(variable)[...,blocks],2,axis=-1)
+        split=np.cumsum([2*len(track[0]) for track in tracks])[:-1]
+        profiles={}
+        for name,track,vals in zip(well_names,tracks,np.split(values,split,axis=-1)):
+            if elevation: x=np.column_stack((track[3],track[4])).ravel()
+            else: x=np.column_stack((track[1],track[2])).ravel()
+            profiles[name]=(x,vals)
+        return profiles
+
     def column_values(self, col, variable, depth = False):
         """Gets values of a variable down a specified column in the grid, returning elevation
         (or depth) and value."""
@@ -2346,14 +4145,17 @@ class mulgrid(object):
         if loneplot: plt.show()
 
     def optimize(self, nodenames=None, connection_angle_weight=1.0, column_aspect_weight=0.0, column_skewness_weight=0.0,
-                 pest=False):
+                 pest=False, processes=1):
         """Adjusts positions of specified nodes to optimize grid.  If nodenames list is not specified,
         all node positions are optimized.  Grid quality can be defined as a combination of connection
         angle cosine, column aspect ratio and column skewness.  Increasing the weight for any of these
         increases its importance in the evaluation of grid quality.
         Note that an error will result if the connection angle weight and either of the other weights is set to zero- in
         this case there are not enough constraints to fit the parameters.
-        If pest is set to True, the PEST parameter estimation software is used to perform the optimization."""
+        If pest is set to True, the PEST parameter estimation software is used to perform the optimization.  Otherwise,
+        the optimization is carried out by a grid_optimizer object, using vectorized residuals and an analytic sparse
+        Jacobian matrix.  If processes is greater than 1, groups of nodes which can be optimized independently of each
+        other (e.g. in separate regions of the grid) are optimized in parallel by that many worker processes."""
         if nodenames is None: nodenames=self.node.keys()
         # identify which columns are affected:
         colnames = [col.name for col in self.columnlist if (set(nodenames) & set([node.name for node in col.node]))]
@@ -2469,35 +4271,57 @@ class mulgrid(object):
                 self.column[colname].get_area()
             self.filename = original_filename
         else:
-            from scipy.optimize import leastsq
-            num_nodes = len(nodenames)
-            def update_grid(x):
-                xpos = x.reshape((num_nodes,2))
-                for nodename,pos in zip(nodenames,xpos):
+            weights = (connection_angle_weight, column_aspect_weight, column_skewness_weight)
+            if processes > 1: groups = self.optimize_node_groups(nodenames, connection_angle_weight > 0.0)
+            else: groups = [nodenames]
+            optimizers = [grid_optimizer(self, group, *weights) for group in groups]
+            if processes > 1 and len(optimizers) > 1:
+                from multiprocessing import Pool
+                pool = Pool(min(processes, len(optimizers)))
+                try: results = pool.map(solve_grid_optimizer, optimizers)
+                finally:
+                    pool.close()
+                    pool.join()
+            else: results = [optimizer.solve() for optimizer in optimizers]
+            for optimizer, x in zip(optimizers, results):
+                for nodename, pos in zip(optimizer.nodenames, x.reshape((-1,2))):
                     self.node[nodename].pos = pos
-                for colname in colnames:
-                    self.column[colname].centre = self.column[colname].centroid
-            def f(x):
-                update_grid(x)
-                result = []
-                if connection_angle_weight: result += [connection_angle_weight*con.angle_cosine for con in cons]
-                if column_aspect_weight:
-                    result += [column_aspect_weight*(self.column[colname].side_ratio-1.) for colname in colnames]
-                if column_skewness_weight: 
-                    result += [column_skewness_weight*(self.column[colname].angle_ratio-1.) for colname in colnames]
-                return np.array(result)
-            x0 = np.array([self.node[nodename].pos for nodename in nodenames]).reshape(2*num_nodes)
-            x1, success = leastsq(f, x0)
-            if success > 4:
-                raise Exception('scipy leastsq() optimization routine did not converge.')
-            update_grid(x1)
-            for colname in colnames: self.column[colname].get_area()
+            for colname in colnames:
+                self.column[colname].centre = self.column[colname].centroid
+                self.column[colname].get_area()
+
+    def optimize_node_groups(self, nodenames, connections = True):
+        """Divides the specified nodes into groups which can be optimized independently (see optimize()), i.e.
+        groups which do not share any columns affected by moving the nodes, or (if connections is True) any
+        connections between these columns.  Nodes not in any column are omitted."""
+        from scipy import sparse
+        from scipy.sparse.csgraph import connected_components
+        nodeset = set(nodenames)
+        columns = [col for col in self.columnlist if nodeset & set([n.name for n in col.node])]
+        column_index = dict([(col.name, i) for i, col in enumerate(columns)])
+        node_index = {}
+        for name in nodenames: node_index.setdefault(name, len(node_index))
+        num_columns = len(columns)
+        # bipartite graph of columns and the nodes moved in them, plus connections between columns:
+        edges = [(column_index[col.name], num_columns + node_index[n.name]) for col in columns
+                 for n in col.node if n.name in nodeset]
+        if connections:
+            edges += [tuple([column_index[col.name] for col in con.column]) for con in self.connectionlist
+                      if all([col.name in column_index for col in con.column])]
+        edges = np.array(edges, dtype = int).reshape((-1,2))
+        num_vertices = num_columns + len(node_index)
+        graph = sparse.coo_matrix((np.ones(len(edges)), (edges[:,0], edges[:,1])), shape = (num_vertices, num_vertices))
+        num_groups, label = connected_components(graph, directed = False)
+        node_label = label[num_columns:]
+        grouped = set(edges[:,1][edges[:,1] >= num_columns] - num_columns)
+        groups = {}
+        for name, i in sorted(node_index.items(), key = lambda item: item[1]):
+            if i in grouped: groups.setdefault(node_label[i], []).append(name)
+        return [groups[k] for k in sorted(groups.keys())]
 
     def connection_with_nodes(self,nodes):
         """Returns a connection, if one exists, containing the specified two nodes."""
-        for con in self.connectionlist:
-            if all([node in con.node for node in nodes]): return con
-        return None
+        return self._node_pair_connection.get(frozenset(nodes))
 
     def nodes_in_columns(self,columns):
         """Returns a list of all nodes in the specified columns."""
@@ -2569,81 +4393,56 @@ class mulgrid(object):
         return set([col for col in self.columnlist if len(set(col.node) & bdynodes)>=2])
     boundary_columns=property(get_boundary_columns)
 
+    def get_mesh3d(self):
+        """Returns 3D mesh of the grid as a dictionary of arrays (see mulgrid_arrays.get_mesh3d()), which is
+        cached until the grid geometry changes."""
+        return self.arrays.mesh3d
+    mesh3d = property(get_mesh3d)
+
     def get_grid3d(self):
         """Returns 3D nodes and elements for the grid, and a dictionary of 'extra nodes' needed
         at the top surface from varying surface elevation.  """
-        node3d = {}
-        index = 0
-        def surf(col): return col.surface if col.surface is not None else self.layerlist[0].bottom
-        # create subsurface nodes
-        for lay in self.layerlist[1:]:
-            for node in self.nodelist:
-                if any([surf(col) > lay.bottom for col in node.column]):
-                    pos3d = np.array(list(node.pos) + [lay.bottom])
-                    node3d[lay.name, node.name] = (index, pos3d)
-                    index += 1
-        # identify where 'extra' nodes are needed
-        extra_node, node_elev = {}, {}
-        for node in self.nodelist:
-            if node.column:
-                colsurf = [surf(col) for col in node.column]
-                if len(set(colsurf)) <= 1: node_elev[node.name] = colsurf[0]
-                else:
-                    for col in node.column:
-                        if node.name in extra_node: extra_node[node.name].append(col.name)
-                        else: extra_node[node.name] = [col.name]
-        # create surface nodes
-        for node in self.nodelist:
-            if node.name in extra_node:
-                for colname in extra_node[node.name]:
-                    pos3d = np.array(list(node.pos) + [surf(self.column[colname])])
-                    node3d[self.layerlist[0].name, node.name, colname] = (index, pos3d)
-                    index += 1
-            else:
-                pos3d = np.array(list(node.pos)+[node_elev[node.name]])
-                node3d[self.layerlist[0].name, node.name] = (index, pos3d)
-                index += 1
-
-        # create elements
-        elt3d = []
-        atmlayer = self.layerlist[0]
-        for ilayer, lay in enumerate(self.layerlist[1:]):
-            for col in [c for c in self.columnlist if surf(c) > lay.bottom]:
-                elt = []
-                for node in col.node: elt.append(node3d[lay.name,node.name][0])
-                if ilayer == self.column_surface_layer_index(col) - 1: # top block
-                    for node in col.node:
-                        if node.name in extra_node: elt.append(node3d[atmlayer.name, node.name, col.name][0])
-                        else: elt.append(node3d[atmlayer.name, node.name][0])
-                else:
-                    for node in col.node: elt.append(node3d[self.layerlist[ilayer].name, node.name][0])
-                elt3d.append((lay, col, elt))
+        mesh = self.mesh3d
+        layer_name = [lay.name for lay in self.layerlist]
+        node_name = [node.name for node in self.nodelist]
+        col_name = [col.name for col in self.columnlist]
+        node3d, extra_node = {}, {}
+        for index, (ilayer, inode, icol, pos3d) in enumerate(zip(mesh['point_layer'], mesh['point_node'],
+                                                                 mesh['point_column'], mesh['points'])):
+            if icol >= 0:
+                node3d[layer_name[ilayer], node_name[inode], col_name[icol]] = (index, pos3d)
+                extra_node.setdefault(node_name[inode], []).append(col_name[icol])
+            else: node3d[layer_name[ilayer], node_name[inode]] = (index, pos3d)
+        connectivity, offsets = mesh['connectivity'].tolist(), mesh['offsets']
+        elt3d = [(self.layerlist[ilayer], self.columnlist[icol], connectivity[start: end])
+                 for ilayer, icol, start, end in zip(mesh['cell_layer'], mesh['cell_column'],
+                                                     offsets[:-1], offsets[1:])]
         return node3d,extra_node,elt3d
     grid3d = property(get_grid3d)
 
     def get_vtk_grid(self,arrays={}):
         """Returns a vtkUnstructuredGrid object (for visualisation with VTK) corresponding to the grid in 3D. 
         VTK data arrays may optionally be added."""
-        from vtk import vtkUnstructuredGrid, vtkPoints, vtkIdList, \
-            vtkWedge, vtkHexahedron, vtkPentagonalPrism, vtkHexagonalPrism, vtkConvexPointSet
-        node3d,extra_node,elt3d=self.grid3d
+        from vtk import vtkUnstructuredGrid, vtkPoints, vtkCellArray
+        from vtk.util.numpy_support import numpy_to_vtk, numpy_to_vtkIdTypeArray, ID_TYPE_CODE
+        mesh = self.mesh3d
         # construct the vtk grid
         grid=vtkUnstructuredGrid()
         pts=vtkPoints()
-        pts.SetNumberOfPoints(len(node3d))
-        for (key,(i,node)) in node3d.items(): pts.SetPoint(i,node)
+        pts.SetData(numpy_to_vtk(mesh['points'], deep = 1))
         grid.SetPoints(pts)
-        # create and add cells
-        celltype = {6: vtkWedge, 8: vtkHexahedron, 10: vtkPentagonalPrism, 12: vtkHexagonalPrism}
-        for ielt,(lay,col,elt) in enumerate(elt3d):
-            n = len(elt)
-            if n in celltype:
-                cell = celltype[n]()
-                for i,j in enumerate(elt): cell.GetPointIds().SetId(i,j)
-            else:
-                cell = vtkConvexPointSet()
-                for i,j in enumerate(elt): cell.GetPointIds().InsertId(i,j)
-            grid.InsertNextCell(cell.GetCellType(), cell.GetPointIds())
+        # add cells in legacy cell array format (number of points followed by point indices, for each cell)
+        offsets = mesh['offsets']
+        num_cells = len(offsets) - 1
+        num_points = np.diff(offsets)
+        locations = offsets[:-1] + np.arange(num_cells)
+        cell_data = np.empty(offsets[-1] + num_cells, dtype = ID_TYPE_CODE)
+        cell_data[locations] = num_points
+        cell_data[np.delete(np.arange(len(cell_data)), locations)] = mesh['connectivity']
+        cells = vtkCellArray()
+        cells.SetCells(num_cells, numpy_to_vtkIdTypeArray(cell_data, deep = 1))
+        grid.SetCells(numpy_to_vtk(mesh['cell_types'], deep = 1, array_type = vtk_unsigned_char),
+                      numpy_to_vtkIdTypeArray(locations.astype(ID_TYPE_CODE), deep = 1), cells)
         for array_type,array_dict in arrays.items():
             sortedkeys=array_dict.keys()
             sortedkeys.sort()
@@ -2929,129 +4728,58 @@ class mulgrid(object):
         self.setup_block_connection_name_index()
         if mapping: return colmap
 
+    def fitter(self, columns = [], alpha = 0.1, beta = 0.1, max_point_sets = 1):
+        """Returns a column_fitter object for fitting scattered data to the specified columns (or all columns)
+        of the geometry, with the specified smoothing parameters.  This can be used to fit several data sets
+        efficiently, reusing the geometry decomposition, point locations and matrix factorization (cached for
+        up to max_point_sets sets of point positions)."""
+        return column_fitter(self, columns, alpha, beta, max_point_sets)
+
     def fit_columns(self, data, alpha = 0.1, beta = 0.1, columns = [], min_columns = [], grid_boundary = False,
-                    silent = False, output_dict = False):
+                    silent = False, output_dict = False, fitter = None, processes = 1, chunk_size = 100000):
 
         """Fits scattered data to the column centres of the geometry, using least-squares bilinear finite element fitting with
         Sobolev smoothing.  The parameter data should be in the form of a 3-column array with x,y,z data in each row.
         The smoothing parameters alpha and beta control the first and second derivatives of the surface.
         If the parameter columns is specified, data will only be fitted for the specified column names.
         For columns with names in min_columns, column centre values will be calculated as the minimum of the fitted nodal
-        values.  For all other columns, the average of the nodal values is used.  If grid_boundary is True, only data
-        inside the bounding polygon of the grid are used- this can speed up the fitting if there are many data outside the 
-        grid, and the grid has a simply-shaped boundary.
+        values.  For all other columns, the average of the nodal values is used.  The data points are located in the
+        columns, and the fitting system assembled, using vectorized array operations on chunks of points.  (The
+        grid_boundary parameter is no longer needed, as points outside the grid are discarded efficiently, and is
+        retained only for compatibility.)  If a column_fitter object (see the fitter() method) is specified, it is used
+        for the fitting, and the alpha, beta and columns parameters are taken from it (and must not be specified).
+        For data sets too large to fit in memory, the data may instead be given as an iterable of data array chunks,
+        or as the name of a text or .npy file, in which case the fitting equations are accumulated chunk by chunk
+        (using the specified number of parallel processes and, for files, the specified chunk size).
         The result is by default an array of fitted values corresponding to each of the columns. If output_dict is True,
         the result is a dictionary of fitted values indexed by column names."""
-
-        if columns == []: columns = self.columnlist
-        else: 
-            if isinstance(columns[0],str): columns = [self.column[col] for col in columns]
-        if min_columns != []:
-            if not isinstance(min_columns[0],str): min_columns = [col.name for col in min_columns]
-
-        # make copy of geometry and decompose into 3,4 sided columns:
-        geo = mulgrid(convention = self.convention)
-        for n in self.nodelist: geo.add_node(node(n.name, n.pos))
-        for col in self.columnlist:
-            geo.add_column(column(col.name, [geo.node[n.name] for n in col.node]))
-        colmap = geo.decompose_columns(columns, mapping = True, chars = ascii_lowercase + ascii_uppercase)
-        geo_columns = []
-        for col in columns: geo_columns += [geo.column[geocol] for geocol in colmap[col.name]]
-            
-        nodes = geo.nodes_in_columns(geo_columns)
-        node_index = dict([(n.name,i) for i,n in enumerate(nodes)])
-        num_nodes = len(nodes)
-        # assemble least squares FEM fitting system:
-        from scipy import sparse
-        A = sparse.lil_matrix((num_nodes, num_nodes))
-        b = np.zeros(num_nodes)
-        guess = None
-        if grid_boundary: bounds = geo.boundary_polygon
-        else: bounds = None
-        qtree = geo.column_quadtree(columns)
-        import sys
-        nd = len(data)
-        for idata,d in enumerate(data):
-            col = geo.column_containing_point(d[0:2], geo_columns, guess, bounds, qtree)
-            percent = 100. * idata / nd
-            if not silent:
-                ps = 'fit_columns %3.0f%% done'% percent
-                sys.stdout.write('%s\r' % ps)
-                sys.stdout.flush()
-            if col:
-                xi = col.local_pos(d[0:2])
-                if xi is not None:
-                    guess = col
-                    psi = col.basis(xi)
-                    for i,nodei in enumerate(col.node):
-                        I = node_index[nodei.name]
-                        for j,nodej in enumerate(col.node):
-                            J = node_index[nodej.name]
-                            A[I,J] += psi[i] * psi[j]
-                        b[I] += psi[i] * d[2]
-
-        # add smoothing:
-        smooth = {3: 0.5 * alpha * np.array([[1.,0.,-1.],
-                                             [0.,1.,-1.],
-                                             [-1.,-1.,2.]]),
-                  4: alpha / 6. * np.array([[4.,-1.,-2.,-1.],
-                                            [-1.,4.,-1.,-2.],
-                                            [-2.,-1.,4.,-1.],
-                                            [-1.,-2.,-1.,4.]]) + \
-                      beta * np.array([[1.,-1.,1.,-1.],
-                                       [-1.,1.,-1.,1.],
-                                       [1.,-1.,1.,-1.],
-                                       [-1.,1.,-1.,1.]])}
-        for col in geo_columns:
-            for i,nodei in enumerate(col.node):
-                I = node_index[nodei.name]
-                for j,nodej in enumerate(col.node):
-                    J = node_index[nodej.name]
-                    A[I,J] += smooth[col.num_nodes][i,j]
-
-        A = A.tocsr()
-        from scipy.sparse.linalg import spsolve, use_solver
-        use_solver(useUmfpack = False)
-        z = spsolve(A, b)
-
-        column_values = []
-        def colnodez(col): return [z[node_index[node.name]] for node in col.node]
-        for col in columns:
-            if col.name in min_columns:
-                geocol_min = None
-                for geocolname in colmap[col.name]:
-                    geocol = geo.column[geocolname]
-                    nodez = colnodez(geocol)
-                    minnodez = min(nodez)
-                    if geocol_min is None: geocol_min = minnodez
-                    else: geocol_min = min(geocol_min, minnodez)
-                column_values.append(geocol_min)
-            else:
-                geocol_area, geocol_values = [],[]
-                for geocolname in colmap[col.name]:
-                    geocol = geo.column[geocolname]
-                    nodez = colnodez(geocol)
-                    geocol_area.append(geocol.area)
-                    geocol_values.append(sum(nodez) / geocol.num_nodes)
-                val = sum([area * val for area, val in zip(geocol_area, geocol_values)]) / sum(geocol_area)
-                column_values.append(val)
-        if output_dict: return dict(zip([col.name for col in columns], column_values))
-        else: return np.array(column_values)
+        if fitter is None: fitter = self.fitter(columns, alpha, beta)
+        elif alpha <> 0.1 or beta <> 0.1 or len(columns) > 0 or grid_boundary:
+            raise Exception('The alpha, beta, columns and grid_boundary parameters cannot be specified ' + \
+                            'when a fitter is used.')
+        return fitter.fit(data, min_columns = min_columns, silent = silent, output_dict = output_dict,
+                          processes = processes, chunk_size = chunk_size)
 
     def fit_surface(self, data, alpha = 0.1, beta = 0.1, columns = [], min_columns = [], grid_boundary = False,
-                    layer_snap = 0.0, silent = False):
+                    layer_snap = 0.0, silent = False, fitter = None, processes = 1, chunk_size = 100000):
 
         """Fits column surface elevations to the grid from the data, using the fit_columns() method (see documentation
         for that method for more detail). The layer_snap parameter can be specified as a positive number
         to avoid the creation of very thin top surface layers, if the fitted elevation is very close to the bottom of a layer.
-        In this case the value of layer_snap is a tolerance representing the smallest permissible layer thickness."""
+        In this case the value of layer_snap is a tolerance representing the smallest permissible layer thickness.
+        If a column_fitter object (see the fitter() method) is specified, it is used for the fitting, and the
+        alpha, beta and columns parameters are taken from it (and must not be specified).  Large data sets may be
+        given as an iterable of chunks, or a file name, as for fit_columns()."""
 
-        if columns == []: columns = self.columnlist
-        else: 
-            if isinstance(columns[0],str): columns = [self.column[col] for col in columns]
+        col_elevations = self.fit_columns(data, alpha, beta, columns, min_columns, grid_boundary, silent,
+                                          fitter = fitter, processes = processes, chunk_size = chunk_size)
+
+        if fitter is None:
+            if columns == []: columns = self.columnlist
+            else: 
+                if isinstance(columns[0],str): columns = [self.column[col] for col in columns]
+        else: columns = [self.column[col.name] for col in fitter.columns]
 
-        col_elevations = self.fit_columns(data, alpha, beta, columns, min_columns, grid_boundary, silent)
-        
         for col, elev in zip(columns, col_elevations):
             col.surface = elev
             self.set_column_num_layers(col)
@@ -3068,22 +4796,19 @@ class mulgrid(object):
         region as needed.  Only 3 and 4-sided columns are supported.  The parameter bisect_edge_columns can contain a list of
         columns outside the edge of the refinement area (as specified by the columns parameter) which should be bisected prior
         to the refinement.  This is useful for columns with larger aspect ratios just outside the refinement area, whose aspect
-        ratios would become even greater from simple refinement."""
+        ratios would become even greater from simple refinement.  The new nodes and columns are calculated using array
+        operations on the grid array representation, and added to the grid in a single batch."""
         if columns==[]: columns=self.columnlist
         else: 
             if isinstance(columns[0],str): columns=[self.column[col] for col in columns]
         connections=set([])
-        sidenodes={}
         chars = uniqstring(chars)
-        nodenumber, colnumber  = 0, 0
         justfn = [ljust,rjust][self.right_justified_names]
-        def create_mid_node(node1,node2,sidenodes,nodenumber):
-            midpos=0.5*(node1.pos+node2.pos)
-            nodenames=frozenset((node1.name,node2.name))
-            name,nodenumber = self.new_node_name(nodenumber, justfn, chars)
-            self.add_node(node(name,midpos))
-            sidenodes[nodenames]=self.nodelist[-1]
-            return sidenodes,nodenumber
+        arrays = self.arrays
+        num_nodes = len(self.nodelist)
+        node_index = dict([(id(n),i) for i,n in enumerate(self.nodelist)])
+        column_index = dict([(id(col),i) for i,col in enumerate(self.columnlist)])
+        refined_sides = [] # node index pairs of column sides to be split
         if bisect:
             if bisect==True: direction=None
             else: direction=bisect
@@ -3092,7 +4817,7 @@ class mulgrid(object):
                     n1,n2=col.node[i],col.node[(i+1)%col.num_nodes]
                     con=self.connection_with_nodes([n1,n2])
                     if con: connections.add(con)
-                    else: sidenodes,nodenumber = create_mid_node(n1,n2,sidenodes,nodenumber)
+                    else: refined_sides.append((node_index[id(n1)],node_index[id(n2)]))
         else: 
             for col in columns: connections=connections | col.connection
         if bisect_edge_columns<>[]:
@@ -3104,18 +4829,30 @@ class mulgrid(object):
             for col in bisect_edge_columns:
                 for con in col.connection:
                     if all([concol in bisect_edge_columns for concol in con.column]): connections.add(con)
-            # create midside nodes at connections:
-            for con in connections:
-                sidenodes,nodenumber=create_mid_node(con.node[0],con.node[1],sidenodes,nodenumber)
+            # midside nodes at connections:
+            connection_index = dict([(id(con),i) for i,con in enumerate(self.connectionlist)])
+            connections = sorted(connections, key = lambda con: connection_index[id(con)])
+            refined_sides += [(node_index[id(con.node[0])],node_index[id(con.node[1])]) for con in connections]
             if not bisect:
-                # create midside nodes on grid boundaries in the refinement area:
-                bdy=self.boundary_nodes
-                for col in columns:
-                    nn=col.num_nodes
-                    for i,corner in enumerate(col.node):
-                        next_corner=col.node[(i+1)%nn]
-                        if (corner in bdy) and (next_corner in bdy):
-                            sidenodes,nodenumber=create_mid_node(corner,next_corner,sidenodes,nodenumber)
+                # midside nodes on grid boundaries in the refinement area:
+                bdy = np.zeros(num_nodes, dtype = bool)
+                bdy[[node_index[id(n)] for n in self.boundary_nodes]] = True
+                colindex = np.array([column_index[id(col)] for col in columns], dtype = int)
+                a = arrays.column_node_indices
+                b = a[arrays.column_node_next]
+                side = np.nonzero(np.in1d(arrays.column_node_column, colindex) & bdy[a] & bdy[b])[0]
+                refined_sides += zip(a[side], b[side])
+            sides = np.array(refined_sides, dtype = int).reshape((-1,2))
+            side_keys, first = np.unique(np.min(sides, axis = 1) * num_nodes + np.max(sides, axis = 1),
+                                         return_index = True)
+            creation = np.argsort(first)
+            mid_node = np.zeros(len(side_keys), dtype = int)
+            mid_node[creation] = num_nodes + np.arange(len(side_keys))
+            new_pos = [0.5 * np.sum(arrays.node_pos[sides[np.sort(first)]], axis = 1)]
+            def side_node(a, b):
+                """Returns new midside node indices for sides between node indices a and b."""
+                key = np.minimum(a,b) * num_nodes + np.maximum(a,b)
+                return mid_node[np.searchsorted(side_keys, key)]
             def transition_type(nn,sides):
                 # returns transition type- classified by how many refined sides, starting side, and range
                 nref=len(sides)
@@ -3137,37 +4874,124 @@ class mulgrid(object):
                                   (2,2): ((0,(0,1),(2,3),3),((0,1),1,2,(2,3))),
                                   (3,2): ((0,(0,1),(2,3),3),((0,1),1,(1,2)),((1,2),2,(2,3)),((0,1),(1,2),(2,3))),
                                   (4,3): ((0,(0,1),'c',(3,0)),((0,1),1,(1,2),'c'),((1,2),2,(2,3),'c'),((2,3),3,(3,0),'c'))}}
+            # classify refined columns by number of nodes and refined sides:
+            old_columns = [col for col in self.columnlist if col in columns_plus_edge]
+            colindex = np.array([column_index[id(col)] for col in old_columns], dtype = int)
+            nn = arrays.column_num_nodes[colindex]
+            table = arrays.column_node_table[colindex,:4]
+            local = np.arange(4)
+            next_local = (local + 1) % nn[:,np.newaxis]
+            a, b = table, table[np.arange(len(colindex))[:,np.newaxis], next_local]
+            refined = (local < nn[:,np.newaxis]) & np.in1d(np.minimum(a,b) * num_nodes + np.maximum(a,b),
+                                                            side_keys).reshape(a.shape)
+            pattern = nn * 16 + np.sum(refined * (1 << local), axis = 1)
             # create refined columns (and centre nodes for quadrilaterals that need them):
-            centrenodes={}
-            for col in columns_plus_edge:
-                nn=col.num_nodes
-                refined_sides=[]
-                for i,corner in enumerate(col.node):
-                    if frozenset((corner.name,col.node[(i+1)%nn].name)) in sidenodes: refined_sides.append(i)
-                nrefined,istart,irange=transition_type(nn,refined_sides)
-                if (col.num_nodes==4) and ((nrefined==4) or ((nrefined==2) and (irange==1))):
-                    # create quadrilateral centre node:
-                    name,nodenumber = self.new_node_name(nodenumber, justfn, chars)
-                    self.add_node(node(name,col.centre))
-                    centrenodes[col.name]=self.nodelist[-1]
-                for subcol in transition_column[nn][nrefined,irange]:
-                    name,colnumber = self.new_column_name(colnumber, justfn, chars)
-                    nodes=[]
-                    for vert in subcol:
-                        if isinstance(vert,int): n=col.node[(istart+vert)%nn]
-                        elif vert=='c': n=centrenodes[col.name]
-                        else: n=sidenodes[frozenset([col.node[(istart+i)%nn].name for i in vert])]
-                        nodes.append(n)
-                    self.add_column(column(name,nodes,surface=col.surface))
-                    self.columnlist[-1].num_layers=col.num_layers
-            # clean up:
-            for col in columns_plus_edge: self.delete_column(col.name)
-            for con in self.missing_connections: self.add_connection(con)
-            self.identify_neighbours()
+            centre_node = -np.ones(len(colindex), dtype = int)
+            subcolumns = [] # (column position, subcolumn number, node indices) for each group of columns
+            next_node = num_nodes + len(side_keys)
+            for p in np.unique(pattern):
+                group = np.nonzero(pattern == p)[0]
+                n = p // 16
+                nrefined, istart, irange = transition_type(n, [i for i in xrange(n) if (p % 16) & (1 << i)])
+                if (n==4) and ((nrefined==4) or ((nrefined==2) and (irange==1))):
+                    centre_node[group] = -2
+                subcolumns.append((group, transition_column[n][nrefined,irange], n, istart))
+            need_centre = np.nonzero(centre_node == -2)[0]
+            centre_node[need_centre] = next_node + np.arange(len(need_centre))
+            new_pos.append(arrays.column_centre[colindex[need_centre]])
+            col_pos, col_num, col_nodes = [], [], []
+            for group, templates, n, istart in subcolumns:
+                for isub, subcol in enumerate(templates):
+                    nodes = -np.ones((len(group), 4), dtype = int)
+                    for k, vert in enumerate(subcol):
+                        if isinstance(vert,int): nodes[:,k] = table[group, (istart+vert)%n]
+                        elif vert=='c': nodes[:,k] = centre_node[group]
+                        else: nodes[:,k] = side_node(table[group, (istart+vert[0])%n], table[group, (istart+vert[1])%n])
+                    col_pos.append(group)
+                    col_num.append(np.ones(len(group), dtype = int) * isub)
+                    col_nodes.append(nodes)
+            if col_pos:
+                col_pos, col_num, col_nodes = np.concatenate(col_pos), np.concatenate(col_num), np.vstack(col_nodes)
+                order = np.lexsort((col_num, col_pos))
+                col_pos, col_nodes = col_pos[order], col_nodes[order]
+            # add new nodes and columns to the grid:
+            new_pos = np.vstack(new_pos)
+            new_nodes = [node(name, pos) for name, pos in zip(self.new_node_names(len(new_pos), justfn, chars), new_pos)]
+            all_nodes = self.nodelist + new_nodes
+            self.nodelist.extend(new_nodes)
+            for n in new_nodes: self.node[n.name] = n
+            new_names = self.new_column_names(len(col_pos), justfn, chars)
+            new_columns = []
+            for name, ipos, nodes in zip(new_names, col_pos, col_nodes):
+                parent = old_columns[ipos]
+                col = column(name, [all_nodes[i] for i in nodes if i >= 0], surface = parent.surface)
+                col.num_layers = parent.num_layers
+                new_columns.append(col)
+                self.columnlist.append(col)
+                self.column[name] = col
+                for n in col.node: n.column.add(col)
+            # remove refined columns and their connections:
+            old_columns_set = set(old_columns)
+            old_connections = set().union(*[col.connection for col in old_columns])
+            for con in old_connections:
+                self.unindex_connection(con)
+                for col in con.column:
+                    col.connection.discard(con)
+                    col.clear_cache()
+                colnames = (con.column[0].name, con.column[1].name)
+                if self.connection.get(colnames) is con: del self.connection[colnames]
+            self.connectionlist[:] = [con for con in self.connectionlist if con not in old_connections]
+            for col in old_columns:
+                for nbr in col.neighbour: nbr.neighbour.discard(col)
+                for n in col.node: n.column.discard(col)
+                del self.column[col.name]
+                self.free_name('column', col.name)
+            self.columnlist[:] = [col for col in self.columnlist if col not in old_columns_set]
+            self.unwatch_geometry(old_columns)
+            self.watch_geometry(new_nodes + new_columns)
+            self.add_side_connections()
             self.setup_block_name_index()
             self.setup_block_connection_name_index()
         else: print 'Grid selection contains columns with more than 4 nodes: not supported.'
 
+    def add_side_connections(self):
+        """Adds connections between all pairs of columns which share a side but are not yet connected, matching
+        column sides using the grid array representation.  For each new connection, the columns are ordered by
+        name (as for the missing_connections property).  Returns a list of the connections added."""
+        arrays = self.arrays
+        nn = len(arrays.node_pos)
+        a = arrays.column_node_indices.astype(np.int64)
+        b = a[arrays.column_node_next]
+        key = np.minimum(a,b) * nn + np.maximum(a,b)
+        order = np.argsort(key, kind = 'mergesort')
+        same = np.nonzero(key[order][1:] == key[order][:-1])[0]
+        e1, e2 = order[same], order[same + 1]
+        c1, c2 = arrays.column_node_column[e1], arrays.column_node_column[e2]
+        num_columns = arrays.num_columns
+        pair = np.minimum(c1,c2).astype(np.int64) * num_columns + np.maximum(c1,c2)
+        cons = arrays.connection_columns[np.all(arrays.connection_columns >= 0, axis = 1)].astype(np.int64)
+        existing = np.min(cons, axis = 1) * num_columns + np.max(cons, axis = 1)
+        new = (c1 <> c2) & ~np.in1d(pair, existing)
+        pair, i = np.unique(pair[new], return_index = True)
+        e1, e2, c1, c2 = e1[new][i], e2[new][i], c1[new][i], c2[new][i]
+        added = []
+        for ei, ej, ci, cj in zip(e1, e2, c1, c2):
+            coli, colj = self.columnlist[ci], self.columnlist[cj]
+            if colj.name < coli.name: ei, coli, colj = ej, colj, coli
+            con = connection([coli, colj])
+            con.node = [self.nodelist[a[ei]], self.nodelist[b[ei]]]
+            self.connectionlist.append(con)
+            self.connection[(coli.name, colj.name)] = con
+            for col in con.column:
+                col.connection.add(con)
+                col.clear_cache()
+            coli.neighbour.add(colj)
+            colj.neighbour.add(coli)
+            self.index_connection(con)
+            added.append(con)
+        if added: self.geometry_changed()
+        return added
+
     def refine_layers(self, layers=[], factor=2, chars = ascii_lowercase):
         """Refines selected layers in the grid.  If no layers are specified, all layers are refined.
         Each layer is refined by the specified factor.  Layer names for all subsurface layers in the grid
@@ -8,5 +8,5 @@ setup(name='PyTOUGH',
       author_email='a.croucher@auckland.ac.nz',
       url='https://github.com/acroucher/PyTOUGH',
       license='LGPL',
-      py_modules=['fixed_format_file','geometry','IAPWS97','mulgrids','t2data','t2grids','t2incons','t2listing','t2thermo'],
+      py_modules=['fixed_format_file','geometry','IAPWS97','instrumentation','mulgrids','t2data','t2grids','t2incons','t2listing','t2listing_server','t2thermo'],
       )
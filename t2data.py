@@ -15,6 +15,7 @@ from fixed_format_file import *
 from t2grids import *
 from t2incons import *
 from math import ceil
+from instrumentation import phase
 
 t2data_format_specification = {
     'title':[['title'],['80s']],
@@ -1244,9 +1245,10 @@ class t2data(object):
                 elif keyword in t2data_sections:
                     fn = self.read_fn[keyword]
                     next_line = None
-                    if keyword == 'SHORT': fn(infile,line)
-                    elif keyword == 'PARAM': next_line = fn(infile)
-                    else: fn(infile)
+                    with phase('t2data.read.' + keyword, infile):
+                        if keyword == 'SHORT': fn(infile,line)
+                        elif keyword == 'PARAM': next_line = fn(infile)
+                        else: fn(infile)
                     self._sections.append(keyword)
             else: more = False
         infile.close()
@@ -1290,7 +1292,7 @@ class t2data(object):
             if (keyword not in mesh_sections) and \
                     ((keyword not in self.extra_precision) or
                      (keyword in self.extra_precision and self.echo_extra_precision)):
-                    self.write_fn[keyword](outfile)
+                    with phase('t2data.write.' + keyword, outfile): self.write_fn[keyword](outfile)
         outfile.write(self.end_keyword+'\n')
         outfile.close()
     
@@ -1310,9 +1312,8 @@ class t2data(object):
         from copy import deepcopy
         tablegens=[' AIR','COM1','COM2','COM3','COM4','COM5','HEAT','MASS','NACL','TRAC',' VOL']
         if (colmapping=={}) or (mapping=={}): mapping,colmapping=sourcegeo.block_mapping(geo,True)
-        bbox=sourcegeo.bounds
-        qt=quadtree(bbox,sourcegeo.columnlist)
-        incols=[col for col in geo.columnlist if sourcegeo.column_containing_point(col.centre,qtree=qt) is not None]
+        incolindex=sourcegeo.column_indices_containing_points([col.centre for col in geo.columnlist])
+        incols=[col for col,i in zip(geo.columnlist,incolindex) if i>=0]
         self.clear_generators()
         col_generator=top_generator+bottom_generator
         for sourcegen in source.generatorlist:
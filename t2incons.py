@@ -259,3 +259,146 @@ class t2incon(object):
                     self[blk]=copy(default_atm_incons)
         # underground blocks:
         for blk in geo.block_name_list[geo.num_atmosphere_blocks:]: self[blk]=copy(sourceinc[mapping[blk]])
+
+class t2incon_array(t2incon):
+    """Class for a set of initial conditions over a TOUGH2 grid, stored in arrays rather than as individual
+    t2blockincon objects.  This is faster to create and write for large grids.  Indexing by block name
+    or index returns a t2blockincon copy of the initial conditions for that block- to modify values,
+    use the variable and porosity properties or assign to the item."""
+    def __init__(self, blocks = [], variable = None, porosity = None, timing = None):
+        self.simulator = 'TOUGH2'
+        self.read_function = fortran_read_function
+        self.empty()
+        self._blocklist = list(blocks)
+        self._block = dict([(blk,i) for i,blk in enumerate(self._blocklist)])
+        if variable is not None: self._variable = np.array(variable, float64).reshape((self.num_blocks, -1))
+        self.porosity = porosity
+        self.timing = timing
+
+    def __getitem__(self, key):
+        if isinstance(key, slice): return [self[i] for i in xrange(*key.indices(self.num_blocks))]
+        elif isinstance(key, str): i = self._block[key]
+        else: i = key
+        por = None if self._porosity is None or np.isnan(self._porosity[i]) else self._porosity[i]
+        return t2blockincon(self._variable[i], self._blocklist[i], por)
+    def __setitem__(self, key, value):
+        if isinstance(value, t2blockincon): incon = t2blockincon(value.variable, key, value.porosity)
+        else: incon = t2blockincon(value, key)
+        if key in self._block:
+            i = self._block[key]
+            self._variable[i] = incon.variable
+            if incon.porosity is not None:
+                if self._porosity is None: self._porosity = np.nan * np.ones(self.num_blocks)
+                self._porosity[i] = incon.porosity
+        else: self.insert_incon(self.num_blocks, incon)
+
+    def empty(self):
+        self._block = {}
+        self._blocklist = []
+        self._variable = np.zeros((0,0), float64)
+        self._porosity = None
+        self.timing = None
+
+    def get_num_variables(self): return self._variable.shape[1]
+    num_variables = property(get_num_variables)
+
+    def get_variable(self): return self._variable
+    def set_variable(self, val): self._variable[:] = val
+    variable = property(get_variable, set_variable)
+
+    def get_porosity(self):
+        if self._porosity is None: return np.array([None] * self.num_blocks)
+        blank = np.isnan(self._porosity)
+        if blank.any():
+            por = np.array(self._porosity, object)
+            por[blank] = None
+            return por
+        else: return self._porosity
+    def set_porosity(self, por):
+        if por is None: self._porosity = None
+        elif isinstance(por, float): self._porosity = por * np.ones(self.num_blocks)
+        elif len(por) == self.num_blocks:
+            if all([p is None for p in por]): self._porosity = None
+            else: self._porosity = np.array([np.nan if p is None else p for p in por], float64)
+        else: raise Exception('Porosity array is the wrong length ('+str(len(por))+').')
+    porosity = property(get_porosity, set_porosity)
+
+    def get_permeability(self): return np.array([None] * self.num_blocks)
+    permeability = property(get_permeability)
+
+    def get_blocklist(self): return self._blocklist
+    blocklist = property(get_blocklist)
+
+    def add_incon(self, incon):
+        """Adds a t2blockincon."""
+        if incon.block in self._block: self[incon.block] = incon
+        else: self.insert_incon(self.num_blocks, incon)
+
+    def insert_incon(self, index, incon):
+        """Inserts a t2blockincon at the specified index."""
+        if self.num_blocks == 0: self._variable = np.zeros((0, len(incon.variable)), float64)
+        self._variable = np.insert(self._variable, index, incon.variable, axis = 0)
+        if self._porosity is None and incon.porosity is not None:
+            self._porosity = np.nan * np.ones(self.num_blocks)
+        if self._porosity is not None:
+            por = np.nan if incon.porosity is None else incon.porosity
+            self._porosity = np.insert(self._porosity, index, por)
+        self._blocklist.insert(index, incon.block)
+        self._block = dict([(blk,i) for i,blk in enumerate(self._blocklist)])
+
+    def delete_incon(self, block):
+        """Deletes initial conditions for the specified block."""
+        if block in self._block:
+            i = self._block[block]
+            self._variable = np.delete(self._variable, i, axis = 0)
+            if self._porosity is not None: self._porosity = np.delete(self._porosity, i)
+            del self._blocklist[i]
+            self._block = dict([(blk,i) for i,blk in enumerate(self._blocklist)])
+
+    def read(self, filename, num_variables = None):
+        """Reads initial conditions from file."""
+        inc = t2incon(filename, self.read_function, num_variables)
+        self.__init__(inc.blocklist, inc.variable, inc.porosity, inc.timing)
+
+    def write(self, filename, reset = True, chunk_size = 10000):
+        """Writes initial conditions to file.  Block values are formatted in chunks of the specified
+        number of blocks, with a single string formatting operation for each chunk."""
+        outfile = t2incon_parser(filename, 'w')
+        if (self.timing is None) or reset:
+            outfile.write_values(['INCON'], 'header_short')
+        else:
+            outfile.write_values(['INCON -- INITIAL CONDITIONS FOR', self.num_blocks,
+                                  ' ELEMENTS AT TIME  ', self.timing['sumtim']], 'header_long')
+        nv = self.num_variables
+        vals_per_line = 4
+        line_fmts = ['%20.13e' * min(vals_per_line, nv - i) for i in xrange(0, nv, vals_per_line)]
+        porosity_fmt = ' ' * 15 if self._porosity is None else '%15s'
+        block_fmt = '%5s' + ' ' * 10 + porosity_fmt + '\n' + ''.join([fmt + '\n' for fmt in line_fmts])
+        for start in xrange(0, self.num_blocks, chunk_size):
+            end = min(start + chunk_size, self.num_blocks)
+            n = end - start
+            cols = [np.array([unfix_blockname(blk) for blk in self._blocklist[start:end]], object)]
+            if self._porosity is not None: # blank porosity for blocks without it, rather than nan
+                por = self._porosity[start:end]
+                porstr = np.char.mod('%15.9e', por).astype(object)
+                porstr[np.isnan(por)] = ' ' * 15
+                cols.append(porstr)
+            cols.append(self._variable[start:end])
+            vals = np.empty((n, len(cols) + nv - 1), object)
+            j = 0
+            for c in cols:
+                w = 1 if c.ndim == 1 else c.shape[1]
+                vals[:, j:j+w] = c.reshape((n, w))
+                j += w
+            outfile.write((block_fmt * n) % tuple(vals.ravel()))
+        if (self.timing is None) or reset: outfile.write('\n\n')
+        else:
+            outfile.write('+++\n')
+            outfile.write_value_line(self.timing, 'timing')
+        outfile.close()
+
+    def transfer_from(self, sourceinc, sourcegeo, geo, mapping = {}, colmapping = {}):
+        """Transfers initial conditions from another t2incon object, as for t2incon objects."""
+        inc = t2incon()
+        inc.transfer_from(sourceinc, sourcegeo, geo, mapping, colmapping)
+        self.__init__(inc.blocklist, inc.variable, inc.porosity, sourceinc.timing)
@@ -20,6 +20,7 @@ except ImportError: # try importing Numeric on old installs
     from Numeric import Float64 as float64
 from mulgrids import fix_blockname, valid_blockname
 from fixed_format_file import fortran_float, fortran_int
+from instrumentation import instrumented
 
 class listingtable(object):
 
@@ -136,6 +137,57 @@ class listingtable(object):
         return pd.DataFrame(datadict, columns = [row_header] + self.column_name)
     DataFrame = property(get_DataFrame)
 
+class zone_incidence(object):
+    """Signed incidence matrices between connections (or generators) in a listing and zones of blocks.
+    The zones are specified by a dictionary mapping block names to zone names- blocks not in the dictionary
+    are outside all zones.  Connection values are assumed to follow the TOUGH2 sign convention, in which a
+    positive flow is from the second block of the connection into the first."""
+
+    def __init__(self, zones, connection_names, generation_names = []):
+        from scipy import sparse
+        self.zone_name = sorted(set(zones.values()))
+        self._zone = dict([(name,i) for i,name in enumerate(self.zone_name)])
+        nz = self.num_zones
+        def zone_index(blkname): return self._zone[zones[blkname]] if blkname in zones else -1
+        conzones = np.array([(zone_index(b1), zone_index(b2)) for (b1,b2) in connection_names], int).reshape((-1,2))
+        icon = np.arange(len(connection_names))
+        z1, z2 = conzones[:,0], conzones[:,1]
+        cross = z1 <> z2 # connections between different zones, or between a zone and the outside
+        in1, in2 = cross & (z1 >= 0), cross & (z2 >= 0)
+        rows = np.hstack((z1[in1], z2[in2]))
+        cols = np.hstack((icon[in1], icon[in2]))
+        vals = np.hstack((np.ones(np.sum(in1)), -np.ones(np.sum(in2))))
+        self.incidence = sparse.csr_matrix((vals, (rows, cols)), shape = (nz, len(connection_names)))
+        both = in1 & in2
+        rows = np.hstack((z1[both] * nz + z2[both], z2[both] * nz + z1[both]))
+        cols = np.hstack((icon[both], icon[both]))
+        vals = np.hstack((np.ones(np.sum(both)), -np.ones(np.sum(both))))
+        self.interzone = sparse.csr_matrix((vals, (rows, cols)), shape = (nz * nz, len(connection_names)))
+        genzones = np.array([zone_index(key[0]) for key in generation_names], int)
+        igen = np.where(genzones >= 0)[0]
+        self.generation_incidence = sparse.csr_matrix((np.ones(len(igen)), (genzones[igen], igen)),
+                                                      shape = (nz, len(generation_names)))
+
+    def __repr__(self): return 'Incidence for ' + str(self.num_zones) + ' zones'
+
+    def get_num_zones(self): return len(self.zone_name)
+    num_zones = property(get_num_zones)
+
+    def net_inflow(self, flow):
+        """Returns array of net inflows into each zone (including flows from outside all zones), given
+        an array of connection flows."""
+        return self.incidence.dot(flow)
+
+    def interzone_flow(self, flow):
+        """Returns square array of net flows between zones, given an array of connection flows.  Element
+        [i,j] is the net flow into zone i from zone j."""
+        nz = self.num_zones
+        return self.interzone.dot(flow).reshape((nz, nz))
+
+    def generation(self, gen):
+        """Returns array of total generation in each zone, given an array of generation table values."""
+        return self.generation_incidence.dot(gen)
+
 class t2listing(file):
     """Class for TOUGH2 listing file.  The element, connection and generation tables can be accessed
        via the element, connection and generation fields.  (For example, the pressure in block 'aa100' is
@@ -361,6 +413,7 @@ class t2listing(file):
                         lineindex += 1
             self.seek(startpos)
 
+    @instrumented('t2listing.setup_pos')
     def setup_pos_AUTOUGH2(self):
         """Sets up _pos list for AUTOUGH2 listings, containing file position at the start of each set of results.
         Also sets up the times and steps arrays."""
@@ -392,6 +445,7 @@ class t2listing(file):
         self.fulltimes=np.array(fullt)
         self.fullsteps=np.array(fulls)
 
+    @instrumented('t2listing.setup_pos')
     def setup_pos_TOUGH2(self):
         """Sets up _pos list for TOUGH2 listings, containing file position at the start of each set of results.
         Also sets up the times and steps arrays."""
@@ -423,6 +477,7 @@ class t2listing(file):
         """Makes tables in self._table accessible as attributes."""        
         for key,table in self._table.iteritems(): setattr(self,key,table)
         
+    @instrumented('t2listing.setup_tables')
     def setup_tables_AUTOUGH2(self):
         """Sets up configuration of element, connection and generation tables."""
         tablename='element'
@@ -433,6 +488,7 @@ class t2listing(file):
             else: self.setup_table(tablename)
             tablename=self.next_table()
 
+    @instrumented('t2listing.setup_tables')
     def setup_tables_TOUGH2(self):
         self.read_title()
         tablename='element'
@@ -443,6 +499,7 @@ class t2listing(file):
             else: self.setup_table(tablename)
             tablename=self.next_table()
 
+    @instrumented('t2listing.setup_tables')
     def setup_tables_TOUGHplus(self):
         self.read_title()
         tablename='element'
@@ -795,6 +852,7 @@ class t2listing(file):
         if i < len(self._tablenames)-1: return self._tablenames[i+1]
         else: return None
 
+    @instrumented('t2listing.read_tables')
     def read_tables_AUTOUGH2(self):
         tablename='element'
         while tablename:
@@ -803,6 +861,7 @@ class t2listing(file):
             else: self.read_table(tablename)
             tablename=self.next_table()
 
+    @instrumented('t2listing.read_tables')
     def read_tables_TOUGH2(self):
         tablename = 'element'
         self.read_header() # only one header at each time
@@ -816,6 +875,7 @@ class t2listing(file):
             last_tablename = tablename
             tablename = self.next_table()
 
+    @instrumented('t2listing.read_tables')
     def read_tables_TOUGHplus(self):
         tablename='element'
         self.read_header() # only one header at each time
@@ -880,6 +940,7 @@ class t2listing(file):
             else: chars = '@@@@@'
             self.skipto(chars)
 
+    @instrumented('t2listing.history')
     def history(self, selection, short = True, start_datetime = None):
         """Returns time histories for specified selection of table type, names (or indices) and column names.
            Table type is specified as 'e','c','g' or 'p' (upper or lower case) for element table,
@@ -1192,6 +1253,63 @@ class t2listing(file):
                     dat.add_generator(t2generator(gen_name,blk.name,type='RECH',gx=coef,ex=h,hg=p0))
         self.index=initial_index
 
+    def incons(self, columns = None, tablename = None, index = None):
+        """Returns initial conditions (as a t2incon_array object) from the listing results at the specified
+        full results index (or the current index if not specified), e.g. for setting up a restart run.  The
+        columns parameter gives the names of the table columns containing the primary variables.  If it is not
+        specified, all columns of the primary table are used (TOUGH2 and TOUGH+ listings only).  The table
+        containing the columns can optionally be specified by name- by default, the primary table is used if
+        present, otherwise the element table."""
+        from t2incons import t2incon_array
+        if tablename is None: tablename = 'primary' if 'primary' in self._table else 'element'
+        if tablename not in self._table: raise Exception('Table ' + tablename + ' not found in listing.')
+        if index is not None: self.index = index
+        table = self._table[tablename]
+        if columns is None:
+            if tablename == 'primary': columns = table.column_name
+            else: raise Exception('No primary table in listing: primary variable columns must be specified.')
+        icols = [table._col[col] for col in columns]
+        timing = {'kcyc': self.step, 'sumtim': self.time}
+        return t2incon_array(table.row_name, table._data[:, icols], timing = timing)
+
+    def zone_budget(self, zones, flows = None, generation = None, indices = None):
+        """Returns mass and energy budgets over zones of blocks, at the specified full results indices (or
+        all of them if indices is None).  The zones are specified by a dictionary mapping block names to zone
+        names.  The flows and generation parameters are lists of connection and generation table column names to
+        include (by default, all columns are included).  Only the connection and generation tables are read, in
+        one pass through the listing.  The result is a dictionary containing the times, zone names and, for each
+        column, arrays of net inflow into each zone ('inflow'), inter-zone flows ('interzone') and total generation
+        in each zone ('generation'), indexed first by time."""
+        if indices is None: indices = range(self.num_fulltimes)
+        congen = [name for name in ['connection', 'generation'] if name in self._table]
+        if 'connection' not in congen: raise Exception('No connection table found in listing.')
+        con = self._table['connection']
+        gen = self._table['generation'] if 'generation' in congen else None
+        if flows is None: flows = con.column_name
+        if generation is None: generation = gen.column_name if gen else []
+        elif gen is None: raise Exception('No generation table found in listing.')
+        inc = zone_incidence(zones, con.row_name, gen.row_name if gen else [])
+        result = {'times': self.fulltimes[indices], 'zone_name': inc.zone_name, 'inflow': {}, 'interzone': {},
+                  'generation': {}}
+        for key, names in [('inflow', flows), ('interzone', flows), ('generation', generation)]:
+            for name in names: result[key][name] = []
+        initial_index, skip_tables = self.index, self.skip_tables
+        self.skip_tables = [name for name in self._table.keys() if name not in congen] + skip_tables
+        try:
+            for i in indices:
+                self.index = i
+                for name in flows:
+                    flow = con[name]
+                    result['inflow'][name].append(inc.net_inflow(flow))
+                    result['interzone'][name].append(inc.interzone_flow(flow))
+                for name in generation: result['generation'][name].append(inc.generation(gen[name]))
+        finally:
+            self.skip_tables = skip_tables
+            self.index = initial_index
+        for key in ['inflow', 'interzone', 'generation']:
+            for name in result[key]: result[key][name] = np.array(result[key][name])
+        return result
+
 class t2historyfile(object):
     """Class for TOUGH2 FOFT, COFT and GOFT files (history of element, connection and generator variables)."""
 
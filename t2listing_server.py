@@ -0,0 +1,453 @@
+"""Local query server for TOUGH2 listing and history files, with in-memory results cache.
+
+Requests are exchanged as pickled objects, so any process that can authenticate to the server can run
+arbitrary code in it (and have it read any file the server's user can read).  By default the server
+therefore uses a random authentication key, generated when it starts and written to a key file readable
+only by the user running the server (see authkey_filename()), from which clients read it."""
+
+"""
+Copyright 2012 University of Auckland.
+
+This file is part of PyTOUGH.
+
+PyTOUGH is free software: you can redistribute it and/or modify it under the terms of the GNU Lesser General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+PyTOUGH is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with PyTOUGH.  If not, see <http://www.gnu.org/licenses/>."""
+
+import os
+import threading
+from collections import OrderedDict
+from multiprocessing.connection import Listener, Client
+try:
+    import numpy as np
+except ImportError: # try importing Numeric on old installs
+    import Numeric as np
+from t2listing import t2listing, t2historyfile, listingtable
+
+default_address = ('localhost', 6512)
+
+def authkey_filename(address = default_address):
+    """Returns name of the key file for a listing server at the given address, in the user's home directory."""
+    return os.path.join(os.path.expanduser('~'), '.pytough_listing_server_%d.key' % address[1])
+
+def write_authkey(filename):
+    """Generates a random authentication key and writes it to a new key file, readable and writable only
+    by the current user.  Returns the key."""
+    from binascii import hexlify
+    authkey = hexlify(os.urandom(32))
+    if os.path.exists(filename): os.remove(filename)
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    with os.fdopen(fd, 'w') as f: f.write(authkey)
+    return authkey
+
+def read_authkey(filename):
+    """Reads authentication key from the specified key file, checking that it is not accessible by other users."""
+    import stat
+    if not os.path.exists(filename):
+        raise Exception('Listing server key file ' + filename + ' not found: is the server running?')
+    if os.stat(filename).st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+        raise Exception('Listing server key file ' + filename + ' is accessible by other users.')
+    with open(filename) as f: return f.read().strip()
+
+def client_authkey(address, authkey):
+    """Returns authentication key for a client connection, reading it from the server's key file if it is
+    not specified."""
+    if authkey is None: authkey = read_authkey(authkey_filename(address))
+    return authkey
+
+class results_cache(object):
+    """Least-recently-used cache, holding up to a specified maximum number of items.  If a close
+    function is given, it is called on items evicted from the cache."""
+
+    def __init__(self, max_items, close = None):
+        self.max_items = max_items
+        self.close = close
+        self._item = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def __len__(self): return len(self._item)
+    def __contains__(self, key): return key in self._item
+
+    def __getitem__(self, key):
+        value = self._item.pop(key)
+        self._item[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._item: del self._item[key]
+        self._item[key] = value
+        while len(self._item) > self.max_items:
+            oldkey, oldvalue = self._item.popitem(last = False)
+            if self.close: self.close(oldvalue)
+
+    def get(self, key, default = None):
+        """Returns cached value for the given key (or default if not present), recording cache hits and misses."""
+        if key in self._item:
+            self.hits += 1
+            return self[key]
+        else:
+            self.misses += 1
+            return default
+
+    def discard(self, match):
+        """Removes all items with keys for which the match function returns True."""
+        for key in [k for k in self._item if match(k)]:
+            value = self._item.pop(key)
+            if self.close: self.close(value)
+
+    def get_stats(self):
+        return {'items': len(self._item), 'max_items': self.max_items, 'hits': self.hits, 'misses': self.misses}
+    stats = property(get_stats)
+
+class listing_entry(object):
+    """Open listing file held by the server, together with a lock to serialize access to its file position.  The
+    number of requests using the entry is counted, so that an entry evicted from the server cache is not closed
+    until the last of them has finished with it."""
+    def __init__(self, filename, skip_tables = []):
+        self.filename = filename
+        self.key = listing_key(filename, skip_tables)
+        self.signature = file_signature(filename)
+        self.listing = t2listing(filename, skip_tables = skip_tables)
+        self.lock = threading.Lock()
+        self.users = 0
+        self.evicted = False
+        self._reductions = None
+
+    def close(self): self.listing.close()
+
+    def evict(self):
+        """Marks the entry as evicted from the server cache, closing it if it is not in use."""
+        self.evicted = True
+        if self.users == 0: self.close()
+
+    def get_reductions(self):
+        if self._reductions is None: self._reductions = self.listing.reductions
+        return self._reductions
+    reductions = property(get_reductions)
+
+def listing_key(filename, skip_tables = []):
+    """Returns key identifying a listing held by the server, from its file name and skipped tables."""
+    return (filename, tuple(sorted(skip_tables)))
+
+def file_signature(filename):
+    """Returns tuple of modification time and size of the specified file, used to detect when a cached
+    listing is out of date (e.g. for a simulation that is still running)."""
+    s = os.stat(filename)
+    return (s.st_mtime, s.st_size)
+
+def table_specification(table):
+    """Returns dictionary specifying the layout of a listing table (without its data)."""
+    return {'column_name': table.column_name, 'row_name': table.row_name, 'num_keys': table.num_keys,
+            'allow_reverse_keys': table.allow_reverse_keys}
+
+class t2listing_server(object):
+    """Server for answering queries on TOUGH2 listing and history files from other processes on the
+    local machine.  Each file is parsed only once, and the resulting indexes are kept open, together
+    with the most recently requested results tables and history selections.  Files modified since they
+    were loaded are automatically re-read.  If no authentication key is specified, a random key is
+    generated and written to the key file for the server address when the server starts."""
+
+    def __init__(self, address = default_address, authkey = None, max_listings = 4, max_tables = 32,
+                 max_histories = 64, max_historyfiles = 8):
+        self.address = address
+        self.authkey = authkey
+        self.authkey_file = None
+        self.listings = results_cache(max_listings, lambda entry: entry.evict())
+        self.tables = results_cache(max_tables)
+        self.histories = results_cache(max_histories)
+        self.historyfiles = results_cache(max_historyfiles)
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._listener = None
+        self._running = False
+        self.commands = {'listing': self.listing_info, 'table': self.table, 'history': self.history,
+                         'reductions': self.reductions, 'historyfile': self.historyfile,
+                         'stats': self.get_stats, 'shutdown': self.shutdown}
+
+    def __repr__(self): return 'Listing server at ' + repr(self.address)
+
+    def entry(self, filename, skip_tables = []):
+        """Returns listing entry for the specified file and skipped tables, loading it if it is not cached or
+        has changed since it was cached.  Listings are loaded outside the server lock, so that queries on
+        other listings are not held up, while only one request loads each listing.  The entry is marked as
+        in use, and must be released (see release()) when the request has finished with it."""
+        filename = os.path.abspath(filename)
+        key = listing_key(filename, skip_tables)
+        signature = file_signature(filename)
+        with self._lock:
+            loading = self._loading.setdefault(key, [threading.Lock(), 0])
+            loading[1] += 1
+        try:
+            with loading[0]:
+                with self._lock:
+                    entry = self.listings.get(key)
+                    if entry is not None and entry.signature <> signature:
+                        self.listings.discard(lambda k: k[0] == filename)
+                        self.tables.discard(lambda k: k[0][0] == filename)
+                        self.histories.discard(lambda k: k[0][0] == filename)
+                        entry = None
+                    if entry is not None: entry.users += 1
+                if entry is None:
+                    entry = listing_entry(filename, skip_tables)
+                    with self._lock:
+                        entry.users += 1
+                        self.listings[key] = entry
+        finally:
+            with self._lock:
+                loading[1] -= 1
+                if loading[1] == 0: del self._loading[key]
+        return entry
+
+    def release(self, entry):
+        """Records that a request has finished using a listing entry, closing it if it has been evicted from
+        the cache and is no longer in use."""
+        with self._lock:
+            entry.users -= 1
+            if entry.evicted and entry.users == 0: entry.close()
+
+    def using_entry(self, filename, skip_tables = []):
+        """Returns context manager giving the listing entry for the specified file and skipped tables (see
+        entry()), which is released on exit."""
+        from contextlib import contextmanager
+        @contextmanager
+        def using():
+            entry = self.entry(filename, skip_tables)
+            try: yield entry
+            finally: self.release(entry)
+        return using()
+
+    def listing_info(self, filename, skip_tables = []):
+        """Returns dictionary of listing properties and table specifications."""
+        with self.using_entry(filename, skip_tables) as entry, entry.lock:
+            lst = entry.listing
+            return {'filename': entry.filename, 'title': lst.title, 'simulator': lst.simulator,
+                    'times': lst.times, 'steps': lst.steps, 'fulltimes': lst.fulltimes, 'fullsteps': lst.fullsteps,
+                    'short_types': lst.short_types,
+                    'tables': dict([(name, table_specification(table)) for name, table in lst._table.iteritems()])}
+
+    def table(self, filename, index, tablename, skip_tables = []):
+        """Returns data array for the specified table at the specified results index."""
+        with self.using_entry(filename, skip_tables) as entry:
+            lst = entry.listing
+            if index < 0: index += lst.num_fulltimes
+            key = (entry.key, index, tablename)
+            with self._lock: data = self.tables.get(key)
+            if data is None:
+                with entry.lock:
+                    if lst.index <> index: lst.index = index
+                    tables = [(name, table._data.copy()) for name, table in lst._table.iteritems()]
+                with self._lock:
+                    for name, tabledata in tables: self.tables[(entry.key, index, name)] = tabledata
+                data = dict(tables)[tablename]
+        return data
+
+    def history(self, filename, selection, short = True, skip_tables = []):
+        """Returns history results for the specified selection."""
+        if isinstance(selection, tuple): selection = [selection]
+        with self.using_entry(filename, skip_tables) as entry:
+            key = (entry.key, tuple([tuple(s) for s in selection]), short)
+            with self._lock: result = self.histories.get(key)
+            if result is None:
+                with entry.lock: result = entry.listing.history(selection, short)
+                with self._lock: self.histories[key] = result
+        return result
+
+    def reductions(self, filename, skip_tables = []):
+        """Returns time step reductions for the specified listing."""
+        with self.using_entry(filename, skip_tables) as entry, entry.lock: return entry.reductions
+
+    def historyfile(self, filename):
+        """Returns dictionary of contents of the specified FOFT, COFT or GOFT file(s).  The filename may contain
+        wildcards, as for t2historyfile objects."""
+        from glob import glob
+        filename = os.path.abspath(filename)
+        signature = tuple([file_signature(fname) for fname in sorted(glob(filename))])
+        with self._lock:
+            item = self.historyfiles.get(filename)
+            if item is not None and item[0] <> signature: item = None
+        if item is None:
+            hist = t2historyfile(filename)
+            contents = dict([(name, getattr(hist, name)) for name in
+                             ['simulator', 'type', 'times', 'keys', 'key_name', 'column_name', 'row_name',
+                              '_data', '_keyrows', '_nkeys']])
+            contents['_row'] = hist._row
+            item = (signature, contents)
+            with self._lock: self.historyfiles[filename] = item
+        return item[1]
+
+    def get_stats(self):
+        """Returns dictionary of cache statistics."""
+        with self._lock:
+            return {'listings': self.listings.stats, 'tables': self.tables.stats, 'histories': self.histories.stats,
+                    'historyfiles': self.historyfiles.stats}
+
+    def shutdown(self):
+        """Stops the server after the current request."""
+        self._running = False
+        try: Client(self.address, authkey = self.authkey).close() # wake up listener
+        except Exception: pass
+
+    def handle(self, conn):
+        """Answers requests on the given connection until it is closed."""
+        try:
+            while True:
+                command, args, kwargs = conn.recv()
+                try:
+                    result = self.commands[command](*args, **kwargs)
+                    conn.send(('ok', result))
+                except Exception as e:
+                    conn.send(('error', '%s: %s' % (e.__class__.__name__, str(e))))
+        except (EOFError, IOError): pass
+        finally: conn.close()
+
+    def serve_forever(self):
+        """Accepts client connections, each answered in its own thread, until shutdown."""
+        if self.authkey is None:
+            self.authkey_file = authkey_filename(self.address)
+            self.authkey = write_authkey(self.authkey_file)
+        elif not self.authkey: raise Exception('Listing server requires a non-empty authentication key.')
+        self._listener = Listener(self.address, backlog = 16, authkey = self.authkey)
+        self._running = True
+        try:
+            while self._running:
+                try: conn = self._listener.accept()
+                except Exception: continue
+                if self._running:
+                    t = threading.Thread(target = self.handle, args = (conn,))
+                    t.daemon = True
+                    t.start()
+                else: conn.close()
+        finally:
+            self._listener.close()
+            with self._lock: self.listings.discard(lambda k: True)
+            if self.authkey_file and os.path.exists(self.authkey_file): os.remove(self.authkey_file)
+
+    def start(self):
+        """Starts the server in a background thread, and returns the thread."""
+        t = threading.Thread(target = self.serve_forever)
+        t.daemon = True
+        t.start()
+        return t
+
+class listing_server_connection(object):
+    """Connection to a running listing server.  If no authentication key is specified, it is read from the
+    server's key file."""
+    def __init__(self, address = default_address, authkey = None):
+        self._conn = Client(address, authkey = client_authkey(address, authkey))
+
+    def request(self, command, *args, **kwargs):
+        """Sends request to the server and returns the result."""
+        self._conn.send((command, args, kwargs))
+        status, result = self._conn.recv()
+        if status == 'ok': return result
+        else: raise Exception(result)
+
+    def close(self): self._conn.close()
+
+class t2listing_client(object):
+    """Client for a TOUGH2 listing file held by a listing server.  This has the same properties and
+    navigation methods as a t2listing object, and also the history() method and reductions property.
+    Tables are fetched from the server only when the results index changes."""
+
+    def __init__(self, filename, address = default_address, authkey = None, skip_tables = [],
+                 connection = None):
+        self.filename = os.path.abspath(filename)
+        self.skip_tables = list(skip_tables)
+        self.server = connection if connection else listing_server_connection(address, authkey)
+        info = self.server.request('listing', self.filename, self.skip_tables)
+        for name in ['title', 'simulator', 'times', 'steps', 'fulltimes', 'fullsteps', 'short_types']:
+            setattr(self, name, info[name])
+        self._table = {}
+        for name, spec in info['tables'].iteritems():
+            self._table[name] = listingtable(spec['column_name'], spec['row_name'], num_keys = spec['num_keys'],
+                                             allow_reverse_keys = spec['allow_reverse_keys'])
+            setattr(self, name, self._table[name])
+        self._index = None
+        self.first()
+
+    def __repr__(self): return self.title
+
+    def get_index(self): return self._index
+    def set_index(self, i):
+        if i < 0: i += self.num_fulltimes
+        if i <> self._index:
+            for name, table in self._table.iteritems():
+                table._data = self.server.request('table', self.filename, i, name, self.skip_tables)
+            self._index = i
+    index = property(get_index, set_index)
+
+    def get_time(self): return self.fulltimes[self._index]
+    def set_time(self, t):
+        if t < self.fulltimes[0]: self.index = 0
+        elif t > self.fulltimes[-1]: self.index = -1
+        else: self.index = np.argmin(np.abs(self.fulltimes - t))
+    time = property(get_time, set_time)
+
+    def get_step(self): return self.fullsteps[self._index]
+    def set_step(self, step):
+        if step < self.fullsteps[0]: self.index = 0
+        elif step > self.fullsteps[-1]: self.index = -1
+        else: self.index = np.argmin(np.abs(self.fullsteps - step))
+    step = property(get_step, set_step)
+
+    def get_num_times(self): return len(self.times)
+    num_times = property(get_num_times)
+    def get_num_fulltimes(self): return len(self.fulltimes)
+    num_fulltimes = property(get_num_fulltimes)
+
+    def get_table_names(self):
+        names = self._table.keys()
+        names.sort()
+        return names
+    table_names = property(get_table_names)
+
+    def first(self): self.index = 0
+    def last(self): self.index = -1
+    def next(self):
+        """Find and read next set of results; returns false if at end of listing"""
+        more = self.index < self.num_fulltimes - 1
+        if more: self.index += 1
+        return more
+    def prev(self):
+        """Find and read previous set of results; returns false if at start of listing"""
+        more = self.index > 0
+        if more: self.index -= 1
+        return more
+
+    def history(self, selection, short = True, start_datetime = None):
+        """Returns time histories for specified selection of table type, names (or indices) and column names,
+        as for the t2listing history() method."""
+        result = self.server.request('history', self.filename, selection, short, self.skip_tables)
+        if start_datetime is not None and result is not None:
+            from datetime import timedelta
+            def datetime_array(t): return np.array([start_datetime + timedelta(0, s) for s in t])
+            if isinstance(result, tuple): result = (datetime_array(result[0]), result[1])
+            else: result = [(datetime_array(t), h) for t, h in result]
+        return result
+
+    def get_reductions(self): return self.server.request('reductions', self.filename, self.skip_tables)
+    reductions = property(get_reductions)
+
+    def close(self): self.server.close()
+
+class t2historyfile_client(t2historyfile):
+    """Client for TOUGH2 FOFT, COFT or GOFT file(s) held by a listing server.  This behaves in the
+    same way as a t2historyfile object."""
+    def __init__(self, filename = None, address = default_address, authkey = None, connection = None):
+        self.server = connection if connection else listing_server_connection(address, authkey)
+        super(t2historyfile_client, self).__init__(filename)
+
+    def read(self, filename):
+        """Fetches contents of file(s) from the server."""
+        contents = self.server.request('historyfile', os.path.abspath(filename))
+        for name, value in contents.iteritems(): setattr(self, name, value)
+
+if __name__ == '__main__':
+    import sys
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else default_address[1]
+    server = t2listing_server(address = (default_address[0], port))
+    print repr(server)
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass